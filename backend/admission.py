@@ -0,0 +1,369 @@
+"""
+Admission Control
+Caps the number of try-ons in flight to the upstream. Extra requests wait in a
+bounded queue until a deadline; past that they are refused at once with a
+Retry-After estimated from the queue depth and observed service time, so a
+slow Space turns into fast 429s instead of an ever-growing backlog.
+
+Slots are shared fairly: each user_id has a token bucket, waiting users are
+served round-robin, and anonymous traffic (keyed by client address) is a
+lower-priority class that gets one slot for every `user_weight` given to users.
+"""
+
+import os
+import math
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+import tryon_metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_RETRY_AFTER = 300  # seconds
+
+USERS = "user"
+ANONYMOUS = "anonymous"
+
+
+def tenant_of(user_id: Optional[str], client: Optional[str]) -> Tuple[str, str]:
+    """(priority class, fairness key) of a request."""
+    if user_id:
+        return USERS, f"user:{user_id}"
+    return ANONYMOUS, f"anon:{client or 'unknown'}"
+
+
+class AdmissionRejected(Exception):
+    """Raised when a try-on can't be admitted (queue full, rate limited, or waited too long)."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate  # tokens per second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Spend one token: 0 on success, else the seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class RateLimiter:
+    """A token bucket per tenant; rate 0 disables limiting. Not thread-safe on its own."""
+
+    def __init__(self, rate_per_min: float, burst: float, max_tenants: int = 10000):
+        self.rate = rate_per_min / 60
+        self.burst = burst
+        self.max_tenants = max_tenants
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    def take(self, tenant: str) -> float:
+        if self.rate <= 0:
+            return 0.0
+        bucket = self._buckets.get(tenant)
+        if bucket is None:
+            if len(self._buckets) >= self.max_tenants:
+                self._prune()
+            bucket = self._buckets[tenant] = TokenBucket(self.rate, self.burst)
+        return bucket.take()
+
+    def _prune(self):
+        # A refilled bucket is the same as a fresh one
+        now = time.monotonic()
+        for tenant in [t for t, b in self._buckets.items() if b.full(now)]:
+            del self._buckets[tenant]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class _Waiter:
+    def __init__(self, notify: Callable[[], None], priority: str, tenant: str, prepaid: bool = False):
+        self.notify = notify  # called, under the controller lock, when a slot is handed over
+        self.priority = priority
+        self.tenant = tenant
+        # Part of an already-admitted batch: waits for its turn without a deadline
+        self.prepaid = prepaid
+        self.granted = False
+        self.enqueued_at = time.perf_counter()
+
+
+class AdmissionController:
+    """
+    A semaphore with a bounded, fair wait queue. release() hands the slot
+    straight to the next waiter, so a newcomer can never overtake the queue;
+    within a priority class the waiting tenants take turns, one request each.
+    Usable from threads (slot) and coroutines (aslot) alike.
+    """
+
+    def __init__(self, max_in_flight: int = 6, max_queue: int = 3, queue_timeout: float = 20,
+                 max_queue_per_tenant: int = 2, user_weight: int = 3,
+                 user_limiter: Optional[RateLimiter] = None, anon_limiter: Optional[RateLimiter] = None,
+                 default_service_time: float = 30, ewma_alpha: float = 0.2):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_queue_per_tenant = max_queue_per_tenant
+        self.user_weight = user_weight
+        self.limiters = {
+            USERS: RateLimiter(0, 1) if user_limiter is None else user_limiter,
+            ANONYMOUS: RateLimiter(0, 1) if anon_limiter is None else anon_limiter,
+        }
+        self.default_service_time = default_service_time
+        self.ewma_alpha = ewma_alpha
+        self.service_time: Optional[float] = None  # EWMA seconds a slot is held
+        self._in_flight = 0
+        # class -> tenant -> its waiters; dict order is the round-robin order
+        self._waiting: Dict[str, "OrderedDict[str, Deque[_Waiter]]"] = {
+            USERS: OrderedDict(),
+            ANONYMOUS: OrderedDict(),
+        }
+        self._queued = 0
+        self._user_turns = 0  # handoffs to users since the last anonymous one
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.rejected = 0
+        self.rate_limited = 0
+        self.timed_out = 0
+
+    @classmethod
+    def from_env(cls) -> "AdmissionController":
+        return cls(
+            max_in_flight=int(os.getenv("TRYON_MAX_IN_FLIGHT", 6)),
+            max_queue=int(os.getenv("TRYON_ADMISSION_QUEUE", 3)),
+            queue_timeout=float(os.getenv("TRYON_ADMISSION_TIMEOUT", 20)),
+            max_queue_per_tenant=int(os.getenv("TRYON_ADMISSION_QUEUE_PER_USER", 2)),
+            user_weight=int(os.getenv("TRYON_FAIR_USER_WEIGHT", 3)),
+            user_limiter=RateLimiter(
+                float(os.getenv("TRYON_USER_RATE_PER_MIN", 12)),
+                float(os.getenv("TRYON_USER_BURST", 6)),
+            ),
+            anon_limiter=RateLimiter(
+                float(os.getenv("TRYON_ANON_RATE_PER_MIN", 6)),
+                float(os.getenv("TRYON_ANON_BURST", 3)),
+            ),
+        )
+
+    def _retry_after(self) -> int:
+        """Seconds until a new arrival could expect a slot (caller holds the lock)."""
+        service = self.service_time or self.default_service_time
+        waves = (self._queued + 1) / self.max_in_flight
+        return max(1, min(MAX_RETRY_AFTER, math.ceil(service * waves)))
+
+    def _reject(self, message: str, priority: str = "unknown") -> AdmissionRejected:
+        """Count and build a rejection (caller holds the lock)."""
+        metrics.ADMISSION.inc(outcome="rejected", priority=priority)
+        self.rejected += 1
+        return AdmissionRejected(message, self._retry_after())
+
+    def check(self):
+        """Refuse right away if even the wait queue is full; call before reading the body."""
+        with self._lock:
+            if self._in_flight >= self.max_in_flight and self._queued >= self.max_queue:
+                raise self._reject("Try-on service is at capacity, please retry later")
+
+    def _take_token(self, priority: str, tenant: str):
+        """Spend one of the tenant's tokens or raise (caller holds the lock)."""
+        wait = self.limiters[priority].take(tenant)
+        if wait:
+            metrics.ADMISSION.inc(outcome="rate_limited", priority=priority)
+            self.rate_limited += 1
+            raise AdmissionRejected(
+                "Too many try-ons, please slow down",
+                max(1, min(MAX_RETRY_AFTER, math.ceil(wait))),
+            )
+
+    def charge(self, user_id: Optional[str] = None, client: Optional[str] = None):
+        """
+        Admit a request that fans out into several try-ons (a batch) as one:
+        one capacity check and one token, so it is refused up front or not at
+        all. Its try-ons then take slots with `prepaid=True`.
+        """
+        priority, tenant = tenant_of(user_id, client)
+        with self._lock:
+            if self._in_flight >= self.max_in_flight and self._queued >= self.max_queue:
+                raise self._reject("Try-on service is at capacity, please retry later", priority)
+            self._take_token(priority, tenant)
+
+    def _enter(self, notify: Callable[[], None], priority: str, tenant: str,
+               prepaid: bool = False) -> Optional[_Waiter]:
+        """
+        Take a free slot (None) or join the queue (the waiter). A token is only
+        spent once the request is admitted or queued. Prepaid try-ons were
+        admitted by charge(): no token, and no queue limits. Raises AdmissionRejected.
+        """
+        with self._lock:
+            if self._in_flight < self.max_in_flight and not self._queued:
+                if not prepaid:
+                    self._take_token(priority, tenant)
+                self._in_flight += 1
+                self.admitted += 1
+                metrics.ADMISSION.inc(outcome="admitted", priority=priority)
+                return None
+            tenants = self._waiting[priority]
+            waiters = tenants.get(tenant)
+            if not prepaid:
+                if self._queued >= self.max_queue:
+                    raise self._reject("Try-on service is at capacity, please retry later", priority)
+                if waiters is not None and len(waiters) >= self.max_queue_per_tenant:
+                    raise self._reject("Too many of your try-ons are already waiting", priority)
+                self._take_token(priority, tenant)
+            if waiters is None:
+                waiters = tenants[tenant] = deque()
+            waiter = _Waiter(notify, priority, tenant, prepaid)
+            waiters.append(waiter)
+            self._queued += 1
+            metrics.ADMISSION.inc(outcome="queued", priority=priority)
+            return waiter
+
+    def _remove(self, waiter: _Waiter):
+        """Take a waiter that gave up out of the queue (caller holds the lock)."""
+        tenants = self._waiting[waiter.priority]
+        waiters = tenants[waiter.tenant]
+        waiters.remove(waiter)
+        if not waiters:
+            del tenants[waiter.tenant]
+        self._queued -= 1
+
+    def _settle(self, waiter: _Waiter):
+        """After a wait: keep the slot if it was handed over, else leave the queue and raise."""
+        with self._lock:
+            if not waiter.granted:
+                self._remove(waiter)
+                self.timed_out += 1
+                metrics.ADMISSION.inc(outcome="timed_out", priority=waiter.priority)
+                raise AdmissionRejected(
+                    f"No try-on slot freed up within {self.queue_timeout:g}s, please retry later",
+                    self._retry_after(),
+                )
+        metrics.STAGE_SECONDS.observe(time.perf_counter() - waiter.enqueued_at, stage="admission_wait")
+
+    def _next_waiter(self) -> _Waiter:
+        """
+        The waiter that gets the next free slot (caller holds the lock):
+        weighted round-robin between the classes, then round-robin over the
+        tenants of the chosen class.
+        """
+        users, anonymous = self._waiting[USERS], self._waiting[ANONYMOUS]
+        if users and (not anonymous or self._user_turns < self.user_weight):
+            tenants = users
+            self._user_turns = min(self._user_turns + 1, self.user_weight)
+        else:
+            tenants = anonymous
+            self._user_turns = 0
+        tenant, waiters = next(iter(tenants.items()))
+        waiter = waiters.popleft()
+        del tenants[tenant]
+        if waiters:
+            tenants[tenant] = waiters  # to the back of the round
+        self._queued -= 1
+        return waiter
+
+    def acquire(self, user_id: Optional[str] = None, client: Optional[str] = None, prepaid: bool = False):
+        event = threading.Event()
+        waiter = self._enter(event.set, *tenant_of(user_id, client), prepaid)
+        if waiter is not None:
+            event.wait(None if prepaid else self.queue_timeout)
+            self._settle(waiter)
+
+    async def aacquire(self, user_id: Optional[str] = None, client: Optional[str] = None,
+                       prepaid: bool = False):
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(True))
+
+        waiter = self._enter(notify, *tenant_of(user_id, client), prepaid)
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(granted, None if prepaid else self.queue_timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            with self._lock:
+                granted_slot = waiter.granted
+                if not granted_slot:
+                    self._remove(waiter)
+            if granted_slot:
+                self.release()  # handed a slot we'll never use
+            raise
+        self._settle(waiter)
+
+    def release(self, service_seconds: Optional[float] = None):
+        with self._lock:
+            if service_seconds is not None:
+                if self.service_time is None:
+                    self.service_time = service_seconds
+                else:
+                    self.service_time += self.ewma_alpha * (service_seconds - self.service_time)
+            if self._queued:
+                # Hand the slot over: in_flight stays the same
+                waiter = self._next_waiter()
+                waiter.granted = True
+                self.admitted += 1
+                waiter.notify()
+            else:
+                self._in_flight -= 1
+
+    @contextmanager
+    def slot(self, user_id: Optional[str] = None, client: Optional[str] = None, prepaid: bool = False):
+        """`with admission.slot(user_id, client):` around one upstream try-on."""
+        self.acquire(user_id, client, prepaid)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - started)
+
+    @asynccontextmanager
+    async def aslot(self, user_id: Optional[str] = None, client: Optional[str] = None,
+                    prepaid: bool = False):
+        await self.aacquire(user_id, client, prepaid)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - started)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "max_in_flight": self.max_in_flight,
+                "queued": self._queued,
+                "queued_by_class": {
+                    priority: sum(len(waiters) for waiters in tenants.values())
+                    for priority, tenants in self._waiting.items()
+                },
+                "waiting_tenants": sum(len(tenants) for tenants in self._waiting.values()),
+                "max_queue": self.max_queue,
+                "max_queue_per_user": self.max_queue_per_tenant,
+                "queue_timeout": self.queue_timeout,
+                "service_time": round(self.service_time, 3) if self.service_time else None,
+                "retry_after": self._retry_after(),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "rate_limited": self.rate_limited,
+                "timed_out": self.timed_out,
+                "tracked_tenants": {priority: len(limiter) for priority, limiter in self.limiters.items()},
+            }
@@ -3,29 +3,45 @@ Virtual Dressing Room - AI Backend Service (Gemini Version)
 Integrates Google Gemini 1.5 Flash for Virtual Try-On
 """
 
+import startup  # first: marks the start of the startup-time report
 import os
 import logging
 from datetime import datetime
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 from dotenv import load_dotenv
 
-# Load environment variables
+# Load environment variables (the only place they are loaded for the app)
 load_dotenv()
 
 # Import try-on API
 # This will now use the updated llm_tryon_service we created in Phase 1
-from tryon_api import tryon_bp
+with startup.phase("imports"):
+    import tryon_api
+    from tryon_api import tryon_bp
+import tryon_metrics
 
 # ============================================
 # CONFIGURATION
 # ============================================
 
 app = Flask(__name__)
-CORS(app)
-
-# Register try-on API blueprint
-app.register_blueprint(tryon_bp)
+# Binary try-on responses carry their metadata in X-TryOn-* headers; 429s carry Retry-After
+EXPOSED_HEADERS = [
+    "X-TryOn-Confidence",
+    "X-TryOn-Request-Id",
+    "X-TryOn-Cached",
+    "X-TryOn-Recommendations-Status",
+    "X-TryOn-User-Id",
+    "X-TryOn-Backend",
+    "Retry-After",
+    "Idempotent-Replayed",
+]
+CORS(app, expose_headers=EXPOSED_HEADERS)
+# Behind TRYON_PROXY_HOPS reverse proxies, remote_addr is the address they saw
+if tryon_api.PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=tryon_api.PROXY_HOPS)
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -39,6 +55,9 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
 
+# Register try-on API blueprint (after config: it stores its cache in UPLOAD_FOLDER)
+app.register_blueprint(tryon_bp)
+
 # ============================================
 # ROUTES
 # ============================================
@@ -49,9 +68,15 @@ def health():
     return jsonify({
         'status': 'healthy',
         'service': 'Virtual Dressing Room (Gemini Powered)',
-        'timestamp': datetime.now().isoformat()
+        'timestamp': datetime.now().isoformat(),
+        'startup': startup.report()
     })
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text format: per-stage latency histograms and pipeline counters"""
+    return Response(tryon_metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
     return jsonify({
@@ -79,4 +104,5 @@ def internal_error(error):
 if __name__ == '__main__':
     port = int(os.environ.get('FLASK_PORT', 5000))
     logger.info(f"Starting Gemini-Powered Backend on port {port}...")
+    tryon_api.warm()
     app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
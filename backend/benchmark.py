@@ -0,0 +1,400 @@
+"""
+Offline Try-On Benchmark
+Runs the Flask app in-process against a fake IDM-VTON Space and a fake
+Gemini (see fake_space.py), then reports throughput and p50/p95/p99 latency
+of /api/tryon/process per concurrency level and image size, plus
+microbenchmarks of the image/parsing helpers. Results are written as JSON
+so runs can be compared.
+
+    python benchmark.py
+    python benchmark.py --concurrency 1 8 32 --sizes 768x1024 3024x4032 --requests 64
+    python benchmark.py --space-latency 2 --space-error-rate 0.05 --env TRYON_HTTP_POOL_SIZE=32
+    python benchmark.py --compare benchmark_results/benchmark-20250101-120000.json
+    python benchmark.py --server async --concurrency 64 256 --sizes 768x1024
+
+Client, server and fake Space share one process (and one GIL), so absolute
+numbers are pessimistic; compare runs made on the same machine.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import base64
+import timeit
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import requests
+from PIL import Image
+
+from fake_space import FakeGeminiModel, FakeSpace
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CLOTHING_ITEM = {"item_type": "shirt", "color": "blue", "pattern": "solid",
+                 "size": "M", "fit": "regular", "style": "casual"}
+BODY_MEASUREMENTS = {"height": 170, "chest": 95, "waist": 80, "hips": 100, "shoulder_width": 40}
+
+
+# =====================================================
+# PAYLOADS
+# =====================================================
+
+def parse_size(text: str) -> Tuple[int, int]:
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def synthetic_photo(size: Tuple[int, int], seed: int = 0, garment: bool = False) -> bytes:
+    """
+    A JPEG with photo-like entropy (gradient background, a figure or a
+    garment shape, sensor noise), so encoded sizes match real uploads.
+    """
+    width, height = size
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    image = np.empty((height, width, 3), np.float32)
+    image[...] = 235 - 20 * (y / height)[..., None]
+    cx = width / 2
+    if garment:
+        shape = (np.abs(x - cx) < width * 0.3) & (y > height * 0.1) & (y < height * 0.9)
+        image[shape] = (40, 70, 160)
+    else:
+        head = ((x - cx) / (width * 0.08)) ** 2 + ((y - height * 0.12) / (height * 0.07)) ** 2 < 1
+        body = (np.abs(x - cx) < width * 0.16) & (y > height * 0.19) & (y < height * 0.97)
+        image[head] = (205, 170, 140)
+        image[body] = (90, 90, 100)
+    image += rng.normal(0, 6, image.shape)
+    buffer = io.BytesIO()
+    Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def load_or_make(path: Optional[str], size: Tuple[int, int], garment: bool) -> bytes:
+    """The given photo resized to `size`, or a synthetic one."""
+    if not path:
+        return synthetic_photo(size, seed=int(garment), garment=garment)
+    with Image.open(path) as img:
+        buffer = io.BytesIO()
+        img.convert("RGB").resize(size, Image.Resampling.LANCZOS).save(buffer, format="JPEG", quality=90)
+        return buffer.getvalue()
+
+
+class RequestBodies:
+    """
+    JSON bodies for one image size, built by string concatenation around
+    pre-encoded base64 so the client spends almost nothing per request.
+    Each body has a distinct colour, so no two requests share a cache key,
+    a single-flight slot or a Gemini cache entry.
+    """
+
+    def __init__(self, person: bytes, garment: bytes, repeat: bool = False):
+        self.person_bytes = len(person)
+        self._images = (f'{{"person_image": "{base64.b64encode(person).decode()}", '
+                        f'"clothing_image": "{base64.b64encode(garment).decode()}", ')
+        self.repeat = repeat
+
+    def body(self, n: int) -> bytes:
+        item = dict(CLOTHING_ITEM, color=CLOTHING_ITEM["color"] if self.repeat else f"blue-{n}")
+        tail = json.dumps({"clothing_item": item, "body_measurements": BODY_MEASUREMENTS})[1:]
+        return (self._images + tail).encode()
+
+
+# =====================================================
+# LOAD GENERATION
+# =====================================================
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """Nearest-rank percentile."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(np.ceil(p / 100 * len(ordered))) - 1))]
+
+
+def stage_totals() -> Dict[str, Tuple[float, int]]:
+    import tryon_metrics
+    totals = {}
+    for key, (total, count) in tryon_metrics.STAGE_SECONDS.totals().items():
+        name = dict(key)["stage"]
+        old_total, old_count = totals.get(name, (0.0, 0))
+        totals[name] = (old_total + total, old_count + count)
+    return totals
+
+
+def stage_means_ms(before, after) -> Dict[str, float]:
+    """Mean milliseconds per stage between two stage_totals() snapshots."""
+    means = {}
+    for name, (total, count) in after.items():
+        old_total, old_count = before.get(name, (0.0, 0))
+        if count > old_count:
+            means[name] = round((total - old_total) / (count - old_count) * 1000, 3)
+    return dict(sorted(means.items()))
+
+
+def run_scenario(url: str, bodies: RequestBodies, concurrency: int, total: int,
+                 warmup: int, offset: int) -> Dict[str, Any]:
+    """`total` POSTs from `concurrency` closed-loop clients (after `warmup` untimed ones)."""
+    local = threading.local()
+
+    def post(n):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        body = bodies.body(offset + n)
+        started = time.perf_counter()
+        try:
+            resp = session.post(url, data=body, headers={"Content-Type": "application/json"}, timeout=300)
+            status, size = str(resp.status_code), len(resp.content)
+            # A failed try-on is still HTTP 200 (original image, confidence 0)
+            if status == "200" and not resp.json().get("confidence"):
+                status = "200_failed"
+        except requests.RequestException:
+            status, size = "connection_error", 0
+        return time.perf_counter() - started, status, size
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(post, range(-warmup, 0)))
+        before = stage_totals()
+        started = time.perf_counter()
+        samples = list(pool.map(post, range(total)))
+        wall = time.perf_counter() - started
+        after = stage_totals()
+
+    ok = [latency for latency, status, _ in samples if status == "200"]
+    statuses: Dict[str, int] = {}
+    for _, status, _ in samples:
+        statuses[status] = statuses.get(status, 0) + 1
+    ms = lambda v: None if v is None else round(v * 1000, 2)
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(ok) / wall, 3) if wall else None,
+        "error_rate": round(1 - len(ok) / total, 4) if total else 0,
+        "statuses": statuses,
+        "latency_ms": {
+            "mean": ms(sum(ok) / len(ok)) if ok else None,
+            "p50": ms(percentile(ok, 50)),
+            "p95": ms(percentile(ok, 95)),
+            "p99": ms(percentile(ok, 99)),
+            "max": ms(max(ok)) if ok else None,
+        },
+        "response_bytes_mean": int(np.mean([s for _, st, s in samples if st == "200"])) if ok else 0,
+        "stage_mean_ms": stage_means_ms(before, after),
+    }
+
+
+# =====================================================
+# MICROBENCHMARKS
+# =====================================================
+
+def time_call(fn, min_seconds: float = 0.2, repeat: int = 5) -> Dict[str, float]:
+    """Per-call microseconds: best and median of `repeat` timed batches."""
+    timer = timeit.Timer(fn)
+    number = 1
+    while timer.timeit(number) < min_seconds / repeat and number < 1_000_000:
+        number *= 2
+    runs = [t / number * 1e6 for t in timer.repeat(repeat, number)]
+    return {"best_us": round(min(runs), 2), "median_us": round(float(np.median(runs)), 2), "calls": number}
+
+
+def run_micro(sizes: List[Tuple[int, int]], person_path: Optional[str] = None) -> List[Dict[str, Any]]:
+    from tryon_api import parse_clothing_item, validate_image
+    from llm_tryon_service import ImageHandle, base64_to_image, image_to_base64
+
+    results = [{"name": "parse_clothing_item", "size": None, **time_call(lambda: parse_clothing_item(CLOTHING_ITEM))}]
+    for size in sizes:
+        jpeg = load_or_make(person_path, size, garment=False)
+        jpeg_b64 = base64.b64encode(jpeg).decode()
+        array = ImageHandle.from_bytes(jpeg).array
+        png_b64 = image_to_base64(array)
+        label = f"{size[0]}x{size[1]}"
+        cases = [
+            ("image_to_base64", lambda: image_to_base64(array)),
+            ("image_to_base64[png_passthrough]", lambda: image_to_base64(ImageHandle.from_base64(png_b64))),
+            ("base64_to_image[jpeg]", lambda: base64_to_image(jpeg_b64)),
+            ("base64_to_image[png]", lambda: base64_to_image(png_b64)),
+            ("validate_image", lambda: validate_image(jpeg_b64)),
+            ("validate_image[data_uri]", lambda: validate_image("data:image/jpeg;base64," + jpeg_b64)),
+        ]
+        for name, fn in cases:
+            results.append({"name": name, "size": label, **time_call(fn)})
+            print(f"  {name:<34} {label:>10} {results[-1]['median_us'] / 1000:9.2f} ms")
+    return results
+
+
+# =====================================================
+# REPORTING
+# =====================================================
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def compare(previous: Dict[str, Any], current: Dict[str, Any]):
+    """Print throughput/p95 and micro deltas against an earlier result file."""
+    def pct(new, old):
+        return f"{(new - old) / old * 100:+7.1f}%" if new is not None and old else "     n/a"
+
+    old_http = {(r["size"], r["concurrency"]): r for r in previous.get("http", [])}
+    print("\nvs", previous.get("meta", {}).get("started_at"), previous.get("meta", {}).get("git_commit"))
+    for row in current.get("http", []):
+        old = old_http.get((row["size"], row["concurrency"]))
+        if old:
+            print(f"  {row['size']:>10} c={row['concurrency']:<3} "
+                  f"rps {pct(row['throughput_rps'], old['throughput_rps'])}  "
+                  f"p95 {pct(row['latency_ms']['p95'], old['latency_ms']['p95'])}")
+    old_micro = {(r["name"], r["size"]): r for r in previous.get("micro", [])}
+    for row in current.get("micro", []):
+        old = old_micro.get((row["name"], row["size"]))
+        if old:
+            print(f"  {row['name']:<34} {row['size'] or '':>10} {pct(row['median_us'], old['median_us'])}")
+
+
+def serve_async() -> Tuple[int, Any]:
+    """Start tryon_async on its own event loop thread; returns (port, stop)."""
+    import asyncio
+    from aiohttp import web
+    import tryon_async
+
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(tryon_async.create_app())
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = runner.addresses[0][1]
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+    return port, stop
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the try-on API")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--sizes", nargs="+", default=["768x1024", "1536x2048", "3024x4032"],
+                        help="person/garment image sizes (WxH)")
+    parser.add_argument("--requests", type=int, default=48, help="timed requests per scenario")
+    parser.add_argument("--warmup", type=int, default=4, help="untimed requests per scenario")
+    parser.add_argument("--repeat-images", action="store_true",
+                        help="send identical requests (measures cache hits instead of the Space path)")
+    parser.add_argument("--person", help="person photo to use instead of a synthetic one")
+    parser.add_argument("--garment", help="garment photo to use instead of a synthetic one")
+    parser.add_argument("--space-latency", type=float, default=0.25, help="median fake Space seconds")
+    parser.add_argument("--space-jitter", type=float, default=0.25, help="log-normal sigma of Space latency")
+    parser.add_argument("--space-error-rate", type=float, default=0.0)
+    parser.add_argument("--gemini-latency", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the app (repeatable)")
+    parser.add_argument("--server", choices=["threaded", "async"], default="threaded",
+                        help="Flask on a threaded WSGI server, or tryon_async on aiohttp")
+    parser.add_argument("--skip-http", action="store_true")
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--output", help="result file (default: benchmark_results/benchmark-<time>.json)")
+    parser.add_argument("--compare", help="earlier result file to diff against")
+    args = parser.parse_args(argv)
+
+    started_at = datetime.now()
+    output = os.path.abspath(args.output or os.path.join(
+        BACKEND_DIR, "benchmark_results", f"benchmark-{started_at:%Y%m%d-%H%M%S}.json"))
+    sizes = [parse_size(s) for s in args.sizes]
+
+    # Everything the app reads at import time must be set before importing it
+    space = FakeSpace(args.space_latency, args.space_jitter, args.space_error_rate, seed=args.seed).start()
+    os.environ["TRYON_BACKENDS"] = f"space:{space.url}"
+    # Every request comes from one anonymous client: measure the pipeline, not
+    # admission control (pass --env to benchmark that instead)
+    for key, value in (("TRYON_MAX_IN_FLIGHT", "1024"), ("TRYON_ADMISSION_QUEUE", "1024"),
+                       ("TRYON_USER_RATE_PER_MIN", "0"), ("TRYON_ANON_RATE_PER_MIN", "0")):
+        os.environ.setdefault(key, value)
+    os.environ.pop("GEMINI_API_KEY", None)
+    for pair in args.env:
+        key, _, value = pair.partition("=")
+        os.environ[key] = value
+    # Keep the result cache and uploads out of the working tree
+    workdir = tempfile.mkdtemp(prefix="tryon-bench-")
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND_DIR)
+
+    from werkzeug.serving import make_server
+    import app as app_module
+    import tryon_api
+    for name in ("", "werkzeug"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    tryon_api.llm_engine.model = FakeGeminiModel(args.gemini_latency)
+
+    results: Dict[str, Any] = {
+        "meta": {
+            "started_at": started_at.isoformat(timespec="seconds"),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "http": [],
+        "micro": [],
+    }
+
+    if not args.skip_http:
+        if args.server == "async":
+            port, stop_server = serve_async()
+        else:
+            server = make_server("127.0.0.1", 0, app_module.app, threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            port, stop_server = server.server_port, server.shutdown
+        url = f"http://127.0.0.1:{port}/api/tryon/process"
+        print(f"App on {url}, fake Space on {space.url}")
+        offset = 0
+        for size in sizes:
+            bodies = RequestBodies(load_or_make(args.person, size, garment=False),
+                                   load_or_make(args.garment, size, garment=True),
+                                   repeat=args.repeat_images)
+            for concurrency in args.concurrency:
+                row = run_scenario(url, bodies, concurrency, args.requests, args.warmup, offset)
+                offset += args.requests + args.warmup
+                row = {"size": f"{size[0]}x{size[1]}", "person_bytes": bodies.person_bytes, **row}
+                results["http"].append(row)
+                lat = row["latency_ms"]
+                print(f"  {row['size']:>10} c={concurrency:<3} {row['throughput_rps']:7.2f} req/s  "
+                      f"p50 {lat['p50']} ms  p95 {lat['p95']} ms  p99 {lat['p99']} ms  "
+                      f"errors {row['error_rate']:.1%}")
+        stop_server()
+        results["space"] = {"predictions": space.predictions, "failures": space.failures}
+
+    if not args.skip_micro:
+        print("Microbenchmarks (median per call)")
+        results["micro"] = run_micro(sizes, args.person)
+
+    space.stop()
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+Circuit Breaker & Adaptive Timeouts
+Fail fast while the upstream Space is down, and size timeouts from the
+latencies actually observed instead of a fixed 120 s.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit is open."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} is unavailable (circuit open, retry in {retry_after:.0f}s)")
+        self.retry_after = retry_after
+
+
+class LatencyTracker:
+    """Rolling window of recent call outcomes, for error rates and percentiles."""
+
+    def __init__(self, window_seconds: float = 120, max_samples: int = 500):
+        self.window_seconds = window_seconds
+        self._samples = deque(maxlen=max_samples)  # (finished_at, latency, ok)
+        self._lock = threading.Lock()
+
+    def record(self, latency: float, ok: bool):
+        with self._lock:
+            self._samples.append((time.time(), latency, ok))
+
+    def _recent(self):
+        cutoff = time.time() - self.window_seconds
+        return [s for s in self._samples if s[0] >= cutoff]
+
+    def counts(self):
+        """(calls, failures) within the window."""
+        with self._lock:
+            recent = self._recent()
+        return len(recent), sum(1 for _, _, ok in recent if not ok)
+
+    def percentile(self, p: float, successes_only: bool = True) -> Optional[float]:
+        with self._lock:
+            latencies = sorted(lat for _, lat, ok in self._recent() if ok or not successes_only)
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, int(round(p / 100 * (len(latencies) - 1))))
+        return latencies[index]
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+
+
+class CircuitBreaker:
+    """
+    closed    → calls flow; opens when the rolling error rate (slow calls count
+                as errors) crosses the threshold over at least `min_calls` calls.
+    open      → calls are rejected immediately for `open_seconds`.
+    half_open → a few probe calls go through; success closes, failure reopens.
+    """
+
+    def __init__(self, name: str = "upstream", failure_rate: float = 0.5, min_calls: int = 5,
+                 slow_call_seconds: Optional[float] = None, open_seconds: float = 30,
+                 half_open_calls: int = 1, window_seconds: float = 120):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.tracker = LatencyTracker(window_seconds=window_seconds)
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    @classmethod
+    def from_env(cls, name: str = "upstream") -> "CircuitBreaker":
+        slow = os.getenv("TRYON_BREAKER_SLOW_SECONDS")
+        return cls(
+            name=name,
+            failure_rate=float(os.getenv("TRYON_BREAKER_FAILURE_RATE", 0.5)),
+            min_calls=int(os.getenv("TRYON_BREAKER_MIN_CALLS", 5)),
+            slow_call_seconds=float(slow) if slow else None,
+            open_seconds=float(os.getenv("TRYON_BREAKER_OPEN_SECONDS", 30)),
+            window_seconds=float(os.getenv("TRYON_BREAKER_WINDOW_SECONDS", 120)),
+        )
+
+    def retry_after(self) -> float:
+        return max(0.0, self._opened_at + self.open_seconds - time.time())
+
+    def _admit(self) -> Optional[bool]:
+        """None if the call is rejected, else whether it took a half-open probe slot."""
+        with self._lock:
+            if self.state == OPEN:
+                if time.time() - self._opened_at < self.open_seconds:
+                    self.rejected += 1
+                    return None
+                self.state = HALF_OPEN
+                self._probes = 0
+                logger.info(f"Circuit {self.name}: half-open, probing upstream")
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    self.rejected += 1
+                    return None
+                self._probes += 1
+                return True
+            return False
+
+    def allow(self) -> bool:
+        return self._admit() is not None
+
+    def rejecting(self) -> bool:
+        """
+        Cheap peek (does not consume a probe slot): open and not yet due for
+        a probe, or half-open with every probe slot taken.
+        """
+        if self.state == HALF_OPEN:
+            return self._probes >= self.half_open_calls
+        return self.state == OPEN and time.time() - self._opened_at < self.open_seconds
+
+    def check(self) -> bool:
+        """allow() that raises CircuitOpenError instead of returning False. True for a probe."""
+        probe = self._admit()
+        if probe is None:
+            raise CircuitOpenError(self.name, self.retry_after())
+        return probe
+
+    def release_probe(self):
+        """Give back the slot of a probe that was abandoned: no success or failure to record."""
+        with self._lock:
+            if self.state == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def record_success(self, latency: float):
+        slow = self.slow_call_seconds is not None and latency > self.slow_call_seconds
+        self.tracker.record(latency, ok=not slow)
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if slow:
+                    self._trip("slow probe")
+                else:
+                    self.state = CLOSED
+                    self.tracker.reset()
+                    logger.info(f"Circuit {self.name}: closed")
+            elif slow:
+                self._evaluate()
+
+    def record_failure(self, latency: float):
+        self.tracker.record(latency, ok=False)
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._trip("failed probe")
+            else:
+                self._evaluate()
+
+    def _evaluate(self):
+        calls, failures = self.tracker.counts()
+        if self.state == CLOSED and calls >= self.min_calls and failures / calls >= self.failure_rate:
+            self._trip(f"{failures}/{calls} calls failed")
+
+    def _trip(self, reason: str):
+        self.state = OPEN
+        self._opened_at = time.time()
+        logger.warning(f"Circuit {self.name}: open for {self.open_seconds:.0f}s ({reason})")
+
+    def stats(self) -> Dict[str, Any]:
+        calls, failures = self.tracker.counts()
+        return {
+            "state": self.state,
+            "calls": calls,
+            "failures": failures,
+            "rejected": self.rejected,
+            "retry_after": round(self.retry_after(), 1) if self.state == OPEN else 0,
+        }
+
+
+class AdaptiveTimeout:
+    """
+    Timeout = observed p-th percentile latency × multiplier, clamped to
+    [minimum, maximum]. Until enough samples exist the maximum is used.
+    """
+
+    def __init__(self, tracker: LatencyTracker, minimum: float = 20, maximum: float = 120,
+                 percentile: float = 99, multiplier: float = 1.5, min_samples: int = 10):
+        self.tracker = tracker
+        self.minimum = minimum
+        self.maximum = maximum
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+
+    def current(self) -> float:
+        calls, failures = self.tracker.counts()
+        if calls - failures < self.min_samples:
+            return self.maximum
+        observed = self.tracker.percentile(self.percentile)
+        return max(self.minimum, min(self.maximum, observed * self.multiplier))
@@ -0,0 +1,208 @@
+"""
+Local Stand-ins for the IDM-VTON Space and Gemini
+A Gradio-queue-protocol server (/config, /upload, /queue/join, /queue/data,
+/file=) with configurable latency and error rate, and a fake Gemini model.
+Used by benchmark.py; no network access needed.
+
+    python fake_space.py --port 7860 --latency 2.0 --error-rate 0.05
+"""
+
+import json
+import time
+import asyncio
+import uuid
+import random
+import argparse
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Same endpoint shape as yisol/IDM-VTON: editor + garment + description + options
+SPACE_CONFIG = {
+    "protocol": "sse_v3",
+    "components": [
+        {"id": 1, "type": "imageeditor", "props": {}},
+        {"id": 2, "type": "image", "props": {}},
+        {"id": 3, "type": "textbox", "props": {"value": ""}},
+        {"id": 4, "type": "checkbox", "props": {"value": True}},
+        {"id": 5, "type": "checkbox", "props": {"value": False}},
+        {"id": 6, "type": "number", "props": {"value": 30}},
+        {"id": 7, "type": "number", "props": {"value": 42}},
+        {"id": 8, "type": "image", "props": {}},
+        {"id": 9, "type": "image", "props": {}},
+    ],
+    "dependencies": [{
+        "id": 0, "targets": [[10, "click"]], "inputs": [1, 2, 3, 4, 5, 6, 7],
+        "outputs": [8, 9], "api_name": "tryon",
+    }],
+}
+
+
+class FakeSpace:
+    """
+    In-process fake Space. Latency is log-normal around `latency` seconds
+    (spread `jitter`); `error_rate` of predictions fail. The result image is
+    the uploaded person image, so payload sizes are realistic.
+    """
+
+    def __init__(self, latency: float = 1.0, jitter: float = 0.25, error_rate: float = 0.0,
+                 host: str = "127.0.0.1", port: int = 0, seed: int = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.files = {}
+        self.sessions = {}
+        self.predictions = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeSpace":
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _sample(self):
+        """(delay seconds, fails?) for one prediction."""
+        with self._lock:
+            delay = self.latency * self.random.lognormvariate(0, self.jitter) if self.latency else 0.0
+            fails = self.random.random() < self.error_rate
+            self.predictions += 1
+            self.failures += fails
+        return delay, fails
+
+    def _handler(self):
+        space = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, code, body, content_type="application/json"):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/config":
+                    return self._send(200, SPACE_CONFIG)
+                if url.path.startswith("/file="):
+                    data = space.files.pop(url.path[len("/file="):], None)
+                    return self._send(200, data, "image/jpeg") if data else self._send(404, {"detail": "Not Found"})
+                if url.path == "/queue/data":
+                    return self._stream(parse_qs(url.query).get("session_hash", [""])[0])
+                self._send(404, {"detail": "Not Found"})
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if url.path == "/upload":
+                    message = BytesParser(policy=HTTP).parsebytes(
+                        f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body
+                    )
+                    paths = []
+                    for part in message.iter_parts():
+                        path = f"/tmp/gradio/{uuid.uuid4().hex}/{part.get_filename() or 'upload'}"
+                        space.files[path] = part.get_payload(decode=True)
+                        paths.append(path)
+                    return self._send(200, paths)
+                if url.path == "/queue/join":
+                    payload = json.loads(body)
+                    event_id = uuid.uuid4().hex
+                    space.sessions[payload["session_hash"]] = (event_id, payload["data"])
+                    return self._send(200, {"event_id": event_id})
+                self._send(404, {"detail": "Not Found"})
+
+            def _stream(self, session_hash):
+                event_id, data = space.sessions.pop(session_hash, (None, None))
+                if event_id is None:
+                    return self._send(404, {"detail": "Session not found"})
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+
+                def emit(msg):
+                    self.wfile.write(f"data: {json.dumps(msg)}\n\n".encode())
+                    self.wfile.flush()
+
+                # Uploads are single-use; results are dropped once downloaded
+                person = space.files.pop(data[0]["background"]["path"], b"")
+                space.files.pop(data[1]["path"], None)
+                delay, fails = space._sample()
+                emit({"msg": "estimation", "event_id": event_id, "rank": 0, "queue_size": 1, "rank_eta": delay})
+                emit({"msg": "process_starts", "event_id": event_id, "eta": delay})
+                time.sleep(delay)
+                if fails:
+                    emit({"msg": "process_completed", "event_id": event_id, "success": False,
+                          "output": {"error": "CUDA out of memory (simulated)"}})
+                else:
+                    out_path = f"/tmp/gradio/{uuid.uuid4().hex}/result.jpg"
+                    space.files[out_path] = person
+                    emit({"msg": "process_completed", "event_id": event_id, "success": True,
+                          "output": {"data": [{"path": out_path, "url": None}, {"path": out_path}]}})
+                emit({"msg": "close_stream"})
+                self.close_connection = True
+
+        return Handler
+
+
+class FakeGeminiResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeGeminiModel:
+    """Drop-in for genai.GenerativeModel: fixed latency, canned recommendations."""
+
+    def __init__(self, latency: float = 0.5):
+        self.latency = latency
+        self.calls = 0
+
+    TEXT = "- Pair it with dark denim.\n- Add white sneakers.\n- Layer a light jacket on top."
+
+    def generate_content(self, prompt, request_options=None):
+        self.calls += 1
+        time.sleep(self.latency)
+        return FakeGeminiResponse(self.TEXT)
+
+    async def generate_content_async(self, prompt, request_options=None):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return FakeGeminiResponse(self.TEXT)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake IDM-VTON Space")
+    parser.add_argument("--port", type=int, default=7860)
+    parser.add_argument("--latency", type=float, default=1.0, help="median prediction seconds")
+    parser.add_argument("--jitter", type=float, default=0.25, help="log-normal sigma")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    space = FakeSpace(args.latency, args.jitter, args.error_rate, port=args.port)
+    print(f"Fake Space on {space.url} (set TRYON_BACKENDS=space:{space.url})")
+    space.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
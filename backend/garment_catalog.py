@@ -0,0 +1,299 @@
+"""
+Garment Catalog
+Shop garments ingested once (normalized to the model resolution, stored on
+disk with their ClothingItem fields) and referenced by `clothing_id` in
+try-on requests instead of being re-uploaded every time.
+
+CLI:
+    python garment_catalog.py import images/ [--manifest garments.csv] [--item-type shirt]
+    python garment_catalog.py list
+    python garment_catalog.py remove <clothing_id>
+"""
+
+import os
+import re
+import csv
+import json
+import time
+import hashlib
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from tryon_cache import TTLCache
+from llm_tryon_service import ImageHandle, fit_to_resolution
+
+logger = logging.getLogger(__name__)
+
+CLOTHING_FIELDS = ("item_type", "color", "pattern", "size", "fit", "style")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+
+class CatalogError(ValueError):
+    """Bad catalog input (unknown id, invalid id, unreadable image)."""
+
+
+class CatalogFull(CatalogError):
+    """Storing the garment would take the catalog over its disk budget."""
+
+
+@dataclass
+class GarmentEntry:
+    clothing_id: str
+    clothing_item: Dict[str, str]
+    name: str = ""
+    filename: str = ""
+    size: Tuple[int, int] = (0, 0)
+    bytes: int = 0
+    source_sha256: str = ""
+    created_at: float = field(default_factory=time.time)
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = asdict(self)
+        data.pop("filename")
+        return data
+
+
+class GarmentCatalog:
+    """
+    Disk-backed garment store: <root>/index.json plus one normalized image
+    per garment under <root>/images/. The whole index lives in memory; image
+    handles are kept in a byte-bounded LRU so hot garments are never re-read
+    (and their memoized encodings are shared across requests). Stored images
+    are capped at `max_disk_bytes` in total.
+    """
+
+    def __init__(self, model_size=(768, 1024), fmt: str = "JPEG", quality: int = 92,
+                 max_memory_bytes: int = 64 * 1024 * 1024, max_disk_bytes: int = 1024 * 1024 * 1024,
+                 root: Optional[str] = None):
+        self.model_size = model_size
+        self.format = fmt.upper()
+        self.quality = quality
+        self.max_disk_bytes = max_disk_bytes
+        self.root: Optional[str] = None
+        self._index: Dict[str, GarmentEntry] = {}
+        self._disk_bytes = 0
+        self._images = TTLCache(max_entries=100000, max_bytes=max_memory_bytes)
+        self._lock = threading.Lock()
+        if root:
+            self.attach(root)
+
+    @classmethod
+    def from_env(cls, root: Optional[str] = None) -> "GarmentCatalog":
+        width, height = os.getenv("TRYON_MODEL_SIZE", "768x1024").lower().split("x")
+        return cls(
+            model_size=(int(width), int(height)),
+            fmt=os.getenv("TRYON_UPLOAD_FORMAT", "JPEG"),
+            quality=int(os.getenv("TRYON_UPLOAD_QUALITY", 92)),
+            max_memory_bytes=int(float(os.getenv("TRYON_CATALOG_MEMORY_MB", 64)) * 1024 * 1024),
+            max_disk_bytes=int(float(os.getenv("TRYON_CATALOG_DISK_MB", 1024)) * 1024 * 1024),
+            root=root,
+        )
+
+    def attach(self, root: str):
+        """Load (or create) the catalog stored under `root`."""
+        os.makedirs(os.path.join(root, "images"), exist_ok=True)
+        index = {}
+        path = os.path.join(root, "index.json")
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for item in json.load(f):
+                    item["size"] = tuple(item.get("size", (0, 0)))
+                    entry = GarmentEntry(**item)
+                    index[entry.clothing_id] = entry
+        with self._lock:
+            self.root = root
+            self._index = index
+            self._disk_bytes = sum(entry.bytes for entry in index.values())
+            self._images.clear()
+        logger.info(f"Garment catalog: {len(index)} garments in {root}")
+
+    # -------- lookups --------
+
+    def get(self, clothing_id: str) -> Optional[GarmentEntry]:
+        return self._index.get(clothing_id)
+
+    def image(self, clothing_id: str) -> Tuple[GarmentEntry, ImageHandle]:
+        """Entry and its normalized image. Raises CatalogError for unknown ids."""
+        entry = self._index.get(clothing_id)
+        if entry is None:
+            raise CatalogError(f"Unknown clothing_id: {clothing_id}")
+        handle = self._images.get(clothing_id)
+        if handle is None:
+            with open(os.path.join(self.root, "images", entry.filename), "rb") as f:
+                handle = ImageHandle.from_bytes(f.read())
+            self._images.set(clothing_id, handle, size=entry.bytes)
+        return entry, handle
+
+    def list(self) -> List[GarmentEntry]:
+        return sorted(self._index.values(), key=lambda e: e.clothing_id)
+
+    def __len__(self):
+        return len(self._index)
+
+    # -------- ingestion --------
+
+    def add(self, raw: bytes, clothing_item: Optional[Dict[str, Any]] = None,
+            clothing_id: Optional[str] = None, name: str = "", save: bool = True) -> GarmentEntry:
+        """
+        Normalize and store one garment. Without an id, one is derived from
+        the image content, so re-importing the same file is idempotent.
+        Raises CatalogFull when it would not fit in `max_disk_bytes`.
+        """
+        if self.root is None:
+            raise CatalogError("Garment catalog has no storage attached")
+        source_sha = hashlib.sha256(raw).hexdigest()
+        clothing_id = clothing_id or source_sha[:16]
+        if not isinstance(clothing_id, str) or not _ID_PATTERN.match(clothing_id):
+            raise CatalogError(f"Invalid clothing_id: {clothing_id!r}")
+        if clothing_item is not None and not isinstance(clothing_item, dict):
+            raise CatalogError("clothing_item must be an object")
+        try:
+            normalized = fit_to_resolution(ImageHandle.from_bytes(raw), self.model_size,
+                                           self.format, self.quality)
+        except Exception as e:
+            raise CatalogError(f"Unreadable garment image: {e}")
+
+        data = normalized.encode()
+        ext = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp"}.get(self.format, self.format.lower())
+        entry = GarmentEntry(
+            clothing_id=clothing_id,
+            clothing_item={k: str(v) for k, v in (clothing_item or {}).items() if k in CLOTHING_FIELDS},
+            name=name or clothing_id,
+            filename=f"{clothing_id}.{ext}",
+            size=normalized.size,
+            bytes=len(data),
+            source_sha256=source_sha,
+        )
+        path = os.path.join(self.root, "images", entry.filename)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with self._lock:
+            # Replacing a garment frees its old image
+            replaced = self._index.get(clothing_id)
+            disk_bytes = self._disk_bytes - (replaced.bytes if replaced else 0) + entry.bytes
+            if disk_bytes > self.max_disk_bytes:
+                raise CatalogFull(f"Garment catalog is full ({self.max_disk_bytes // (1024 * 1024)} MB)")
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            self._index[clothing_id] = entry
+            self._disk_bytes = disk_bytes
+        self._images.set(clothing_id, normalized, size=entry.bytes)
+        if save:
+            self.save()
+        return entry
+
+    def add_many(self, items: Iterable[Tuple[bytes, Dict[str, Any], Optional[str], str]],
+                 workers: int = 4) -> List[GarmentEntry]:
+        """Bulk ingest (raw, clothing_item, clothing_id, name) tuples in parallel; saves once."""
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            entries = list(pool.map(lambda item: self.add(*item, save=False), items))
+        self.save()
+        return entries
+
+    def remove(self, clothing_id: str) -> bool:
+        with self._lock:
+            entry = self._index.pop(clothing_id, None)
+            if entry is not None:
+                self._disk_bytes -= entry.bytes
+        if entry is None:
+            return False
+        self._images.pop(clothing_id)
+        try:
+            os.remove(os.path.join(self.root, "images", entry.filename))
+        except OSError:
+            pass
+        self.save()
+        return True
+
+    def save(self):
+        """Write index.json atomically."""
+        with self._lock:
+            items = [asdict(e) for e in self._index.values()]
+        path = os.path.join(self.root, "index.json")
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(items, f, indent=1)
+        os.replace(tmp, path)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "garments": len(self._index),
+            "disk": {"bytes": self._disk_bytes, "max_bytes": self.max_disk_bytes},
+            "memory": self._images.stats(),
+        }
+
+
+# =====================================================
+# CLI
+# =====================================================
+
+def _read_manifest(path: str) -> Dict[str, Dict[str, str]]:
+    """file name -> row, from a CSV (header row) or JSON list manifest."""
+    with open(path, "r", encoding="utf-8") as f:
+        rows = json.load(f) if path.endswith(".json") else list(csv.DictReader(f))
+    return {os.path.basename(row["file"]): row for row in rows}
+
+
+def _collect_images(paths: List[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, name) for name in sorted(os.listdir(path))
+                if name.lower().endswith(IMAGE_EXTENSIONS)
+            )
+        else:
+            files.append(path)
+    return files
+
+
+def main(argv=None):
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Manage the try-on garment catalog")
+    parser.add_argument("--catalog", default=os.path.join(os.getenv("UPLOAD_FOLDER", "uploads"), "garment_catalog"),
+                        help="catalog directory (default: uploads/garment_catalog)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    imp = sub.add_parser("import", help="import garment images")
+    imp.add_argument("paths", nargs="+", help="image files or directories")
+    imp.add_argument("--manifest", help="CSV/JSON with columns file, clothing_id, name, item_type, color, ...")
+    imp.add_argument("--item-type", default="shirt", help="item_type for images without a manifest row")
+    imp.add_argument("--workers", type=int, default=4)
+
+    sub.add_parser("list", help="list garments")
+    rm = sub.add_parser("remove", help="remove a garment")
+    rm.add_argument("clothing_id")
+
+    args = parser.parse_args(argv)
+    catalog = GarmentCatalog.from_env(root=args.catalog)
+
+    if args.command == "import":
+        manifest = _read_manifest(args.manifest) if args.manifest else {}
+        items = []
+        for path in _collect_images(args.paths):
+            row = manifest.get(os.path.basename(path), {})
+            with open(path, "rb") as f:
+                raw = f.read()
+            clothing_item = {k: row[k] for k in CLOTHING_FIELDS if row.get(k)}
+            clothing_item.setdefault("item_type", args.item_type)
+            clothing_id = row.get("clothing_id") or os.path.splitext(os.path.basename(path))[0]
+            items.append((raw, clothing_item, clothing_id, row.get("name", "")))
+        started = time.time()
+        entries = catalog.add_many(items, workers=args.workers)
+        print(f"Imported {len(entries)} garments in {time.time() - started:.1f}s into {args.catalog}")
+    elif args.command == "list":
+        for entry in catalog.list():
+            print(f"{entry.clothing_id}\t{entry.name}\t{json.dumps(entry.clothing_item)}")
+    elif args.command == "remove":
+        print("Removed" if catalog.remove(args.clothing_id) else "Not found")
+
+
+if __name__ == "__main__":
+    main()
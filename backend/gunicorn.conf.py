@@ -0,0 +1,32 @@
+"""
+Gunicorn settings (picked up automatically from the working directory).
+
+The app module is imported once in the master (preload_app) together with
+the heavy, fork-safe imports; each worker then builds its engines in
+post_worker_init, before it accepts its first request.
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', os.getenv('FLASK_PORT', 5000))}"
+# One worker by default: jobs, recommendations by request_id, person sessions and
+# Idempotency-Key records live in process memory, so follow-up requests must reach
+# the same process. Scale with threads (or sticky routing) instead.
+workers = int(os.getenv("WEB_CONCURRENCY", 1))
+threads = int(os.getenv("GUNICORN_THREADS", 10))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 300))  # Space calls can take minutes
+# Connections waiting for a free thread; overload beyond admission control stays bounded
+backlog = int(os.getenv("GUNICORN_BACKLOG", 64))
+preload_app = os.getenv("TRYON_PRELOAD", "true").lower() == "true"
+
+
+def when_ready(server):
+    # Master, after the preloaded app import and before any fork
+    if preload_app:
+        import tryon_api
+        tryon_api.preload()
+
+
+def post_worker_init(worker):
+    import tryon_api
+    tryon_api.warm()
@@ -0,0 +1,123 @@
+"""
+Idempotency Keys
+Clients resend POST /api/tryon/process with the same `Idempotency-Key` header
+after a network flap. The first request's outcome is recorded under the key:
+retries while it is still running wait for it, later retries get the stored
+response, and neither starts another upstream job.
+"""
+
+import os
+import time
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, Dict, Optional, Tuple
+
+from tryon_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyMismatch(Exception):
+    """Raised when a key is reused with a different request."""
+
+
+class _Record:
+    def __init__(self, fingerprint: str):
+        self.fingerprint = fingerprint
+        self.future: Future = Future()
+        self.created_at = time.time()
+
+
+class IdempotencyStore:
+    """
+    Key -> fingerprint and outcome of the first request (a Future, so
+    concurrent retries share it). Bounded by key count and payload bytes,
+    expires `ttl` after the first request. Only successful payloads are kept:
+    a request that raised, or whose result was discard()ed, is forgotten, so
+    its retry runs again.
+    """
+
+    def __init__(self, ttl: float = 3600, max_keys: int = 10000, max_bytes: int = 128 * 1024 * 1024):
+        self.ttl = ttl
+        self._records = TTLCache(max_entries=max_keys, max_bytes=max_bytes, ttl=ttl)
+        self._lock = threading.Lock()
+        self.started = 0
+        self.replayed = 0
+        self.mismatched = 0
+
+    @classmethod
+    def from_env(cls) -> "IdempotencyStore":
+        return cls(
+            ttl=float(os.getenv("TRYON_IDEMPOTENCY_TTL", 3600)),
+            max_keys=int(os.getenv("TRYON_IDEMPOTENCY_MAX_KEYS", 10000)),
+            max_bytes=int(float(os.getenv("TRYON_IDEMPOTENCY_MEMORY_MB", 128)) * 1024 * 1024),
+        )
+
+    def completed(self, key: str) -> bool:
+        """A finished outcome is stored (fingerprint not checked yet)."""
+        record = self._records.peek(key)
+        return record is not None and record.future.done()
+
+    def begin(self, key: str, fingerprint: str) -> Tuple[Future, bool]:
+        """
+        (future, owner). The owner runs the request and calls complete()/fail();
+        everyone else waits on the future. Raises IdempotencyMismatch.
+        """
+        with self._lock:
+            record = self._records.get(key)
+            if record is not None:
+                if record.fingerprint != fingerprint:
+                    self.mismatched += 1
+                    raise IdempotencyMismatch("Idempotency-Key was already used with a different request")
+                self.replayed += 1
+                logger.info(f"Idempotent replay: {key[:32]}")
+                return record.future, False
+            record = _Record(fingerprint)
+            self._records.set(key, record, size=len(key))
+            self.started += 1
+            return record.future, True
+
+    def complete(self, key: str, future: Future, payload: Dict[str, Any]):
+        with self._lock:
+            record = self._records.peek(key)
+            if record is not None and record.future is future:
+                # Re-store with the payload's size so the byte bound covers it,
+                # keeping the expiry of the first request
+                size = len(key) + sum(len(v) for v in payload.values() if isinstance(v, str))
+                self._records.set(key, record, size=size, stored_at=record.created_at)
+        future.set_result(payload)
+
+    def discard(self, key: str, future: Future, payload: Dict[str, Any]):
+        """Hand a payload not worth keeping (a failed try-on) to current waiters only."""
+        self._forget(key, future)
+        future.set_result(payload)
+
+    def fail(self, key: str, future: Future, error: BaseException):
+        self._forget(key, future)
+        future.set_exception(error)
+
+    def _forget(self, key: str, future: Future):
+        with self._lock:
+            record = self._records.peek(key)
+            if record is not None and record.future is future:
+                self._records.pop(key)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._records.stats(),
+            "ttl": self.ttl,
+            "started": self.started,
+            "replayed": self.replayed,
+            "mismatched": self.mismatched,
+        }
+
+
+def check_key(key: Optional[str]) -> Optional[str]:
+    """Normalize an Idempotency-Key header value. Raises ValueError."""
+    key = (key or "").strip()
+    if len(key) > MAX_KEY_LENGTH:
+        raise ValueError(f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters")
+    return key or None
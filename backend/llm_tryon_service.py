@@ -4,19 +4,29 @@ Uses Hugging Face Inference API (no cv2, no gradio_client)
 """
 
 import os
+import asyncio
 import logging
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageOps
 from io import BytesIO
 import base64
 import tempfile
+import threading
+import time
+import uuid
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
 from dataclasses import dataclass
-from typing import List, Dict, Optional
+from typing import Any, Callable, List, Dict, Optional, Union
 from enum import Enum
-from dotenv import load_dotenv
 
-load_dotenv()
+from tryon_cache import TTLCache
+from singleflight import AsyncSingleFlight, SingleFlight
+from circuit_breaker import CircuitOpenError
+from tryon_backends import BackendRegistry, backends_from_env
+from local_compositor import composite_garment
+import tryon_metrics as metrics
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -55,216 +65,800 @@ class BodyMeasurements:
 
 @dataclass
 class TryOnResult:
-    original_image: np.ndarray
-    result_image: np.ndarray
+    original_image: "ImageHandle"
+    result_image: "ImageHandle"
     confidence: float
     recommendations: List[str]
     fit_analysis: Dict[str, str]
+    request_id: Optional[str] = None
+    recommendations_ready: bool = True
+    backend: Optional[str] = None
+    fallback: bool = False  # produced by a last-resort backend
+
+# =====================================================
+# LAZY IMAGE HANDLE
+# =====================================================
+
+_MIME_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp", "GIF": "image/gif"}
+
+class ImageHandle:
+    """
+    An image that keeps its original encoded bytes, decodes pixels only when
+    `.array` is used, and memoizes every encoding it produces. Forwarding an
+    upload or a Space result unchanged never touches the pixels.
+    """
+
+    def __init__(self, data: Optional[bytes] = None, array: Optional[np.ndarray] = None):
+        if data is None and array is None:
+            raise ValueError("ImageHandle needs encoded bytes or a pixel array")
+        self._array = array
+        self._encoded: Dict[str, bytes] = {}
+        self._b64: Dict[str, str] = {}
+        self._variants: Dict[tuple, "ImageHandle"] = {}
+        self._variant_lock = threading.Lock()
+        self.format: Optional[str] = None
+        self.size = None  # (width, height)
+        if data is not None:
+            # Parses the header only; raises on non-image input
+            with Image.open(BytesIO(data)) as pil:
+                self.format = (pil.format or "").upper() or None
+                self.size = pil.size
+            if self.format:
+                self._encoded[self.format] = data
+            self._original = data
+        else:
+            self._original = None
+            self.size = (array.shape[1], array.shape[0])
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "ImageHandle":
+        return cls(data=data)
+
+    @classmethod
+    def from_base64(cls, b64_data: str) -> "ImageHandle":
+        handle = cls(data=base64.b64decode(b64_data))
+        if handle.format:
+            handle._b64[handle.format] = b64_data
+        return handle
+
+    @classmethod
+    def from_array(cls, array: np.ndarray) -> "ImageHandle":
+        return cls(array=array)
+
+    @property
+    def mime(self) -> str:
+        return _MIME_TYPES.get(self.format or "PNG", "application/octet-stream")
+
+    @property
+    def array(self) -> np.ndarray:
+        """Decoded pixels (decoded once, on first access)."""
+        if self._array is None:
+            self._array = np.array(Image.open(BytesIO(self._original)))
+        return self._array
+
+    def to_pil(self, draft_size=None) -> Image.Image:
+        """
+        Fresh PIL image. With `draft_size`, JPEGs are decoded at the smallest
+        DCT scale (1/2, 1/4, 1/8) that is still at least that big.
+        """
+        if self._original is None:
+            return Image.fromarray(self.array)
+        pil = Image.open(BytesIO(self._original))
+        if draft_size and pil.format == "JPEG":
+            pil.draft("RGB", draft_size)
+        return pil
+
+    def variant(self, key: tuple, factory) -> "ImageHandle":
+        """
+        Memoized derived image (e.g. the model-resolution upload). Threads
+        sharing a handle wait for the first to build it instead of repeating it.
+        """
+        with self._variant_lock:
+            if key not in self._variants:
+                self._variants[key] = factory(self)
+            return self._variants[key]
+
+    def render(self, fmt: Optional[str] = None, quality: Optional[int] = None,
+               max_dimension: Optional[int] = None, default_quality: Optional[int] = None) -> "ImageHandle":
+        """
+        This image in `fmt` at `quality`, downscaled to fit `max_dimension`.
+        Returns self when nothing would change (same format, no explicit
+        quality), so passing an upstream result through stays free.
+        `default_quality` is used when a lossy re-encode happens anyway.
+        """
+        fmt = (fmt or self.format or "PNG").upper()
+        if fmt == "PNG":
+            quality = default_quality = None
+        too_big = bool(max_dimension) and max(self.size) > max_dimension
+        if fmt == self.format and quality is None and not too_big:
+            return self
+        if quality is None:
+            quality = default_quality
+
+        def make(handle):
+            draft = None
+            if too_big:
+                scale = max_dimension / max(handle.size)
+                draft = (round(handle.size[0] * scale), round(handle.size[1] * scale))
+            pil = handle.to_pil(draft_size=draft)
+            if too_big:
+                pil.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+            if fmt == "JPEG" and pil.mode not in ("RGB", "L"):
+                pil = pil.convert("RGB")
+            buf = BytesIO()
+            params = {"quality": quality} if quality is not None else {}
+            pil.save(buf, format=fmt, **params)
+            return ImageHandle.from_bytes(buf.getvalue())
+
+        return self.variant(("render", fmt, quality, max_dimension if too_big else None), make)
+
+    def __array__(self, dtype=None):
+        return self.array if dtype is None else self.array.astype(dtype)
+
+    def encode(self, fmt: Optional[str] = None) -> bytes:
+        """Encoded bytes in `fmt` (default: the original format, else PNG)."""
+        fmt = (fmt or self.format or "PNG").upper()
+        if fmt not in self._encoded:
+            pil = Image.fromarray(self.array)
+            if fmt == "JPEG" and pil.mode not in ("RGB", "L"):
+                pil = pil.convert("RGB")
+            buf = BytesIO()
+            pil.save(buf, format=fmt)
+            self._encoded[fmt] = buf.getvalue()
+        return self._encoded[fmt]
+
+    def base64(self, fmt: Optional[str] = None) -> str:
+        fmt = (fmt or self.format or "PNG").upper()
+        if fmt not in self._b64:
+            self._b64[fmt] = base64.b64encode(self.encode(fmt)).decode()
+        return self._b64[fmt]
+
+    def data_uri(self, fmt: Optional[str] = None) -> str:
+        fmt = (fmt or self.format or "PNG").upper()
+        return f"data:{_MIME_TYPES.get(fmt, 'image/png')};base64,{self.base64(fmt)}"
+
+
+def fit_to_resolution(handle: ImageHandle, size=(768, 1024), fmt: str = "JPEG",
+                      quality: int = 92, fill=(255, 255, 255)) -> ImageHandle:
+    """
+    Aspect-preserving resize + pad to exactly `size`, encoded as `fmt`.
+    Large JPEGs are draft-decoded, so a 4000x3000 photo never decodes at
+    full resolution.
+    """
+    target_w, target_h = size
+    src_w, src_h = handle.size
+    # Draft big enough for either orientation: EXIF may rotate the photo 90°
+    draft_scale = max(min(target_w / src_w, target_h / src_h), min(target_w / src_h, target_h / src_w))
+    pil = handle.to_pil(draft_size=(round(src_w * draft_scale), round(src_h * draft_scale)))
+    pil = ImageOps.exif_transpose(pil)  # phone photos: bake in the EXIF rotation
+
+    scale = min(target_w / pil.width, target_h / pil.height)
+    fit_w, fit_h = max(1, round(pil.width * scale)), max(1, round(pil.height * scale))
+    if pil.mode in ("RGBA", "LA", "PA") or (pil.mode == "P" and "transparency" in pil.info):
+        # Transparent product cut-outs go onto `fill`, not onto black
+        pil = pil.convert("RGBA")
+        pil = Image.alpha_composite(Image.new("RGBA", pil.size, (*fill, 255)), pil)
+    pil = pil.convert("RGB").resize((fit_w, fit_h), Image.Resampling.LANCZOS)
+
+    canvas = Image.new("RGB", (target_w, target_h), fill)
+    canvas.paste(pil, ((target_w - fit_w) // 2, (target_h - fit_h) // 2))
+
+    buf = BytesIO()
+    fmt = fmt.upper()
+    if fmt == "JPEG":
+        canvas.save(buf, format="JPEG", quality=quality, optimize=True, subsampling=0)
+    elif fmt == "WEBP":
+        canvas.save(buf, format="WEBP", quality=quality)
+    else:
+        canvas.save(buf, format=fmt)
+    result = ImageHandle.from_bytes(buf.getvalue())
+    result._array = np.asarray(canvas)
+    return result
+
+
+def garment_description(clothing_item: ClothingItem) -> str:
+    """Short text prompt for the Space, e.g. "black solid shirt"."""
+    parts = (clothing_item.color, clothing_item.pattern, clothing_item.item_type)
+    return " ".join(p for p in (_normalize_attr(v) for v in parts) if p)
+
+
+def as_image_handle(image: Union["ImageHandle", np.ndarray, bytes]) -> ImageHandle:
+    if isinstance(image, ImageHandle):
+        return image
+    if isinstance(image, (bytes, bytearray)):
+        return ImageHandle.from_bytes(bytes(image))
+    return ImageHandle.from_array(image)
+
+
+# =====================================================
+# PROGRESS REPORTING
+# =====================================================
+
+# on_stage(stage, info) callbacks let callers (e.g. the SSE endpoint) follow
+# a try-on: decoded, upstream_queued, upstream_started, image_received,
+# recommendations_ready.
+StageCallback = Callable[[str, Dict[str, Any]], None]
+
+def emit_stage(on_stage: Optional[StageCallback], stage: str, **info):
+    if on_stage is None:
+        return
+    try:
+        on_stage(stage, {"t": time.time(), **info})
+    except Exception as e:
+        logger.warning(f"Stage callback failed for {stage}: {e}")
+
+def notify_when_ready(future: Future, on_stage: Optional[StageCallback]):
+    """Emit recommendations_ready when a recommendation future completes."""
+    if on_stage is None:
+        return
+    future.add_done_callback(lambda f: emit_stage(
+        on_stage, "recommendations_ready",
+        recommendations=f.result() if not f.exception() else [],
+    ))
+
+def start_recommendations(llm_engine, request_id, clothing_item, body_measurements, on_stage):
+    """Kick off recommendations for a try-on; None without an LLM engine."""
+    if not llm_engine:
+        return None
+    future = llm_engine.submit_recommendations(request_id, clothing_item, body_measurements)
+    notify_when_ready(future, on_stage)
+    return future
+
+def collect_recommendations(future):
+    """(recommendations, ready) — only if Gemini already answered."""
+    if future is None:
+        return ["Try-on generated successfully."], True
+    if future.done():
+        return future.result(), True
+    return [], False
 
 # =====================================================
 # VIRTUAL TRY-ON ENGINE (HuggingFace API)
 # =====================================================
 
+def create_http_session(pool_size: int, pool_hosts: int = 4, pool_block: bool = False) -> requests.Session:
+    """
+    Keep-alive session with a bounded connection pool.
+    urllib3 pools are thread-safe, so one session can be shared by all
+    threads serving the blueprint as long as nobody mutates it per request.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_hosts,   # number of per-host pools kept
+        pool_maxsize=pool_size,        # connections kept alive per host
+        pool_block=pool_block,         # True = hard per-host connection limit
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
 class VirtualTryOnEngine:
-    def __init__(self):
-        self.hf_space = "yisol/IDM-VTON"
-        # yisol/IDM-VTON is a HuggingFace Space, not a model
-        # Spaces use their own API endpoint format: https://{username}-{spacename}.hf.space/api/predict
-        space_name = self.hf_space.replace("/", "-").lower()
-        self.api_url = f"https://{space_name}.hf.space/api/predict"
-        self.hf_token = os.getenv("HF_TOKEN")
-        logger.info(f"VirtualTryOnEngine using HuggingFace Space API: {self.hf_space}")
-        logger.info(f"Space API URL: {self.api_url}")
+    def __init__(self, hf_space: Optional[str] = None, space_url: Optional[str] = None):
+        self.hf_space = hf_space or os.getenv("TRYON_HF_SPACE", "yisol/IDM-VTON")
+
+        # Pooled keep-alive connections to *.hf.space; size it to the
+        # Gunicorn thread count so every serving thread can hold one.
+        pool_size = int(os.getenv("TRYON_HTTP_POOL_SIZE", os.getenv("GUNICORN_THREADS", 10)))
+        self.timeout = (
+            float(os.getenv("TRYON_CONNECT_TIMEOUT", 10)),
+            float(os.getenv("TRYON_READ_TIMEOUT", 120)),  # Spaces can take longer
+        )
+        self.session = create_http_session(
+            pool_size=pool_size,
+            pool_hosts=int(os.getenv("TRYON_HTTP_POOL_HOSTS", 4)),
+            pool_block=os.getenv("TRYON_HTTP_POOL_BLOCK", "false").lower() == "true",
+        )
+
+        # Upstream preprocessing: IDM-VTON works at 768x1024, so larger
+        # photos only cost bandwidth; JPEG is far cheaper to encode than PNG.
+        width, height = os.getenv("TRYON_MODEL_SIZE", "768x1024").lower().split("x")
+        self.model_size = (int(width), int(height))
+        self.upload_format = os.getenv("TRYON_UPLOAD_FORMAT", "JPEG").upper()
+        self.upload_quality = int(os.getenv("TRYON_UPLOAD_QUALITY", 92))
+        self.preprocess = os.getenv("TRYON_PREPROCESS", "true").lower() == "true"
+
+        # Providers (Space replicas, self-hosted endpoints, local blend) with
+        # per-backend circuit breakers and adaptive timeouts; calls are routed
+        # to the fastest healthy one and optionally hedged.
+        hedge_delay = os.getenv("TRYON_HEDGE_DELAY")
+        self.backends = BackendRegistry(
+            backends_from_env(self.session, default_space=self.hf_space,
+                              default_url=space_url, timeout=self.timeout),
+            hedge_delay=float(hedge_delay) if hedge_delay else None,
+            hedge_workers=int(os.getenv("TRYON_HEDGE_WORKERS", 8)),
+        )
+
+        logger.info(f"VirtualTryOnEngine backends: {[b.name for b in self.backends.backends]} "
+                    f"(pool size {pool_size})")
+
+    def prepare_image(self, image: ImageHandle) -> ImageHandle:
+        """Model-resolution, upload-format version of an image (memoized on the handle)."""
+        if not self.preprocess:
+            return image
+        # Already normalized (e.g. catalog garments): header check only
+        if image.size == self.model_size and image.format == self.upload_format:
+            return image
+        key = ("model", self.model_size, self.upload_format, self.upload_quality)
+        return image.variant(key, lambda h: fit_to_resolution(
+            h, self.model_size, self.upload_format, self.upload_quality
+        ))
+
+    def close(self):
+        self.backends.close()
+        self.session.close()
 
     def process_tryon(
         self,
-        person_image: np.ndarray,
-        clothing_image: np.ndarray,
+        person_image: Union[ImageHandle, np.ndarray],
+        clothing_image: Union[ImageHandle, np.ndarray],
         clothing_item: ClothingItem,
         body_measurements: Optional[BodyMeasurements] = None,
         llm_engine: Optional['LLMRecommendationEngine'] = None,
+        request_id: Optional[str] = None,
+        on_stage: Optional[StageCallback] = None,
     ) -> TryOnResult:
 
-        logger.info("🚀 Sending try-on request to HuggingFace API...")
+        # Recommendations run concurrently with the Space call and never
+        # delay the image; late ones are fetched later by request_id.
+        request_id = request_id or uuid.uuid4().hex
+        rec_future = start_recommendations(llm_engine, request_id, clothing_item, body_measurements, on_stage)
 
-        headers = {"Content-Type": "application/json"}
-        if self.hf_token:
-            headers["Authorization"] = f"Bearer {self.hf_token}"
+        person_image = as_image_handle(person_image)
+        clothing_image = as_image_handle(clothing_image)
+
+        logger.info("🚀 Sending try-on request to the try-on backends...")
 
         try:
-            # Convert to base64
-            person_b64 = self._img_to_b64(person_image)
-            cloth_b64 = self._img_to_b64(clothing_image)
-
-            # HuggingFace Space API expects data in format: [image1, image2, ...]
-            # Convert base64 to data URI format for Space API
-            person_data_uri = f"data:image/png;base64,{person_b64}"
-            cloth_data_uri = f"data:image/png;base64,{cloth_b64}"
-            
-            # Space API payload format: array of inputs matching the Space's function signature
-            payload = {
-                "data": [
-                    person_data_uri,  # person image
-                    cloth_data_uri     # clothing image
-                ]
-            }
-
-            # Space API doesn't need Authorization header, but keep it for compatibility
-            space_headers = {"Content-Type": "application/json"}
-            
-            response = requests.post(
-                self.api_url,
-                json=payload,
-                headers=space_headers,
-                timeout=120  # Spaces can take longer
+            self._check_available()
+            person_upload, cloth_upload = self._prepare_uploads(person_image, clothing_image, on_stage)
+            result_bytes, backend = self.backends.predict(
+                person_upload,
+                cloth_upload,
+                garment_description(clothing_item),
+                lambda stage, **info: emit_stage(on_stage, stage, **info),
+                clothing_item,
+                body_measurements,
             )
+            return self._success(person_image, result_bytes, backend, rec_future, request_id, on_stage)
 
-            logger.info(f"Space API Status: {response.status_code}")
-            logger.info(f"Space API URL: {self.api_url}")
-
-            if response.status_code != 200:
-                error_text = response.text
-                logger.error(f"Space API Error Response: {error_text}")
-                
-                # Try alternative payload format (some Spaces use different formats)
-                logger.warning("Trying alternative payload format...")
-                alt_payload = {
-                    "data": [
-                        person_data_uri,
-                        cloth_data_uri,
-                        f"{clothing_item.color} {clothing_item.item_type}"  # description
-                    ]
-                }
-                
-                alt_response = requests.post(
-                    self.api_url,
-                    json=alt_payload,
-                    headers=space_headers,
-                    timeout=120
-                )
-                
-                if alt_response.status_code == 200:
-                    response = alt_response
-                    logger.info("Alternative payload format worked!")
-                else:
-                    raise Exception(f"HTTP {response.status_code}: {error_text}")
-
-            data = response.json()
-            
-            # Space API returns data in format: {"data": [result_image_base64, ...]}
-            # Extract the result image
-            if isinstance(data, dict) and "data" in data:
-                result_data = data["data"]
-                if isinstance(result_data, list) and len(result_data) > 0:
-                    # Result is usually the first element, might be base64 string or data URI
-                    output_b64 = result_data[0]
-                    # Remove data URI prefix if present
-                    if isinstance(output_b64, str) and output_b64.startswith("data:image"):
-                        output_b64 = output_b64.split(",")[1] if "," in output_b64 else output_b64
-                else:
-                    raise Exception("Space API returned empty result")
-            else:
-                # Fallback: try to get image directly
-                output_b64 = data.get("generated_image") or data.get("image") or data.get("result")
-                if not output_b64:
-                    raise Exception(f"Unexpected Space API response format: {data}")
-            
-            result_img = self._b64_to_img(output_b64)
-
-            # Recommendations
-            recs = ["Try-on generated successfully."]
-            if llm_engine:
-                recs = llm_engine.generate_recommendations(clothing_item, body_measurements)
+        except Exception as e:
+            return self._failure(person_image, e, request_id)
+
+    async def aprocess_tryon(
+        self,
+        http,
+        executor,
+        person_image: Union[ImageHandle, np.ndarray],
+        clothing_image: Union[ImageHandle, np.ndarray],
+        clothing_item: ClothingItem,
+        body_measurements: Optional[BodyMeasurements] = None,
+        llm_engine: Optional['LLMRecommendationEngine'] = None,
+        request_id: Optional[str] = None,
+        on_stage: Optional[StageCallback] = None,
+    ) -> TryOnResult:
+        """
+        process_tryon() for the asyncio server (`http`: aiohttp session). The
+        upstream wait and Gemini are awaited; image work runs on `executor`.
+        """
+        request_id = request_id or uuid.uuid4().hex
+        rec_future = None
+        if llm_engine:
+            rec_future = llm_engine.asubmit_recommendations(request_id, clothing_item, body_measurements)
+            notify_when_ready(rec_future, on_stage)
+
+        person_image = as_image_handle(person_image)
+        clothing_image = as_image_handle(clothing_image)
+        loop = asyncio.get_running_loop()
+        try:
+            self._check_available()
+            person_upload, cloth_upload = await loop.run_in_executor(
+                executor, self._prepare_uploads, person_image, clothing_image, on_stage
+            )
+            result_bytes, backend = await self.backends.apredict(
+                http,
+                executor,
+                person_upload,
+                cloth_upload,
+                garment_description(clothing_item),
+                lambda stage, **info: emit_stage(on_stage, stage, **info),
+                clothing_item,
+                body_measurements,
+            )
+            return self._success(person_image, result_bytes, backend, rec_future, request_id, on_stage)
+
+        except Exception as e:
+            return self._failure(person_image, e, request_id)
+
+    def _check_available(self):
+        """During an outage, fail before spending any CPU on the images."""
+        if self.backends.pick() is None:
+            retry = min(b.breaker.retry_after() for b in self.backends.backends)
+            raise CircuitOpenError("all try-on backends", retry)
+
+    def _prepare_uploads(self, person_image, clothing_image, on_stage):
+        # Normalize to the model's resolution and upload encoding first
+        with metrics.stage("upstream_encode"):
+            person_upload = self.prepare_image(person_image)
+            cloth_upload = self.prepare_image(clothing_image)
+            upload_bytes = len(person_upload.encode()) + len(cloth_upload.encode())
+        emit_stage(on_stage, "decoded", upload_bytes=upload_bytes)
+        return person_upload, cloth_upload
+
+    def _success(self, person_image, result_bytes, backend, rec_future, request_id, on_stage) -> TryOnResult:
+        with metrics.stage("result_decode"):
+            result_img = ImageHandle.from_bytes(result_bytes)
+        emit_stage(on_stage, "image_received", backend=backend.name)
+
+        recs, recs_ready = collect_recommendations(rec_future)
+
+        return TryOnResult(
+            original_image=person_image,
+            result_image=result_img,
+            confidence=backend.confidence,
+            recommendations=recs,
+            fit_analysis={"fit_description": "Virtual try-on successful"},
+            request_id=request_id,
+            recommendations_ready=recs_ready,
+            backend=backend.name,
+            fallback=backend.fallback,
+        )
+
+    def _failure(self, person_image, error, request_id) -> TryOnResult:
+        logger.error(f"❌ Try-on error: {error}")
+        return TryOnResult(
+            original_image=person_image,
+            result_image=person_image,
+            confidence=0.0,
+            recommendations=["Try-on failed."],
+            fit_analysis={"fit_description": str(error)},
+            request_id=request_id,
+        )
+
+    def stats(self):
+        return self.backends.stats()
+
+    # image → base64
+    def _img_to_b64(self, img):
+        return as_image_handle(img).base64("PNG")
+
+    # base64 → image (numpy)
+    def _b64_to_img(self, b64_data):
+        return ImageHandle.from_base64(b64_data).array
+
+
+# =====================================================
+# LOCAL CPU ENGINE (instant previews / outages)
+# =====================================================
+
+class LocalTryOnEngine:
+    """
+    Same process_tryon interface as VirtualTryOnEngine, but composites the
+    garment onto the person on the CPU (see local_compositor) in well under
+    200 ms. Lower confidence than a real try-on; never the cached result.
+    """
+
+    confidence = 0.4
 
+    def __init__(self, max_dimension: Optional[int] = None):
+        self.max_dimension = max_dimension or int(os.getenv("TRYON_PREVIEW_MAX_DIMENSION", 768))
+
+    def load(self, image: ImageHandle, keep_alpha: bool = False) -> np.ndarray:
+        """Pixels at preview resolution (JPEGs are draft-decoded)."""
+        key = ("preview", self.max_dimension, keep_alpha)
+
+        def make(handle):
+            scale = min(1.0, self.max_dimension / max(handle.size))
+            pil = handle.to_pil(draft_size=(round(handle.size[0] * scale), round(handle.size[1] * scale)))
+            pil = ImageOps.exif_transpose(pil)
+            pil.thumbnail((self.max_dimension, self.max_dimension), Image.Resampling.BILINEAR)
+            mode = "RGBA" if keep_alpha and "A" in pil.getbands() else "RGB"
+            return ImageHandle.from_array(np.asarray(pil.convert(mode)))
+
+        return image.variant(key, make).array
+
+    def process_tryon(
+        self,
+        person_image: Union[ImageHandle, np.ndarray],
+        clothing_image: Union[ImageHandle, np.ndarray],
+        clothing_item: ClothingItem,
+        body_measurements: Optional[BodyMeasurements] = None,
+        llm_engine: Optional['LLMRecommendationEngine'] = None,
+        request_id: Optional[str] = None,
+        on_stage: Optional[StageCallback] = None,
+    ) -> TryOnResult:
+        request_id = request_id or uuid.uuid4().hex
+        rec_future = start_recommendations(llm_engine, request_id, clothing_item, body_measurements, on_stage)
+
+        person_image = as_image_handle(person_image)
+        clothing_image = as_image_handle(clothing_image)
+        try:
+            with metrics.stage("image_decode"):
+                person = self.load(person_image)
+                garment = self.load(clothing_image, keep_alpha=True)
+            emit_stage(on_stage, "decoded")
+            started = time.time()
+            with metrics.stage("upstream_wait", backend="local-compositor"):
+                result = composite_garment(person, garment, clothing_item.item_type,
+                                           body_measurements, clothing_item.fit)
+            emit_stage(on_stage, "image_received", backend="local-compositor",
+                       elapsed_ms=round((time.time() - started) * 1000, 1))
+            recs, recs_ready = collect_recommendations(rec_future)
             return TryOnResult(
                 original_image=person_image,
-                result_image=result_img,
-                confidence=0.95,
+                result_image=ImageHandle.from_array(result),
+                confidence=self.confidence,
                 recommendations=recs,
-                fit_analysis={"fit_description": "Virtual try-on successful"}
+                fit_analysis={"fit_description": "Local preview (approximate garment placement)"},
+                request_id=request_id,
+                recommendations_ready=recs_ready,
+                backend="local-compositor",
+                fallback=True,
             )
-
         except Exception as e:
-            logger.error(f"❌ Try-on error: {e}")
+            logger.error(f"❌ Local try-on error: {e}")
             return TryOnResult(
                 original_image=person_image,
                 result_image=person_image,
                 confidence=0.0,
                 recommendations=["Try-on failed."],
-                fit_analysis={"fit_description": str(e)}
+                fit_analysis={"fit_description": str(e)},
+                request_id=request_id,
             )
 
-    # image → base64
-    def _img_to_b64(self, img):
-        pil = Image.fromarray(img)
-        buf = BytesIO()
-        pil.save(buf, format="PNG")
-        return base64.b64encode(buf.getvalue()).decode()
-
-    # base64 → image (numpy)
-    def _b64_to_img(self, b64_data):
-        raw = base64.b64decode(b64_data)
-        pil = Image.open(BytesIO(raw))
-        return np.array(pil)
-
 
 # =====================================================
 # GEMINI RECOMMENDATION ENGINE
 # =====================================================
 
+def _normalize_attr(value) -> str:
+    if hasattr(value, "value"):
+        value = value.value
+    value = str(value or "")
+    # "ClothingType.SHIRT" (stringified enum) -> "shirt"
+    if value.startswith("ClothingType."):
+        value = value.split(".", 1)[1]
+    return " ".join(value.lower().split())
+
+def recommendation_key(clothing_item):
+    """Cache key over the only fields the prompt uses."""
+    return (
+        _normalize_attr(clothing_item.color),
+        _normalize_attr(clothing_item.item_type),
+        _normalize_attr(clothing_item.pattern),
+    )
+
+def import_genai():
+    """The google.generativeai module, or None if it is not installed. Safe before fork."""
+    try:
+        import google.generativeai as genai
+        return genai
+    except Exception:
+        return None
+
 class LLMRecommendationEngine:
     def __init__(self):
+        # Hard per-call deadline for Gemini; late calls fall back to defaults.
+        self.timeout = float(os.getenv("GEMINI_TIMEOUT", 8))
+        self._executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("GEMINI_WORKERS", 4)),
+            thread_name_prefix="gemini",
+        )
+        # request_id -> Future[List[str]], kept long enough for clients to fetch
+        self._pending = TTLCache(max_entries=4096, ttl=float(os.getenv("GEMINI_RESULT_TTL", 900)))
+        # (color, item, pattern) -> recommendations; the attribute space is small
+        self._cache = TTLCache(
+            max_entries=int(os.getenv("GEMINI_CACHE_SIZE", 512)),
+            ttl=float(os.getenv("GEMINI_CACHE_TTL", 6 * 3600)),
+        )
+        self._inflight = SingleFlight()
+        self._ainflight = AsyncSingleFlight()
+        # The Gemini SDK is slow to import: load it on first use (or in warm())
+        self._model = None
+        self._model_loaded = False
+        self._model_lock = threading.Lock()
+
+    @property
+    def model(self):
+        if not self._model_loaded:
+            with self._model_lock:
+                if not self._model_loaded:
+                    self._model = self._load_model()
+                    self._model_loaded = True
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        with self._model_lock:
+            self._model = model
+            self._model_loaded = True
+
+    def _load_model(self):
+        key = os.getenv("GEMINI_API_KEY")
+        if not key:
+            logger.warning("No GEMINI_API_KEY. Using fallback.")
+            return None
+        genai = import_genai()
+        if genai is None:
+            logger.error("Failed to load Gemini.")
+            return None
         try:
-            import google.generativeai as genai
-            key = os.getenv("GEMINI_API_KEY")
-
-            if key:
-                genai.configure(api_key=key)
-                self.model = genai.GenerativeModel("gemini-1.5-flash")
-                logger.info("Gemini initialized.")
-            else:
-                logger.warning("No GEMINI_API_KEY. Using fallback.")
-                self.model = None
+            genai.configure(api_key=key)
+            model = genai.GenerativeModel("gemini-1.5-flash")
+            logger.info("Gemini initialized.")
+            return model
         except:
             logger.error("Failed to load Gemini.")
-            self.model = None
+            return None
 
     def generate_recommendations(self, clothing_item, body_measurements=None):
         if not self.model:
-            return [
-                f"This {clothing_item.color} {clothing_item.item_type} suits you.",
-                "Consider pairing with complementary colors.",
-                "The fit looks clean and balanced."
-            ]
+            return self._default_recommendations(clothing_item)
+
+        key = recommendation_key(clothing_item)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return list(cached)
 
         try:
-            prompt = f"""
+            # Concurrent misses for the same attributes share one Gemini call
+            recs, _ = self._inflight.do("|".join(key), lambda: self._ask_gemini(key))
+            return list(recs)
+        except:
+            metrics.FALLBACKS.inc(kind="recommendations")
+            return ["Nice choice!", "This item fits your style."]
+
+    async def agenerate_recommendations(self, clothing_item, body_measurements=None):
+        """generate_recommendations() for the asyncio server: the Gemini call is awaited."""
+        if not self.model:
+            return self._default_recommendations(clothing_item)
+
+        key = recommendation_key(clothing_item)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return list(cached)
+
+        try:
+            recs, _ = await self._ainflight.do("|".join(key), lambda: self._aask_gemini(key))
+            return list(recs)
+        except Exception:
+            metrics.FALLBACKS.inc(kind="recommendations")
+            return ["Nice choice!", "This item fits your style."]
+
+    def _default_recommendations(self, clothing_item):
+        return [
+            f"This {clothing_item.color} {clothing_item.item_type} suits you.",
+            "Consider pairing with complementary colors.",
+            "The fit looks clean and balanced."
+        ]
+
+    def _prompt(self, key):
+        color, item_type, pattern = key
+        return f"""
 Provide 3 short styling recommendations for:
-Color: {clothing_item.color}
-Item: {clothing_item.item_type}
-Pattern: {clothing_item.pattern}
+Color: {color}
+Item: {item_type}
+Pattern: {pattern}
 """
 
-            response = self.model.generate_content(prompt)
-            text = response.text
-            lines = [l.strip("-• ").strip() for l in text.split("\n") if l.strip()]
-            return lines[:3]
+    def _ask_gemini(self, key):
+        with metrics.stage("llm_call"):
+            response = self.model.generate_content(
+                self._prompt(key),
+                request_options={"timeout": self.timeout},
+            )
+        return self._parse_recommendations(key, response.text)
 
-        except:
-            return ["Nice choice!", "This item fits your style."]
+    async def _aask_gemini(self, key):
+        with metrics.stage("llm_call"):
+            if hasattr(self.model, "generate_content_async"):
+                call = self.model.generate_content_async(self._prompt(key), request_options={"timeout": self.timeout})
+            else:
+                call = asyncio.to_thread(self.model.generate_content, self._prompt(key),
+                                         request_options={"timeout": self.timeout})
+            response = await asyncio.wait_for(call, timeout=self.timeout)
+        return self._parse_recommendations(key, response.text)
+
+    def _parse_recommendations(self, key, text):
+        lines = [l.strip("-• ").strip() for l in text.split("\n") if l.strip()]
+        recs = lines[:3]
+        if recs:
+            self._cache.set(key, tuple(recs))
+        return recs
+
+    def prewarm(self, combinations):
+        """
+        Fill the cache in the background for common attribute combinations,
+        given as ClothingItem, dicts, or "color item pattern" strings.
+        """
+        if not self.model:
+            return []
+        futures = []
+        for combo in combinations:
+            if isinstance(combo, str):
+                parts = combo.split()
+                combo = dict(zip(("color", "item_type", "pattern"), parts))
+            if isinstance(combo, dict):
+                combo = ClothingItem(
+                    item_type=combo.get("item_type", "shirt"),
+                    color=combo.get("color", ""),
+                    pattern=combo.get("pattern", ""),
+                )
+            futures.append(self._executor.submit(self.generate_recommendations, combo))
+        logger.info(f"Prewarming {len(futures)} recommendation combinations.")
+        return futures
+
+    def prewarm_from_env(self):
+        """GEMINI_PREWARM="black shirt solid; white shirt solid; blue pants denim" """
+        spec = os.getenv("GEMINI_PREWARM", "")
+        combos = [c.strip() for c in spec.split(";") if c.strip()]
+        return self.prewarm(combos) if combos else []
+
+    def cache_stats(self):
+        return self._cache.stats()
+
+    def submit_recommendations(self, request_id, clothing_item, body_measurements=None) -> Future:
+        """Start generating in the background; the result is kept under request_id."""
+        cached = self._cache.get(recommendation_key(clothing_item)) if self.model else None
+        if cached is not None:
+            future = Future()
+            future.set_result(list(cached))
+        else:
+            future = self._executor.submit(self.generate_recommendations, clothing_item, body_measurements)
+        self._pending.set(request_id, (future, time.time() + self.timeout))
+        return future
+
+    def asubmit_recommendations(self, request_id, clothing_item, body_measurements=None) -> Future:
+        """
+        submit_recommendations() from inside the event loop: the Gemini call is
+        a task, not a worker thread. Returns the same kind of Future.
+        """
+        future = Future()
+        cached = self._cache.get(recommendation_key(clothing_item)) if self.model else None
+        if cached is not None:
+            future.set_result(list(cached))
+        else:
+            task = asyncio.ensure_future(self.agenerate_recommendations(clothing_item, body_measurements))
+            task.add_done_callback(lambda t: future.set_result(
+                ["Nice choice!", "This item fits your style."] if t.cancelled() else t.result()
+            ))
+        self._pending.set(request_id, (future, time.time() + self.timeout))
+        return future
+
+    async def await_recommendations(self, request_id, wait: float = 0):
+        """get_recommendations() without blocking the event loop."""
+        entry = self._pending.get(request_id)
+        if entry is None:
+            return None
+        future, deadline = entry
+        try:
+            return True, await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)),
+                                                timeout=max(0, min(wait, deadline - time.time())))
+        except asyncio.TimeoutError:
+            return self.get_recommendations(request_id)
+
+    def get_recommendations(self, request_id, wait: float = 0):
+        """Returns (ready, recommendations) or None for an unknown request_id."""
+        entry = self._pending.get(request_id)
+        if entry is None:
+            return None
+        future, deadline = entry
+        try:
+            return True, future.result(timeout=max(0, min(wait, deadline - time.time())))
+        except FutureTimeout:
+            if time.time() >= deadline:
+                # Past the hard deadline: answer with defaults instead of "pending" forever
+                metrics.FALLBACKS.inc(kind="recommendations")
+                return True, ["Nice choice!", "This item fits your style."]
+            return False, []
 
 
 # =====================================================
 # IMAGE HELPERS (required by tryon_api)
 # =====================================================
 
-def image_to_base64(image: np.ndarray) -> str:
-    pil = Image.fromarray(image)
-    buf = BytesIO()
-    pil.save(buf, format="PNG")
-    return base64.b64encode(buf.getvalue()).decode()
+def image_to_base64(image: Union[ImageHandle, np.ndarray]) -> str:
+    """PNG base64; an ImageHandle that is already PNG is returned as-is."""
+    return as_image_handle(image).base64("PNG")
 
 def base64_to_image(base64_str: str) -> np.ndarray:
-    raw = base64.b64decode(base64_str)
-    pil = Image.open(BytesIO(raw))
-    return np.array(pil)
+    return ImageHandle.from_base64(base64_str).array
@@ -0,0 +1,243 @@
+"""
+Local CPU Try-On Compositor
+Places the garment over the person's torso (or legs) with NumPy only:
+background masking, silhouette-based placement, feathered alpha blending
+and shading transfer. No per-pixel Python loops; well under 200 ms at
+768x1024 on one core.
+"""
+
+import logging
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Garment region per item type, as fractions of the person's height
+# measured from the top of the head: (top, bottom, width source)
+REGIONS = {
+    "shirt": (0.17, 0.52, "shoulders"),
+    "sweater": (0.17, 0.54, "shoulders"),
+    "jacket": (0.16, 0.56, "shoulders"),
+    "coat": (0.16, 0.72, "shoulders"),
+    "dress": (0.17, 0.80, "shoulders"),
+    "pants": (0.49, 0.97, "hips"),
+    "skirt": (0.49, 0.74, "hips"),
+    "shoes": (0.93, 1.00, "hips"),
+}
+DEFAULT_REGION = REGIONS["shirt"]
+
+# Flat-lay garment photos are wider than the body they cover (sleeves, legs)
+FLAT_LAY_SPREAD = {"shoulders": 1.35, "hips": 1.1}
+
+# Garment width relative to the body width at that height
+FIT_SCALE = {"slim": 0.98, "tight": 0.95, "regular": 1.08, "loose": 1.2, "oversized": 1.3}
+
+
+# =====================================================
+# VECTORIZED HELPERS
+# =====================================================
+
+def box_blur(values: np.ndarray, radius: int) -> np.ndarray:
+    """Mean filter of a 2-D array via an integral image (cost independent of radius)."""
+    if radius < 1:
+        return values.astype(np.float32)
+    k = 2 * radius + 1
+    padded = np.pad(values.astype(np.float64), ((radius + 1, radius), (radius + 1, radius)), mode="edge")
+    integral = padded.cumsum(0).cumsum(1)
+    window = integral[k:, k:] - integral[:-k, k:] - integral[k:, :-k] + integral[:-k, :-k]
+    return (window / (k * k)).astype(np.float32)
+
+
+def border_color(rgb: np.ndarray, thickness: int = 4) -> np.ndarray:
+    """Median colour of the image border: the background estimate."""
+    border = np.concatenate([
+        rgb[:thickness].reshape(-1, 3), rgb[-thickness:].reshape(-1, 3),
+        rgb[:, :thickness].reshape(-1, 3), rgb[:, -thickness:].reshape(-1, 3),
+    ])
+    return np.median(border, axis=0)
+
+
+def foreground_mask(image: np.ndarray, threshold: float = 38.0) -> np.ndarray:
+    """
+    Soft foreground mask in [0, 1]: the alpha channel when it is meaningful,
+    otherwise colour distance from the border (background) colour.
+    """
+    if image.ndim == 3 and image.shape[2] == 4 and image[..., 3].min() < 250:
+        return image[..., 3].astype(np.float32) / 255.0
+    rgb = image[..., :3].astype(np.float32)
+    diff = rgb - border_color(rgb).astype(np.float32)
+    distance = np.sqrt(np.einsum("ijk,ijk->ij", diff, diff))
+    # Soft ramp around the threshold instead of a hard cut
+    mask = np.clip((distance - threshold * 0.5) / threshold, 0.0, 1.0)
+    # Close pinholes (white logos on a white background, JPEG noise)
+    radius = max(1, min(image.shape[:2]) // 150)
+    return np.clip(box_blur(mask, radius) * 1.5, 0.0, 1.0)
+
+
+def bounding_box(mask: np.ndarray, level: float = 0.5) -> Optional[Tuple[int, int, int, int]]:
+    rows = np.flatnonzero((mask > level).any(axis=1))
+    cols = np.flatnonzero((mask > level).any(axis=0))
+    if rows.size == 0 or cols.size == 0:
+        return None
+    return rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+
+# =====================================================
+# BODY LANDMARKS
+# =====================================================
+
+class BodyLandmarks:
+    """Head top, feet, centre line and row-wise silhouette extent, in pixels."""
+
+    def __init__(self, top: int, bottom: int, center_x: float, left: np.ndarray, right: np.ndarray,
+                 silhouette: Optional[np.ndarray]):
+        self.top = top
+        self.bottom = bottom
+        self.center_x = center_x
+        self.left = left      # per row: first silhouette column (-1 where empty)
+        self.right = right
+        self.silhouette = silhouette
+
+    @property
+    def height(self) -> int:
+        return max(1, self.bottom - self.top)
+
+    def row(self, fraction: float) -> int:
+        return int(self.top + fraction * self.height)
+
+    def width_at(self, start: float, end: float) -> Optional[float]:
+        """Median silhouette width over a band of rows (fractions of height)."""
+        lo, hi = self.row(start), max(self.row(end), self.row(start) + 1)
+        widths = (self.right[lo:hi] - self.left[lo:hi])[self.left[lo:hi] >= 0]
+        return float(np.median(widths)) if widths.size else None
+
+
+def detect_landmarks(person: np.ndarray) -> BodyLandmarks:
+    """
+    Silhouette from background subtraction against the border colour. Works
+    on studio/plain backgrounds and the padded model-resolution images; on
+    cluttered photos it falls back to a centred, full-height figure.
+    """
+    h, w = person.shape[:2]
+    # Landmarks need no detail: analyse a subsampled copy (~384 px wide)
+    step = max(1, w // 384)
+    mask = foreground_mask(person[::step, ::step]) > 0.5
+    coverage = mask.mean()
+    if 0.05 < coverage < 0.85:
+        mask = np.repeat(mask, step, axis=0)[:h]
+        has = mask.any(axis=1)
+        left = np.where(has, mask.argmax(axis=1) * step, -1)
+        right = np.where(has, (mask.shape[1] - mask[:, ::-1].argmax(axis=1)) * step, -1)
+        rows = np.flatnonzero(has)
+        top, bottom = int(rows[0]), int(rows[-1]) + 1
+        band = slice(top + (bottom - top) // 5, top + (bottom - top) // 2)
+        valid = left[band] >= 0
+        center = float(np.median((left[band][valid] + right[band][valid]) / 2)) if valid.any() else w / 2
+        return BodyLandmarks(top, bottom, center, left, right, mask)
+
+    logger.info(f"No clear silhouette (coverage {coverage:.2f}); assuming a centred figure")
+    left = np.full(h, int(w * 0.3))
+    right = np.full(h, int(w * 0.7))
+    return BodyLandmarks(int(h * 0.04), h, w / 2, left, right, None)
+
+
+def body_width_px(landmarks: BodyLandmarks, source: str, measurements=None) -> float:
+    """Body width at the garment's widest point, from measurements when given."""
+    px_per_cm = None
+    height_cm = getattr(measurements, "height", 0) or 0
+    if height_cm > 0:
+        px_per_cm = landmarks.height / height_cm
+    if px_per_cm:
+        # Front width of a body circumference is roughly a third of it
+        if source == "shoulders" and getattr(measurements, "shoulder_width", 0):
+            return measurements.shoulder_width * px_per_cm
+        if source == "shoulders" and getattr(measurements, "chest", 0):
+            return measurements.chest / 3 * px_per_cm
+        if source == "hips" and getattr(measurements, "hips", 0):
+            return measurements.hips / 3 * px_per_cm
+
+    band, typical, low, high = (
+        ((0.18, 0.26), 0.26, 0.15, 0.38) if source == "shoulders" else ((0.50, 0.58), 0.22, 0.12, 0.34)
+    )
+    measured = landmarks.width_at(*band) if landmarks.silhouette is not None else None
+    # Implausible widths mean the "silhouette" was something else (e.g. a
+    # photo rectangle inside padding): use typical proportions instead
+    if measured is None or not low <= measured / landmarks.height <= high:
+        return landmarks.height * typical
+    return measured
+
+
+# =====================================================
+# COMPOSITING
+# =====================================================
+
+def _item_name(item_type) -> str:
+    value = getattr(item_type, "value", item_type)
+    return str(value or "").lower().split(".")[-1].strip()
+
+
+def composite_garment(person: np.ndarray, garment: np.ndarray, item_type="shirt",
+                      measurements=None, fit: str = "", shading: float = 0.35) -> np.ndarray:
+    """
+    Paste `garment` (RGB or RGBA array) onto `person` (RGB array) over the
+    body region for `item_type`. Returns a new uint8 RGB array.
+    """
+    person = person[..., :3] if person.ndim == 3 else np.stack([person] * 3, axis=2)
+    if garment.ndim == 2:
+        garment = np.stack([garment] * 3, axis=2)
+    h, w = person.shape[:2]
+
+    # 1. Cut the garment out of its background and crop to it
+    g_mask = foreground_mask(garment)
+    box = bounding_box(g_mask)
+    if box is None or g_mask.mean() > 0.97:
+        box, g_mask = (0, garment.shape[0], 0, garment.shape[1]), np.ones(garment.shape[:2], np.float32)
+    y0, y1, x0, x1 = box
+    g_rgb = garment[y0:y1, x0:x1, :3]
+    g_mask = g_mask[y0:y1, x0:x1]
+
+    # 2. Place it on the body
+    landmarks = detect_landmarks(person)
+    top_f, bottom_f, source = REGIONS.get(_item_name(item_type), DEFAULT_REGION)
+    scale = FIT_SCALE.get(str(fit or "").lower(), FIT_SCALE["regular"])
+    target_w = body_width_px(landmarks, source, measurements) * scale * FLAT_LAY_SPREAD[source]
+    top, bottom = landmarks.row(top_f), landmarks.row(bottom_f)
+    region_h = max(8, bottom - top)
+    # Keep the garment's aspect unless that would overshoot the region a lot
+    region_w = int(np.clip(target_w, region_h * g_rgb.shape[1] / g_rgb.shape[0] * 0.6,
+                           region_h * g_rgb.shape[1] / g_rgb.shape[0] * 1.6))
+    region_w = max(8, min(region_w, w))
+    left = int(round(landmarks.center_x - region_w / 2))
+
+    g_rgb = np.asarray(Image.fromarray(np.ascontiguousarray(g_rgb)).resize(
+        (region_w, region_h), Image.Resampling.BILINEAR), dtype=np.float32)
+    g_alpha = np.asarray(Image.fromarray((g_mask * 255).astype(np.uint8)).resize(
+        (region_w, region_h), Image.Resampling.BILINEAR), dtype=np.float32) / 255.0
+
+    # Clip the placement to the frame
+    py0, py1 = max(0, top), min(h, top + region_h)
+    px0, px1 = max(0, left), min(w, left + region_w)
+    if py1 <= py0 or px1 <= px0:
+        return person.copy()
+    gy0, gx0 = py0 - top, px0 - left
+    g_rgb = g_rgb[gy0:gy0 + py1 - py0, gx0:gx0 + px1 - px0]
+    g_alpha = g_alpha[gy0:gy0 + py1 - py0, gx0:gx0 + px1 - px0]
+
+    # 3. Feathered alpha: soften the cut-out edge inwards, so background
+    #    colour caught in the garment's anti-aliased border never shows
+    feather = max(1, min(region_w, region_h) // 60)
+    alpha = np.clip(box_blur(g_alpha, feather) * 2.0 - 1.0, 0.0, 1.0)[..., None]
+
+    # 4. Shading transfer: the person's folds and shadows modulate the garment
+    base = person[py0:py1, px0:px1].astype(np.float32)
+    if shading > 0:
+        luma = base @ np.array([0.299, 0.587, 0.114], np.float32)
+        local_mean = box_blur(luma, max(2, region_w // 12)) + 1.0
+        detail = np.clip((luma + 1.0) / local_mean, 0.6, 1.4) ** shading
+        g_rgb = g_rgb * detail[..., None]
+
+    out = person.copy()
+    out[py0:py1, px0:px1] = np.clip(base * (1 - alpha) + g_rgb * alpha, 0, 255).astype(np.uint8)
+    return out
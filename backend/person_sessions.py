@@ -0,0 +1,149 @@
+"""
+Person Photo Sessions
+A user's photo is uploaded and normalized once (POST /api/tryon/persons),
+then referenced by `person_id` for any number of try-ons. Sessions expire
+after a sliding TTL, are capped per user (or per client address when
+anonymous), and the store is byte-bounded.
+"""
+
+import os
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from admission import tenant_of
+from tryon_cache import TTLCache
+from llm_tryon_service import ImageHandle, fit_to_resolution
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PersonSession:
+    person_id: str
+    image: ImageHandle
+    user_id: Optional[str]
+    created_at: float
+    expires_at: float
+    tenant: str = ""
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "person_id": self.person_id,
+            "user_id": self.user_id,
+            "size": list(self.image.size),
+            "bytes": len(self.image.encode()),
+            "created_at": self.created_at,
+            "expires_at": self.expires_at,
+        }
+
+
+class PersonSessionStore:
+    """
+    In-memory sessions (memory LRU bounded by bytes, sliding TTL). Each user
+    keeps at most `max_per_user` sessions; creating one more drops their
+    oldest. Anonymous sessions share that quota per client address, so one
+    client can't flush everyone else's sessions out of the byte budget.
+    """
+
+    def __init__(self, ttl: float = 3600, max_per_user: int = 5,
+                 max_bytes: int = 256 * 1024 * 1024, model_size=(768, 1024),
+                 fmt: str = "JPEG", quality: int = 92):
+        self.ttl = ttl
+        self.max_per_user = max_per_user
+        self.model_size = model_size
+        self.format = fmt.upper()
+        self.quality = quality
+        self._sessions = TTLCache(max_entries=100000, max_bytes=max_bytes, ttl=ttl)
+        self._by_tenant: Dict[str, "OrderedDict[str, None]"] = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.quota_evictions = 0
+
+    @classmethod
+    def from_env(cls) -> "PersonSessionStore":
+        width, height = os.getenv("TRYON_MODEL_SIZE", "768x1024").lower().split("x")
+        return cls(
+            ttl=float(os.getenv("TRYON_PERSON_TTL", 3600)),
+            max_per_user=int(os.getenv("TRYON_PERSON_MAX_PER_USER", 5)),
+            max_bytes=int(float(os.getenv("TRYON_PERSON_MEMORY_MB", 256)) * 1024 * 1024),
+            model_size=(int(width), int(height)),
+            fmt=os.getenv("TRYON_UPLOAD_FORMAT", "JPEG"),
+            quality=int(os.getenv("TRYON_UPLOAD_QUALITY", 92)),
+        )
+
+    def create(self, raw: bytes, user_id: Optional[str] = None,
+               client: Optional[str] = None) -> PersonSession:
+        """
+        Normalize the photo to the model resolution and open a session,
+        counted against the user's quota (the client address's if anonymous).
+        Raises on bad images.
+        """
+        image = fit_to_resolution(ImageHandle.from_bytes(raw), self.model_size, self.format, self.quality)
+        image._array = None  # keep only the encoded bytes; pixels decode again on demand
+        now = time.time()
+        tenant = tenant_of(user_id, client)[1]
+        session = PersonSession(uuid.uuid4().hex, image, user_id, now, now + self.ttl, tenant)
+        self._sessions.set(session.person_id, session, size=len(image.encode()))
+
+        with self._lock:
+            owned = self._by_tenant.setdefault(tenant, OrderedDict())
+            self._forget_dead(owned)
+            owned[session.person_id] = None
+            while len(owned) > self.max_per_user:
+                oldest, _ = owned.popitem(last=False)
+                self._sessions.pop(oldest)
+                self.quota_evictions += 1
+        self.created += 1
+        return session
+
+    def get(self, person_id: str, user_id: Optional[str] = None) -> Optional[PersonSession]:
+        """
+        The live session (its TTL restarts), or None if unknown, expired or
+        another user's. A session created with a user_id needs that user_id.
+        """
+        session = self._sessions.get(person_id)
+        if session is None:
+            return None
+        if session.user_id and str(user_id or "") != str(session.user_id):
+            return None
+        session.expires_at = time.time() + self.ttl
+        self._sessions.set(person_id, session, size=len(session.image.encode()))
+        return session
+
+    def delete(self, person_id: str, user_id: Optional[str] = None) -> bool:
+        session = self.get(person_id, user_id)
+        if session is None:
+            return False
+        self._sessions.pop(person_id)
+        with self._lock:
+            owned = self._by_tenant.get(session.tenant)
+            if owned is not None:
+                owned.pop(person_id, None)
+                if not owned:
+                    del self._by_tenant[session.tenant]
+        return True
+
+    def _forget_dead(self, owned):
+        """Drop ids whose sessions expired or were evicted for memory (caller holds the lock)."""
+        for person_id in [p for p in owned if self._sessions.peek(p) is None]:
+            del owned[person_id]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            for tenant in list(self._by_tenant):
+                owned = self._by_tenant[tenant]
+                self._forget_dead(owned)
+                if not owned:
+                    del self._by_tenant[tenant]
+            tenants = len(self._by_tenant)
+        return {
+            **self._sessions.stats(),
+            "tenants": tenants,
+            "created": self.created,
+            "quota_evictions": self.quota_evictions,
+        }
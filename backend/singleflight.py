@@ -0,0 +1,123 @@
+"""
+Single-Flight Call Coalescing
+Concurrent callers with the same key share one execution of the work.
+"""
+
+import asyncio
+import logging
+import threading
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    In-process equivalent of Go's singleflight.Group: while a call for a key is
+    running, further calls for that key block and receive the same result
+    (or exception) instead of starting their own.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+        self.executions = 0
+        self.coalesced = 0
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Run fn once per key at a time. Returns (result, shared)."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.executions += 1
+                leader = True
+
+        if not leader:
+            logger.info(f"Coalesced in-flight request: {key[:12]}")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result, call.waiters > 0
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": self.in_flight(),
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+        }
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutines (one event loop). The work runs as its own
+    task, so a caller that goes away (client disconnect) does not cancel it
+    for the others still waiting.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, Tuple[asyncio.Task, list]] = {}
+        self.executions = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Await fn() once per key at a time. Returns (result, shared)."""
+        call = self._calls.get(key)
+        if call is not None:
+            task, waiters = call
+            waiters.append(1)
+            self.coalesced += 1
+            logger.info(f"Coalesced in-flight request: {key[:12]}")
+            return await asyncio.shield(task), True
+
+        task = asyncio.ensure_future(fn())
+        waiters: list = []
+        self._calls[key] = (task, waiters)
+        self.executions += 1
+        task.add_done_callback(lambda t: self._done(key, t))
+        result = await asyncio.shield(task)
+        return result, bool(waiters)
+
+    def _done(self, key: str, task: asyncio.Task):
+        if self._calls.get(key, (None,))[0] is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # retrieved, even if every caller went away
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": self.in_flight(),
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,391 @@
+"""
+Gradio Queue Client for HuggingFace Spaces
+Speaks the Space's native queue protocol (upload → queue/join → queue/data
+event stream → file download) instead of guessing /api/predict payloads.
+predict() runs on requests; apredict() runs the same protocol on aiohttp.
+"""
+
+import json
+import time
+import uuid
+import base64
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# Input component types that take an image, in order of preference
+IMAGE_COMPONENTS = ("imageeditor", "image", "sketchpad", "paint")
+TEXT_COMPONENTS = ("textbox", "text")
+
+
+class SpaceError(Exception):
+    """The Space rejected or failed a prediction."""
+
+
+class SchemaUnavailable(SpaceError):
+    """The Space exposes no usable Gradio queue endpoint."""
+
+
+class SignatureMismatch(SpaceError):
+    """The Space rejected our inputs; its API probably changed."""
+
+
+@dataclass
+class EndpointSignature:
+    """What we learned from the Space's /config, discovered once and cached."""
+    api_name: str
+    fn_index: int
+    api_prefix: str = ""
+    protocol: str = "sse_v3"
+    trigger_id: Optional[int] = None
+    # (component type, default value) per input, in call order
+    inputs: List[Tuple[str, Any]] = field(default_factory=list)
+
+
+@dataclass
+class QueueStatus:
+    """Latest queue feedback from the Space, usable for scheduling."""
+    rank: Optional[int] = None
+    queue_size: Optional[int] = None
+    eta: Optional[float] = None
+    updated_at: float = 0.0
+
+
+def _noop_progress(stage: str, **info):
+    pass
+
+
+class GradioSpaceClient:
+    def __init__(self, base_url: str, session, timeout=(10, 120), api_name: str = "/tryon",
+                 hf_token: Optional[str] = None, deadline: float = 240):
+        self.base_url = base_url.rstrip("/")
+        self.session = session
+        self.timeout = timeout          # (connect, read) per HTTP call / stream gap
+        self.deadline = deadline        # overall budget for one prediction
+        self.api_name = api_name if api_name.startswith("/") else f"/{api_name}"
+        self.headers = {"Authorization": f"Bearer {hf_token}"} if hf_token else {}
+        self.queue_status = QueueStatus()
+        self._signature: Optional[EndpointSignature] = None
+        self._lock = threading.Lock()
+
+    # -------- schema discovery --------
+
+    def signature(self) -> EndpointSignature:
+        """Endpoint signature from the Space's config (cached after the first call)."""
+        sig = self._signature
+        if sig is not None:
+            return sig
+        with self._lock:
+            if self._signature is None:
+                self._signature = self._discover()
+            return self._signature
+
+    def invalidate(self):
+        with self._lock:
+            self._signature = None
+
+    def _discover(self) -> EndpointSignature:
+        resp = self.session.get(f"{self.base_url}/config", headers=self.headers, timeout=self.timeout)
+        if resp.status_code != 200:
+            raise SchemaUnavailable(f"Space config unavailable: HTTP {resp.status_code}")
+        return self._parse_config(resp.json())
+
+    def _parse_config(self, config: Dict[str, Any]) -> EndpointSignature:
+        components = {c["id"]: c for c in config.get("components", [])}
+        dependencies = config.get("dependencies", [])
+
+        wanted = self.api_name.lstrip("/")
+        fn_index = next(
+            (i for i, dep in enumerate(dependencies) if dep.get("api_name") == wanted),
+            None,
+        )
+        if fn_index is None:
+            # No endpoint by that name: take the first one fed by two images
+            for i, dep in enumerate(dependencies):
+                types = [components.get(c, {}).get("type") for c in dep.get("inputs", [])]
+                if sum(t in IMAGE_COMPONENTS for t in types) >= 2:
+                    fn_index = i
+                    break
+        if fn_index is None:
+            raise SchemaUnavailable(f"No try-on endpoint {self.api_name} in Space config")
+
+        dep = dependencies[fn_index]
+        inputs = []
+        for comp_id in dep.get("inputs", []):
+            comp = components.get(comp_id, {})
+            inputs.append((comp.get("type", ""), comp.get("props", {}).get("value")))
+
+        targets = dep.get("targets") or []
+        trigger_id = targets[0][0] if targets and isinstance(targets[0], (list, tuple)) else None
+        sig = EndpointSignature(
+            api_name=f"/{dep.get('api_name') or wanted}",
+            fn_index=dep.get("id", fn_index),
+            api_prefix=config.get("api_prefix", "") or "",
+            protocol=config.get("protocol", "sse_v3"),
+            trigger_id=trigger_id,
+            inputs=inputs,
+        )
+        if not sig.protocol.startswith("sse"):
+            raise SchemaUnavailable(f"Unsupported Gradio protocol: {sig.protocol}")
+        logger.info(f"Discovered Space endpoint {sig.api_name} (fn_index={sig.fn_index}, "
+                    f"protocol={sig.protocol}, inputs={[t for t, _ in sig.inputs]})")
+        return sig
+
+    # -------- prediction --------
+
+    def predict(self, person: Tuple[bytes, str], garment: Tuple[bytes, str], description: str = "",
+                progress: Callable[..., None] = _noop_progress, deadline: Optional[float] = None) -> bytes:
+        """
+        Run the try-on. `person` / `garment` are (encoded bytes, mime type).
+        `deadline` overrides the overall time budget for this call.
+        Returns the encoded result image.
+        """
+        sig = self.signature()
+        started = time.time()
+        deadline = deadline or self.deadline
+        try:
+            person_file, garment_file = self._upload(sig, [person, garment])
+            data = self._build_inputs(sig, person_file, garment_file, description)
+            output = self._run_queue(sig, data, progress, started, deadline)
+        except SignatureMismatch:
+            # The Space was redeployed with a new signature: rediscover next time
+            self.invalidate()
+            raise
+        return self._fetch_output(sig, output)
+
+    def _url(self, sig: EndpointSignature, path: str) -> str:
+        return f"{self.base_url}{sig.api_prefix}{path}"
+
+    def _upload(self, sig: EndpointSignature, images) -> List[Dict[str, Any]]:
+        files = []
+        for i, (data, mime) in enumerate(images):
+            ext = mime.split("/")[-1].replace("jpeg", "jpg")
+            files.append(("files", (f"input_{i}.{ext}", data, mime)))
+        resp = self.session.post(self._url(sig, "/upload"), files=files,
+                                 headers=self.headers, timeout=self.timeout)
+        if resp.status_code != 200:
+            raise SpaceError(f"Upload failed: HTTP {resp.status_code}: {resp.text[:200]}")
+        paths = resp.json()
+        return [
+            {"path": path, "orig_name": name, "mime_type": mime, "meta": {"_type": "gradio.FileData"}}
+            for path, (_, (name, _, mime)) in zip(paths, files)
+        ]
+
+    def _build_inputs(self, sig: EndpointSignature, person_file, garment_file, description):
+        """Fill the discovered inputs: images in order, text gets the description, rest keep defaults."""
+        images = [person_file, garment_file]
+        data = []
+        for comp_type, default in sig.inputs:
+            if comp_type in IMAGE_COMPONENTS and images:
+                image = images.pop(0)
+                if comp_type == "imageeditor":
+                    data.append({"background": image, "layers": [], "composite": None})
+                else:
+                    data.append(image)
+            elif comp_type in TEXT_COMPONENTS:
+                data.append(description)
+            else:
+                data.append(default)
+        if images:
+            raise SignatureMismatch(f"Endpoint {sig.api_name} does not take two images")
+        return data
+
+    def _run_queue(self, sig, data, progress, started, deadline):
+        session_hash = uuid.uuid4().hex[:11]
+        join = self.session.post(
+            self._url(sig, "/queue/join"),
+            json=self._join_payload(sig, data, session_hash),
+            headers=self.headers,
+            timeout=self.timeout,
+        )
+        if join.status_code in (404, 422):
+            raise SignatureMismatch(f"Queue join rejected: HTTP {join.status_code}: {join.text[:200]}")
+        if join.status_code != 200:
+            raise SpaceError(f"Queue join failed: HTTP {join.status_code}: {join.text[:200]}")
+        event_id = join.json().get("event_id")
+        progress("upstream_queued", event_id=event_id)
+
+        stream = self.session.get(
+            self._url(sig, "/queue/data"),
+            params={"session_hash": session_hash},
+            headers={**self.headers, "Accept": "text/event-stream"},
+            stream=True,
+            # No stream gap may outlast the whole budget
+            timeout=(self.timeout[0], min(self.timeout[1], deadline)),
+        )
+        try:
+            if stream.status_code != 200:
+                raise SpaceError(f"Queue stream failed: HTTP {stream.status_code}")
+            for line in stream.iter_lines(decode_unicode=True):
+                if time.time() - started > deadline:
+                    raise SpaceError(f"Space did not finish within {deadline:.0f}s")
+                if not line or not line.startswith("data:"):
+                    continue
+                done, output = self._handle_message(json.loads(line[5:].strip()), event_id, progress)
+                if done:
+                    if output is None:
+                        break
+                    return output
+        finally:
+            stream.close()
+        raise SpaceError("Queue stream closed before the result arrived")
+
+    def _join_payload(self, sig: EndpointSignature, data, session_hash: str) -> Dict[str, Any]:
+        return {
+            "data": data,
+            "fn_index": sig.fn_index,
+            "session_hash": session_hash,
+            "event_data": None,
+            "trigger_id": sig.trigger_id,
+        }
+
+    def _handle_message(self, msg: Dict[str, Any], event_id, progress) -> Tuple[bool, Optional[List[Any]]]:
+        """
+        One queue event. Returns (True, output) on completion, (True, None)
+        when the stream is closing, (False, None) otherwise.
+        """
+        if event_id and msg.get("event_id") not in (None, event_id):
+            return False, None
+        kind = msg.get("msg")
+        if kind == "estimation":
+            self.queue_status = QueueStatus(
+                rank=msg.get("rank"),
+                queue_size=msg.get("queue_size"),
+                eta=msg.get("rank_eta"),
+                updated_at=time.time(),
+            )
+            progress("upstream_queued", position=msg.get("rank"),
+                     queue_size=msg.get("queue_size"), eta=msg.get("rank_eta"))
+        elif kind == "process_starts":
+            progress("upstream_started", eta=msg.get("eta"))
+        elif kind == "process_completed":
+            output = msg.get("output") or {}
+            if not msg.get("success", True) or output.get("error"):
+                raise SpaceError(f"Space error: {output.get('error') or 'prediction failed'}")
+            return True, output.get("data") or []
+        elif kind == "close_stream":
+            return True, None
+        return False, None
+
+    def _fetch_output(self, sig: EndpointSignature, output: List[Any]) -> bytes:
+        url, data = self._output_location(sig, output)
+        if data is not None:
+            return data
+        resp = self.session.get(url, headers=self._download_headers(url), timeout=self.timeout)
+        if resp.status_code != 200:
+            raise SpaceError(f"Result download failed: HTTP {resp.status_code}")
+        return resp.content
+
+    def _download_headers(self, url: str) -> Dict[str, str]:
+        """The HF token only goes to the Space itself, not to a URL the Space handed us."""
+        space, target = urlparse(self.base_url), urlparse(url)
+        same_origin = (space.scheme, space.netloc.lower()) == (target.scheme, target.netloc.lower())
+        return self.headers if same_origin else {}
+
+    def _output_location(self, sig: EndpointSignature, output: List[Any]) -> Tuple[Optional[str], Optional[bytes]]:
+        """(download URL, None) for file outputs, (None, image bytes) for inline ones."""
+        if not output:
+            raise SpaceError("Space returned empty result")
+        first = output[0]
+        if isinstance(first, dict):
+            return first.get("url") or self._url(sig, f"/file={first.get('path')}"), None
+        if isinstance(first, str):
+            # Older Spaces return a (data URI) base64 string
+            return None, base64.b64decode(first.split(",", 1)[1] if first.startswith("data:") else first)
+        raise SpaceError(f"Unexpected Space output: {type(first).__name__}")
+
+    # -------- asyncio transport --------
+    # Same protocol over an aiohttp.ClientSession: a pending prediction costs
+    # one coroutine instead of one blocked thread. Shares the signature cache.
+
+    def _aio_timeout(self, read: float):
+        import aiohttp
+        return aiohttp.ClientTimeout(total=None, sock_connect=self.timeout[0], sock_read=read)
+
+    async def asignature(self, http) -> EndpointSignature:
+        sig = self._signature
+        if sig is not None:
+            return sig
+        async with http.get(f"{self.base_url}/config", headers=self.headers,
+                            timeout=self._aio_timeout(self.timeout[1])) as resp:
+            if resp.status != 200:
+                raise SchemaUnavailable(f"Space config unavailable: HTTP {resp.status}")
+            config = await resp.json(content_type=None)
+        sig = self._parse_config(config)
+        with self._lock:
+            self._signature = self._signature or sig
+            return self._signature
+
+    async def apredict(self, http, person: Tuple[bytes, str], garment: Tuple[bytes, str],
+                       description: str = "", progress: Callable[..., None] = _noop_progress,
+                       deadline: Optional[float] = None) -> bytes:
+        """predict() on an aiohttp session; the whole call is bounded by `deadline`."""
+        deadline = deadline or self.deadline
+        try:
+            return await asyncio.wait_for(self._apredict(http, person, garment, description, progress, deadline),
+                                          timeout=deadline)
+        except asyncio.TimeoutError:
+            raise SpaceError(f"Space did not finish within {deadline:.0f}s")
+        except SignatureMismatch:
+            self.invalidate()
+            raise
+
+    async def _apredict(self, http, person, garment, description, progress, deadline) -> bytes:
+        import aiohttp
+        sig = await self.asignature(http)
+        timeout = self._aio_timeout(self.timeout[1])
+
+        form = aiohttp.FormData()
+        names = []
+        for i, (data, mime) in enumerate([person, garment]):
+            name = f"input_{i}.{mime.split('/')[-1].replace('jpeg', 'jpg')}"
+            form.add_field("files", data, filename=name, content_type=mime)
+            names.append((name, mime))
+        async with http.post(self._url(sig, "/upload"), data=form, headers=self.headers, timeout=timeout) as resp:
+            if resp.status != 200:
+                raise SpaceError(f"Upload failed: HTTP {resp.status}: {(await resp.text())[:200]}")
+            paths = await resp.json(content_type=None)
+        person_file, garment_file = [
+            {"path": path, "orig_name": name, "mime_type": mime, "meta": {"_type": "gradio.FileData"}}
+            for path, (name, mime) in zip(paths, names)
+        ]
+        data = self._build_inputs(sig, person_file, garment_file, description)
+
+        session_hash = uuid.uuid4().hex[:11]
+        async with http.post(self._url(sig, "/queue/join"), json=self._join_payload(sig, data, session_hash),
+                             headers=self.headers, timeout=timeout) as join:
+            if join.status in (404, 422):
+                raise SignatureMismatch(f"Queue join rejected: HTTP {join.status}: {(await join.text())[:200]}")
+            if join.status != 200:
+                raise SpaceError(f"Queue join failed: HTTP {join.status}: {(await join.text())[:200]}")
+            event_id = (await join.json(content_type=None)).get("event_id")
+        progress("upstream_queued", event_id=event_id)
+
+        output = None
+        async with http.get(self._url(sig, "/queue/data"), params={"session_hash": session_hash},
+                            headers={**self.headers, "Accept": "text/event-stream"},
+                            timeout=self._aio_timeout(min(self.timeout[1], deadline))) as stream:
+            if stream.status != 200:
+                raise SpaceError(f"Queue stream failed: HTTP {stream.status}")
+            async for raw in stream.content:
+                line = raw.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                done, output = self._handle_message(json.loads(line[5:].strip()), event_id, progress)
+                if done:
+                    break
+        if output is None:
+            raise SpaceError("Queue stream closed before the result arrived")
+
+        url, inline = self._output_location(sig, output)
+        if inline is not None:
+            return inline
+        async with http.get(url, headers=self._download_headers(url), timeout=timeout) as resp:
+            if resp.status != 200:
+                raise SpaceError(f"Result download failed: HTTP {resp.status}")
+            return await resp.read()
@@ -0,0 +1,88 @@
+"""
+Worker Startup
+Lazily built, thread-safe service singletons and a startup-time report, so a
+worker opens its port quickly and the expensive objects are either built on
+first use or warmed explicitly (see gunicorn.conf.py).
+"""
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Generic, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# First import of this module: app.py imports it before anything heavy
+STARTED_AT = time.time()
+_phases: Dict[str, float] = {}
+_warmed_at: Optional[float] = None
+
+
+@contextmanager
+def phase(name: str):
+    """`with phase("imports"):` — record how long one startup step took."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases[name] = _phases.get(name, 0.0) + time.perf_counter() - started
+
+
+def mark_warm():
+    """Everything is built; log the startup report once."""
+    global _warmed_at
+    if _warmed_at is None:
+        _warmed_at = time.time()
+        steps = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in _phases.items())
+        logger.info(f"Startup: warm {_warmed_at - STARTED_AT:.2f}s after import ({steps})")
+
+
+def report() -> Dict[str, Any]:
+    return {
+        "warm": _warmed_at is not None,
+        "seconds_to_warm": round(_warmed_at - STARTED_AT, 3) if _warmed_at else None,
+        "uptime_seconds": round(time.time() - STARTED_AT, 1),
+        "phases": {name: round(seconds, 4) for name, seconds in _phases.items()},
+    }
+
+
+class Lazy(Generic[T]):
+    """
+    Stand-in for a module-level singleton: the factory runs on first attribute
+    access (once, even under concurrent first requests) and every attribute is
+    forwarded to the built object afterwards.
+    """
+
+    def __init__(self, name: str, factory: Callable[[], T]):
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_instance", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    # Accessors are underscored: any public name here would shadow the wrapped object's
+    def _resolve(self) -> T:
+        instance = self._instance
+        if instance is None:
+            with self._lock:
+                instance = self._instance
+                if instance is None:
+                    with phase(self._name):
+                        instance = self._factory()
+                    object.__setattr__(self, "_instance", instance)
+        return instance
+
+    @property
+    def _built(self) -> bool:
+        return self._instance is not None
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._resolve(), attr, value)
+
+    def __repr__(self):
+        return f"<Lazy {self._name} ({'built' if self._built else 'pending'})>"
@@ -0,0 +1,634 @@
+"""
+Offline API tests: the Flask app against the fake Space and fake Gemini
+(fake_space.py). No network or API keys needed.
+
+    python -m pytest -q test_tryon_api.py
+"""
+
+import io
+import os
+import sys
+import base64
+import tempfile
+
+import pytest
+from PIL import Image
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BACKEND_DIR)
+
+from fake_space import FakeGeminiModel, FakeSpace
+
+# Everything the app reads at import time must be set before importing it
+SPACE = FakeSpace(latency=0.05, jitter=0.0, seed=1).start()
+os.environ["TRYON_BACKENDS"] = f"space:{SPACE.url}"
+os.environ.pop("GEMINI_API_KEY", None)
+for key in ("TRYON_USER_RATE_PER_MIN", "TRYON_ANON_RATE_PER_MIN"):
+    os.environ[key] = "0"
+os.chdir(tempfile.mkdtemp(prefix="tryon-test-"))
+
+import app as app_module  # noqa: E402
+import tryon_api  # noqa: E402
+
+tryon_api.llm_engine.model = FakeGeminiModel(latency=0.0)
+
+
+def image_b64(color, size=(96, 128), mode="RGB", fmt="JPEG"):
+    buffer = io.BytesIO()
+    Image.new(mode, size, color).save(buffer, format=fmt)
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+@pytest.fixture
+def client():
+    return app_module.app.test_client()
+
+
+def tryon_body(seed, **extra):
+    return {
+        # Colours far apart: JPEG maps nearby solid colours to the same bytes
+        "person_image": image_b64((seed * 37 % 256, 90, 100)),
+        "clothing_image": image_b64((40, 70, seed * 53 % 256)),
+        "clothing_item": {"item_type": "shirt", "color": "blue"},
+        **extra,
+    }
+
+
+# =====================================================
+# RESULT CACHE
+# =====================================================
+
+def test_default_cache_hit_is_not_re_encoded(client, monkeypatch):
+    from llm_tryon_service import ImageHandle
+
+    body = tryon_body(5)
+    first = client.post("/api/tryon/process", json=body)
+    assert first.get_json()["cached"] is False
+
+    calls = []
+    real_encode, real_save = ImageHandle.encode, Image.Image.save
+    monkeypatch.setattr(ImageHandle, "encode", lambda *a, **k: calls.append("encode") or real_encode(*a, **k))
+    monkeypatch.setattr(Image.Image, "save", lambda *a, **k: calls.append("save") or real_save(*a, **k))
+    hit = client.post("/api/tryon/process", json=body)
+    assert hit.get_json()["cached"] is True
+    assert hit.get_json()["result_image"] == first.get_json()["result_image"]
+    assert calls == []
+
+
+# =====================================================
+# SINGLE-FLIGHT
+# =====================================================
+
+def test_single_flight_runs_identical_keys_once():
+    import threading
+    import time
+    from singleflight import SingleFlight
+
+    flight, started, release = SingleFlight(), threading.Event(), threading.Event()
+    runs, results = [], []
+
+    def work():
+        runs.append(1)
+        started.set()
+        release.wait(5)
+        return "result"
+
+    threads = [threading.Thread(target=lambda: results.append(flight.do("k", work))) for _ in range(4)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    while flight.coalesced < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(runs) == 1
+    assert sorted(results) == [("result", True)] * 4
+
+
+def test_single_flight_errors_reach_followers():
+    import threading
+    import time
+    from singleflight import SingleFlight
+
+    flight, started, release = SingleFlight(), threading.Event(), threading.Event()
+    errors = []
+
+    def work():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("upstream down")
+
+    def call():
+        try:
+            flight.do("k", work)
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    leader, follower = threading.Thread(target=call), threading.Thread(target=call)
+    leader.start()
+    started.wait(5)
+    follower.start()
+    while flight.coalesced < 1:
+        time.sleep(0.001)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert errors == ["upstream down"] * 2
+    assert flight.in_flight() == 0
+
+
+def test_async_single_flight_survives_a_cancelled_leader():
+    import asyncio
+    from singleflight import AsyncSingleFlight
+
+    async def scenario():
+        flight, runs = AsyncSingleFlight(), []
+
+        async def work():
+            runs.append(1)
+            await asyncio.sleep(0.05)
+            return "result"
+
+        leader = asyncio.ensure_future(flight.do("k", work))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do("k", work))
+        await asyncio.sleep(0)
+        leader.cancel()  # e.g. the leader's client disconnected
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower, runs
+
+    result, runs = asyncio.run(scenario())
+    assert result == ("result", True)
+    assert runs == [1]
+
+
+# =====================================================
+# JOBS
+# =====================================================
+
+def test_job_submit_and_poll(client):
+    response = client.post("/api/tryon/jobs", json=tryon_body(1))
+    assert response.status_code == 202
+    job_id = response.get_json()["job_id"]
+
+    response = client.get(f"/api/tryon/jobs/{job_id}?wait=10")
+    assert response.status_code == 200
+    job = response.get_json()
+    assert job["job_status"] == "succeeded"
+    assert job["result"]["status"] == "success"
+
+
+def test_async_stream_accepted_event_has_a_pollable_job_id():
+    import asyncio
+    import json
+    from aiohttp.test_utils import TestClient, TestServer
+    import tryon_async
+
+    async def scenario():
+        async with TestClient(TestServer(tryon_async.create_app())) as http:
+            response = await http.post("/api/tryon/process-stream", json=tryon_body(4))
+            events = [line for line in (await response.text()).splitlines() if line.startswith("data: ")]
+            accepted = json.loads(events[0][len("data: "):])
+            poll = await http.get(f"/api/tryon/jobs/{accepted['job_id']}?wait=10")
+            return accepted, await poll.json()
+
+    accepted, job = asyncio.run(scenario())
+    assert accepted["stage"] == "accepted"
+    assert job["job_status"] == "succeeded"
+
+
+def test_unknown_job_is_404(client):
+    assert client.get("/api/tryon/jobs/nope").status_code == 404
+
+
+# =====================================================
+# PERSON SESSIONS
+# =====================================================
+
+def test_owned_person_session_needs_its_user_id(client):
+    response = client.post("/api/tryon/persons", json={"person_image": image_b64((1, 2, 3)), "user_id": "alice"})
+    assert response.status_code == 201
+    person_id = response.get_json()["person_id"]
+
+    assert client.get(f"/api/tryon/persons/{person_id}").status_code == 404
+    assert client.get(f"/api/tryon/persons/{person_id}?user_id=bob").status_code == 404
+    assert client.delete(f"/api/tryon/persons/{person_id}").status_code == 404
+    body = {**tryon_body(3), "person_id": person_id}
+    del body["person_image"]
+    assert client.post("/api/tryon/process", json=body).status_code == 400
+    assert client.get(f"/api/tryon/persons/{person_id}?user_id=alice").status_code == 200
+
+
+def test_anonymous_person_sessions_are_capped_per_client():
+    from person_sessions import PersonSessionStore
+
+    store = PersonSessionStore(max_per_user=2, model_size=(48, 64))
+    raw = base64.b64decode(image_b64((1, 2, 3)))
+    other = store.create(raw, client="10.0.0.2")
+    mine = [store.create(raw, client="10.0.0.1") for _ in range(3)]
+
+    assert store.get(mine[0].person_id) is None  # oldest of this client's dropped
+    assert store.get(mine[2].person_id) is not None
+    assert store.get(other.person_id) is not None  # other clients are untouched
+    assert store.stats()["quota_evictions"] == 1
+
+
+# =====================================================
+# GARMENT CATALOG
+# =====================================================
+
+def test_catalog_writes_need_a_token(client, monkeypatch):
+    monkeypatch.delenv("TRYON_CATALOG_TOKEN", raising=False)
+    monkeypatch.delenv("TRYON_CATALOG_OPEN_WRITES", raising=False)
+    body = {"clothing_image": image_b64((40, 70, 200)), "clothing_id": "shirt-1"}
+    assert client.post("/api/tryon/garments", json=body).status_code == 401
+
+    monkeypatch.setenv("TRYON_CATALOG_TOKEN", "secret")
+    assert client.post("/api/tryon/garments", json=body).status_code == 401
+    auth = {"Authorization": "Bearer secret"}
+    assert client.post("/api/tryon/garments", json=body, headers=auth).status_code == 201
+    assert client.delete("/api/tryon/garments/shirt-1", headers=auth).status_code == 200
+
+
+def test_catalog_is_capped_on_disk(tmp_path):
+    from garment_catalog import CatalogFull, GarmentCatalog
+
+    catalog = GarmentCatalog(model_size=(96, 128), root=str(tmp_path))
+    first = catalog.add(base64.b64decode(image_b64((1, 2, 3))), clothing_id="a")
+    catalog.max_disk_bytes = first.bytes + 10
+    catalog.add(base64.b64decode(image_b64((1, 2, 3))), clothing_id="a")  # replacing fits
+    with pytest.raises(CatalogFull):
+        catalog.add(base64.b64decode(image_b64((3, 2, 1))), clothing_id="b")
+    assert [e.clothing_id for e in catalog.list()] == ["a"]
+    assert catalog.remove("a") and catalog.stats()["disk"]["bytes"] == 0
+
+
+def test_malformed_garment_fields_are_rejected(client, monkeypatch):
+    monkeypatch.setenv("TRYON_CATALOG_OPEN_WRITES", "1")
+    person = image_b64((120, 90, 100))
+    for garment in ({"clothing_id": 123},
+                    {"clothing_image": image_b64((40, 70, 200)), "clothing_item": "x"}):
+        body = {"person_image": person, **garment}
+        assert client.post("/api/tryon/process", json=body).status_code == 400
+        batch = {"person_image": person, "garments": [garment]}
+        assert client.post("/api/tryon/process-batch", json=batch).status_code == 400
+
+    bad_add = {"clothing_image": image_b64((40, 70, 200)), "clothing_id": 123}
+    assert client.post("/api/tryon/garments", json=bad_add).status_code == 400
+    bad_add = {"clothing_image": image_b64((40, 70, 200)), "clothing_item": ["x"]}
+    assert client.post("/api/tryon/garments", json=bad_add).status_code == 400
+
+
+# =====================================================
+# IMAGE NORMALIZATION
+# =====================================================
+
+def test_fit_to_resolution_keeps_transparent_areas_white():
+    from llm_tryon_service import ImageHandle, fit_to_resolution
+
+    garment = Image.new("RGBA", (200, 300), (0, 0, 0, 0))
+    garment.paste((200, 30, 30, 255), (50, 50, 150, 250))
+    buffer = io.BytesIO()
+    garment.save(buffer, format="PNG")
+
+    fitted = fit_to_resolution(ImageHandle.from_bytes(buffer.getvalue()), (768, 1024), "PNG")
+    pixels = fitted.array
+    assert pixels.shape == (1024, 768, 3)
+    assert tuple(pixels[512, 10]) == (255, 255, 255)  # padding
+    assert tuple(pixels[100, 384]) == (255, 255, 255)  # transparent inside the garment image
+    assert tuple(pixels[512, 384]) == (200, 30, 30)  # the garment itself
+
+
+# =====================================================
+# RESULT ENCODING
+# =====================================================
+
+def test_result_in_requested_format_is_passed_through():
+    from llm_tryon_service import ImageHandle, TryOnResult
+
+    upstream = base64.b64decode(image_b64((120, 60, 30), fmt="WEBP"))
+    handle = ImageHandle.from_bytes(upstream)
+    payload = tryon_api.build_result_payload(TryOnResult(handle, handle, 0.9, [], {}))
+    assert base64.b64decode(payload["result_image"]) == upstream  # not re-encoded as PNG
+
+    webp = tryon_api.apply_output_options(payload, tryon_api.OutputOptions(format="WEBP"))
+    assert base64.b64decode(webp["result_image"]) == upstream
+    assert "_image" not in webp
+    png = tryon_api.apply_output_options(payload, tryon_api.OutputOptions(format="PNG"))
+    again = tryon_api.apply_output_options(payload, tryon_api.OutputOptions(format="PNG"))
+    assert png["result_format"] == "png"
+    assert again["result_image"] is png["result_image"]  # rendered once, shared
+
+
+# =====================================================
+# ADMISSION
+# =====================================================
+
+def test_full_queue_is_refused_and_a_freed_slot_goes_to_the_waiter():
+    import threading
+    import time
+    from admission import AdmissionController, AdmissionRejected
+
+    controller = AdmissionController(max_in_flight=2, max_queue=1, queue_timeout=5, default_service_time=30)
+    controller.acquire(client="a")
+    controller.acquire(client="b")
+    waiter = threading.Thread(target=controller.acquire, kwargs={"client": "c"})
+    waiter.start()
+    while controller.stats()["queued"] < 1:
+        time.sleep(0.005)
+
+    with pytest.raises(AdmissionRejected) as refused:
+        controller.check()
+    assert refused.value.retry_after == 30  # (1 queued + 1) / 2 slots × 30 s
+    with pytest.raises(AdmissionRejected):
+        controller.acquire(client="d")
+
+    controller.release(service_seconds=10)
+    waiter.join(1)
+    assert not waiter.is_alive()  # handed the slot directly
+    stats = controller.stats()
+    assert (stats["in_flight"], stats["queued"]) == (2, 0)
+    assert controller.service_time == 10
+
+
+def test_queue_deadline_is_refused():
+    from admission import AdmissionController, AdmissionRejected
+
+    controller = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=0.05)
+    controller.acquire(client="a")
+    with pytest.raises(AdmissionRejected, match="No try-on slot"):
+        controller.acquire(client="b")
+    assert controller.timed_out == 1 and controller.stats()["queued"] == 0
+    controller.release()
+    assert controller.stats()["in_flight"] == 0
+
+
+def test_queue_full_rejection_spends_no_token():
+    from admission import AdmissionController, AdmissionRejected, RateLimiter
+
+    controller = AdmissionController(max_in_flight=1, max_queue=0, anon_limiter=RateLimiter(60, 2))
+    controller.acquire(client="a")  # token 1 of 2
+    with pytest.raises(AdmissionRejected):
+        controller.acquire(client="a")  # no room: refused before the bucket
+    controller.release()
+    controller.acquire(client="a")  # the second token is still there
+    controller.release()
+    assert controller.rate_limited == 0
+
+
+def test_batch_is_charged_once(client, monkeypatch):
+    from admission import AdmissionController, RateLimiter
+
+    controller = AdmissionController(max_in_flight=2, anon_limiter=RateLimiter(6, 3))
+    monkeypatch.setattr(tryon_api, "admission", controller)
+    body = {
+        "person_image": image_b64((10, 90, 100)),
+        "garments": [{"clothing_image": image_b64((40, 70, 100 + i))} for i in range(6)],
+    }
+    response = client.post("/api/tryon/process-batch", json=body)
+    assert response.status_code == 200
+    assert [r["status"] for r in response.get_json()["results"]] == ["success"] * 6
+    assert controller.limiters["anonymous"].take("anon:127.0.0.1") == 0  # 2 of 3 tokens left
+
+
+def test_coalesced_follower_retries_when_the_leader_is_refused(monkeypatch):
+    import threading
+    import time
+    from contextlib import contextmanager
+    from admission import AdmissionRejected
+
+    leading, refuse = threading.Event(), threading.Event()
+
+    class RateLimitedAlice:
+        def check(self):
+            pass
+
+        @contextmanager
+        def slot(self, user_id, client, prepaid=False):
+            if user_id == "alice":
+                leading.set()
+                refuse.wait(5)
+                raise AdmissionRejected("Too many try-ons, please slow down", 7)
+            yield
+
+    monkeypatch.setattr(tryon_api, "admission", RateLimitedAlice())
+    statuses = {}
+
+    def post(user_id):
+        body = tryon_body(6, user_id=user_id)
+        statuses[user_id] = app_module.app.test_client().post("/api/tryon/process", json=body).status_code
+
+    alice = threading.Thread(target=post, args=("alice",))
+    alice.start()
+    assert leading.wait(5), statuses
+    coalesced = tryon_api.inflight.coalesced
+    bob = threading.Thread(target=post, args=("bob",))
+    bob.start()
+    deadline = time.time() + 5
+    while tryon_api.inflight.coalesced == coalesced and time.time() < deadline:
+        time.sleep(0.005)
+    refuse.set()
+    alice.join(5)
+    bob.join(5)
+    assert statuses == {"alice": 429, "bob": 200}
+
+
+def test_forwarded_for_ignored_without_proxy_hops(monkeypatch):
+    headers = {"X-Forwarded-For": "203.0.113.9, 10.0.0.2"}
+    assert tryon_api.client_address(headers, "10.0.0.1") == "10.0.0.1"
+    monkeypatch.setattr(tryon_api, "PROXY_HOPS", 1)
+    assert tryon_api.client_address(headers, "10.0.0.1") == "10.0.0.2"
+
+
+def test_unconfigured_proxy_is_warned_about(caplog):
+    tryon_api._proxy_warned.clear()
+    tryon_api.client_address({"X-Forwarded-For": "203.0.113.9"}, "10.0.0.1")
+    assert "TRYON_PROXY_HOPS" in caplog.text
+
+
+# =====================================================
+# IDEMPOTENCY
+# =====================================================
+
+def test_idempotency_keys_are_scoped_per_user(client):
+    headers = {"Idempotency-Key": "order-1"}
+    first = client.post("/api/tryon/process", json=tryon_body(2, user_id="alice"), headers=headers)
+    replay = client.post("/api/tryon/process", json=tryon_body(2, user_id="alice"), headers=headers)
+    other = client.post("/api/tryon/process", json=tryon_body(2, user_id="bob"), headers=headers)
+    assert replay.headers.get("Idempotent-Replayed") == "true"
+    assert replay.get_json()["request_id"] == first.get_json()["request_id"]
+    assert other.status_code == 200  # not a 422 mismatch, nor alice's result
+    assert "Idempotent-Replayed" not in other.headers
+
+
+def test_failed_outcomes_are_not_stored(monkeypatch):
+    from idempotency import IdempotencyStore
+
+    store = IdempotencyStore(ttl=60)
+    monkeypatch.setattr(tryon_api, "idempotency", store)
+    future, _ = store.begin("k", "fp")
+    tryon_api.record_outcome("k", future, {"confidence": 0.0, "fallback": False})
+    assert future.result()["confidence"] == 0.0  # waiting retries still get it
+    assert not store.completed("k")
+    assert store.begin("k", "fp")[1]  # the next retry runs again
+
+
+def test_completing_keeps_the_original_expiry(monkeypatch):
+    import time
+    from idempotency import IdempotencyStore
+
+    store = IdempotencyStore(ttl=10)
+    future, _ = store.begin("k", "fp")
+    later = time.time() + 8
+    monkeypatch.setattr(time, "time", lambda: later)
+    store.complete("k", future, {"status": "success"})
+    monkeypatch.setattr(time, "time", lambda: later + 5)  # 13 s after begin()
+    assert not store.completed("k")
+
+
+# =====================================================
+# CIRCUIT BREAKER
+# =====================================================
+
+def test_breaker_opens_on_error_rate():
+    from circuit_breaker import CircuitBreaker, CircuitOpenError
+
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=4, open_seconds=30)
+    for ok in (True, True, False):
+        breaker.record_success(1.0) if ok else breaker.record_failure(1.0)
+    assert breaker.state == "closed"  # 1/3: under min_calls
+    breaker.record_failure(1.0)
+    assert breaker.state == "open"  # 2/4
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+
+def test_breaker_half_open_probe_closes_or_reopens():
+    from circuit_breaker import CircuitBreaker
+
+    breaker = CircuitBreaker(open_seconds=0, half_open_calls=1)
+    breaker._trip("test")
+    assert breaker.check() is True  # due: becomes half-open, this call is the probe
+    assert breaker.state == "half_open"
+    assert not breaker.allow()  # only one probe at a time
+    breaker.record_success(1.0)
+    assert breaker.state == "closed" and breaker.allow()
+
+    breaker._trip("test")
+    assert breaker.allow() and breaker.state == "half_open"
+    breaker.record_failure(1.0)
+    assert breaker.state == "open"
+
+
+def test_adaptive_timeout_clamps_p99():
+    from circuit_breaker import AdaptiveTimeout, LatencyTracker
+
+    tracker = LatencyTracker()
+    timeout = AdaptiveTimeout(tracker, minimum=20, maximum=120, percentile=99, multiplier=1.5, min_samples=10)
+    for _ in range(9):
+        tracker.record(30.0, ok=True)
+    assert timeout.current() == 120  # too few samples: the maximum
+    tracker.record(40.0, ok=True)
+    assert timeout.current() == 60  # p99 40 s × 1.5
+    tracker.reset()
+    for _ in range(10):
+        tracker.record(5.0, ok=True)
+    assert timeout.current() == 20  # clamped up to the minimum
+    for _ in range(10):
+        tracker.record(100.0, ok=True)
+    assert timeout.current() == 120  # clamped down to the maximum
+
+
+# =====================================================
+# SPACE CLIENT
+# =====================================================
+
+# The sse_v3 /queue/data stream of one prediction, as the Space sends it
+SSE_V3_TRANSCRIPT = [
+    {"msg": "estimation", "event_id": "ev1", "rank": 2, "queue_size": 3, "rank_eta": 41.5},
+    {"msg": "estimation", "event_id": "other", "rank": 0, "queue_size": 3, "rank_eta": 1.0},
+    {"msg": "process_starts", "event_id": "ev1", "eta": 38.0},
+    {"msg": "progress", "event_id": "ev1", "progress_data": [{"index": 3, "length": 30}]},
+    {"msg": "process_completed", "event_id": "ev1", "success": True,
+     "output": {"data": [{"path": "/tmp/gradio/abc/image.webp", "url": None}, {"path": "/tmp/gradio/abc/mask.png"}]}},
+    {"msg": "close_stream"},
+]
+
+
+def space_client(token=None):
+    import requests
+    from space_client import GradioSpaceClient
+
+    return GradioSpaceClient(SPACE.url, requests.Session(), hf_token=token)
+
+
+def test_space_config_is_parsed():
+    from fake_space import SPACE_CONFIG
+
+    sig = space_client()._parse_config(SPACE_CONFIG)
+    assert (sig.api_name, sig.fn_index, sig.trigger_id, sig.protocol) == ("/tryon", 0, 10, "sse_v3")
+    assert [t for t, _ in sig.inputs] == ["imageeditor", "image", "textbox", "checkbox", "checkbox",
+                                          "number", "number"]
+    assert sig.inputs[5] == ("number", 30)
+
+
+def test_sse_v3_transcript_is_handled():
+    from space_client import SpaceError
+
+    client, stages = space_client(), []
+    progress = lambda stage, **info: stages.append((stage, info))
+    outcomes = [client._handle_message(msg, "ev1", progress) for msg in SSE_V3_TRANSCRIPT]
+    assert outcomes[:4] == [(False, None)] * 4
+    assert outcomes[4] == (True, SSE_V3_TRANSCRIPT[4]["output"]["data"])
+    assert outcomes[5] == (True, None)
+    assert [stage for stage, _ in stages] == ["upstream_queued", "upstream_started"]  # "other" ignored
+    assert stages[0][1]["position"] == 2 and client.queue_status.eta == 41.5
+
+    failed = {"msg": "process_completed", "event_id": "ev1", "success": False, "output": {"error": "CUDA OOM"}}
+    with pytest.raises(SpaceError, match="CUDA OOM"):
+        client._handle_message(failed, "ev1", progress)
+
+
+def test_space_predict_against_the_fake_space():
+    person = base64.b64decode(image_b64((200, 10, 10)))
+    result = space_client("hf_secret").predict((person, "image/jpeg"), (person, "image/jpeg"), "a shirt")
+    assert result == person  # the fake Space returns the person image
+
+
+def test_hf_token_only_goes_to_the_space_host():
+    client = space_client("hf_secret")
+    assert client._download_headers(f"{SPACE.url}/file=/tmp/x.png") == {"Authorization": "Bearer hf_secret"}
+    assert client._download_headers("https://cdn.example.com/x.png") == {}
+    assert client._download_headers(SPACE.url.replace("http://", "https://") + "/x.png") == {}
+
+
+# =====================================================
+# BACKENDS
+# =====================================================
+
+def test_cancelled_half_open_probe_frees_its_slot():
+    import asyncio
+    from tryon_backends import TryOnBackend
+
+    class Hanging(TryOnBackend):
+        async def _acall(self, *args, **kwargs):
+            await asyncio.sleep(60)
+
+    backend = Hanging("hanging")
+    backend.breaker.open_seconds = 0
+    backend.breaker._trip("test")
+
+    async def scenario():
+        probe = asyncio.ensure_future(backend.apredict(None, None, None, None, "", None))
+        await asyncio.sleep(0.01)
+        assert backend.breaker.state == "half_open" and not backend.healthy
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+    asyncio.run(scenario())
+    assert backend.healthy
+    assert backend.breaker.allow()  # the next call may probe
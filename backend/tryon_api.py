@@ -3,67 +3,170 @@ Virtual Try-On API Routes (Raw Base64 Version)
 Fixes double-prefix issue by sending raw base64 strings.
 """
 
+import os
+import json
+import queue
+import time
+import threading
+import uuid
+import hmac
 import logging
-from flask import Blueprint, request, jsonify
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass, field
+from itertools import zip_longest
+from typing import Optional
+from flask import Blueprint, Response, g, request, jsonify, stream_with_context
 import base64
-from io import BytesIO
-from PIL import Image
 
 # Import from our new service
 from llm_tryon_service import (
     VirtualTryOnEngine,
+    LocalTryOnEngine,
     LLMRecommendationEngine,
     ClothingItem,
     ClothingType,
     BodyMeasurements,
-    image_to_base64,
-    base64_to_image,
+    ImageHandle,
+    as_image_handle,
+    emit_stage,
+    notify_when_ready,
+    import_genai,
 )
+from tryon_cache import TryOnResultCache, make_cache_key
+from singleflight import SingleFlight
+from tryon_jobs import JobManager, JobQueueFull
+from admission import AdmissionController, AdmissionRejected, tenant_of
+from idempotency import IdempotencyMismatch, IdempotencyStore, check_key
+from garment_catalog import CatalogError, CatalogFull, GarmentCatalog
+from person_sessions import PersonSessionStore
+from startup import Lazy
+import startup
+import tryon_metrics as metrics
 
 logger = logging.getLogger(__name__)
 tryon_bp = Blueprint("tryon", __name__, url_prefix="/api/tryon")
 
-# Initialize engines
-tryon_engine = VirtualTryOnEngine()
-llm_engine = LLMRecommendationEngine()
+# Engines are built on first use (or by warm()), not at import
+tryon_engine = Lazy("tryon_engine", VirtualTryOnEngine)
+preview_engine = Lazy("preview_engine", LocalTryOnEngine)  # CPU compositor for `preview=true`
+llm_engine = Lazy("llm_engine", LLMRecommendationEngine)
+result_cache = TryOnResultCache.from_env()
+inflight = SingleFlight()
+admission = AdmissionController.from_env()  # caps concurrent upstream try-ons
+idempotency = IdempotencyStore.from_env()  # Idempotency-Key -> first outcome
+job_manager = Lazy("job_manager", JobManager.from_env)
+garment_catalog = GarmentCatalog.from_env()
+person_sessions = PersonSessionStore.from_env()
+
+MAX_JOB_WAIT = 60  # seconds a GET /jobs/<id>?wait= may hold the connection
+SSE_HEARTBEAT = 15  # seconds between keep-alive comments on /process-stream
+MAX_BATCH_GARMENTS = int(os.getenv("TRYON_BATCH_MAX_GARMENTS", 12))
+BATCH_CONCURRENCY = int(os.getenv("TRYON_BATCH_CONCURRENCY", 6))
+
+@tryon_bp.record_once
+def _attach_storage(state):
+    """Put the on-disk result cache under the app's UPLOAD_FOLDER."""
+    upload_folder = state.app.config.get("UPLOAD_FOLDER", "uploads")
+    result_cache.attach_disk(os.path.join(upload_folder, "tryon_cache"))
+    garment_catalog.attach(os.path.join(upload_folder, "garment_catalog"))
+
+def preload():
+    """
+    Pre-fork half of the warm-up (Gunicorn preload_app master): heavy imports
+    only. No threads, sockets or SDK clients — those would not survive fork.
+    """
+    with startup.phase("gemini_import"):
+        if os.getenv("GEMINI_API_KEY"):
+            import_genai()
+
+def warm():
+    """
+    Per-worker warm-up: build the engines, configure Gemini and start the
+    recommendation prewarm, so the first request pays none of it.
+    """
+    preload()
+    for lazy in (tryon_engine, preview_engine, llm_engine, job_manager):
+        lazy._resolve()
+    with startup.phase("gemini_client"):
+        llm_engine.model
+    llm_engine.prewarm_from_env()
+    startup.mark_warm()
+
+@tryon_bp.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+@tryon_bp.after_request
+def _record_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule else "unknown"
+    metrics.REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, endpoint=endpoint)
+    metrics.PAYLOAD_BYTES.inc(request.content_length or 0, direction="in")
+    # Streamed responses (SSE, NDJSON) have no length up front
+    if not response.is_streamed:
+        metrics.PAYLOAD_BYTES.inc(response.calculate_content_length() or 0, direction="out")
+    return response
 
 # ============================================
 # UTILITY: VALIDATION & FORMATTING
 # ============================================
 
-def format_image_response(img_array):
+def format_image_response(image):
     """
-    Convert numpy array to Raw Base64 string.
+    Convert an ImageHandle (or numpy array) to a Raw Base64 string, in the
+    image's own encoding (PNG for pixel arrays).
     Does NOT add 'data:image/jpeg;base64,' prefix.
     """
-    if img_array is None:
+    if image is None:
         return None
         
-    # Just return the raw string so frontend can handle the prefix
-    return image_to_base64(img_array)
+    # Just return the raw string so frontend can handle the prefix;
+    # a result straight from the Space is passed through without re-encoding
+    return as_image_handle(image).base64()
 
-def validate_image(image_data):
-    """Validate and decode image data from frontend"""
+def read_image_bytes(image_data):
+    """Return the raw encoded bytes of an uploaded image (no pixel decode)"""
     try:
         if not image_data:
             return None, "No image data"
-            
+
         # Handle Data URI prefix (remove it if present)
         if isinstance(image_data, str) and "base64," in image_data:
             image_data = image_data.split("base64,")[1]
 
         if isinstance(image_data, str):
-            image_array = base64_to_image(image_data)
-        else:
-            # Direct file upload
-            image_array = np.array(Image.open(image_data))
-            image_array = cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR)
+            with metrics.stage("base64_decode"):
+                return base64.b64decode(image_data), None
+        # Direct file upload
+        return image_data.read(), None
+    except Exception as e:
+        return None, str(e)
 
-        return image_array, None
+def open_image_bytes(raw):
+    """Wrap raw bytes in a lazy ImageHandle (header check only, no pixel decode)"""
+    try:
+        with metrics.stage("image_decode"):
+            return ImageHandle.from_bytes(raw), None
+    except Exception as e:
+        return None, str(e)
+
+def decode_image_bytes(raw):
+    """Decode raw encoded image bytes to a numpy array"""
+    handle, err = open_image_bytes(raw)
+    if err:
+        return None, err
+    try:
+        return handle.array, None
     except Exception as e:
         return None, str(e)
 
+def validate_image(image_data):
+    """Validate and decode image data from frontend"""
+    raw, err = read_image_bytes(image_data)
+    if err:
+        return None, err
+    return decode_image_bytes(raw)
+
 def parse_clothing_item(data):
     """Parse clothing item data safely"""
     try:
@@ -91,6 +194,562 @@ def parse_clothing_item(data):
         logger.error(f"Error parsing clothing item: {e}")
         return ClothingItem(item_type=ClothingType.SHIRT)
 
+# ============================================
+# REQUEST PIPELINE (shared by sync and job endpoints)
+# ============================================
+
+CLOTHING_FIELDS = ("item_type", "color", "pattern", "size", "fit", "style")
+
+OUTPUT_FORMATS = {"png": "PNG", "jpeg": "JPEG", "jpg": "JPEG", "webp": "WEBP"}
+OUTPUT_MIME_TYPES = {"image/webp": "WEBP", "image/jpeg": "JPEG", "image/png": "PNG"}
+# output_profile presets; explicit output_* fields override them
+OUTPUT_PROFILES = {
+    "mobile": {"format": "WEBP", "quality": 80, "max_dimension": 1024},
+    "thumbnail": {"format": "JPEG", "quality": 75, "max_dimension": 384},
+    "original": {"format": "PNG", "quality": None, "max_dimension": None},
+}
+DEFAULT_OUTPUT_QUALITY = int(os.getenv("TRYON_OUTPUT_QUALITY", 85))
+
+@dataclass
+class OutputOptions:
+    format: str = os.getenv("TRYON_OUTPUT_FORMAT", "PNG").upper()
+    quality: Optional[int] = None
+    max_dimension: Optional[int] = None
+
+def parse_output_options(data, args=None, accept=None):
+    """
+    Result encoding from output_profile / output_format / output_quality /
+    max_dimension fields (body or query string), else from an Accept header
+    that names an image type. Raises ValueError on bad values.
+    `args` / `accept` default to the current Flask request's.
+    """
+    data = data or {}
+    args = request.args if args is None else args
+    accept = request.accept_mimetypes if accept is None else accept
+
+    def option(name):
+        value = data.get(name)
+        return value if value not in (None, "") else args.get(name)
+
+    options = OutputOptions()
+    profile = option("output_profile")
+    if profile:
+        if profile not in OUTPUT_PROFILES:
+            raise ValueError(f"Unknown output_profile: {profile}")
+        options = OutputOptions(**OUTPUT_PROFILES[profile])
+
+    fmt = option("output_format")
+    if fmt:
+        if str(fmt).lower() not in OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported output_format: {fmt}")
+        options.format = OUTPUT_FORMATS[str(fmt).lower()]
+    elif not profile:
+        # Only an explicit image type counts; */* keeps the default
+        accepted = [m for m, _ in accept if m in OUTPUT_MIME_TYPES]
+        if accepted:
+            options.format = OUTPUT_MIME_TYPES[accept.best_match(accepted)]
+
+    try:
+        quality = option("output_quality")
+        if quality is not None:
+            options.quality = max(1, min(100, int(quality)))
+        max_dimension = option("max_dimension")
+        if max_dimension is not None:
+            options.max_dimension = max(16, int(max_dimension))
+    except (TypeError, ValueError):
+        raise ValueError("output_quality and max_dimension must be integers")
+
+    # quality stays None unless asked for: a result already in the requested
+    # format is then passed through (DEFAULT_OUTPUT_QUALITY applies to re-encodes)
+    return options
+
+def apply_output_options(payload, output):
+    """
+    Render the canonical result (the upstream's own bytes) in the requested
+    format, or pass it through if it already is. The cache and single-flight
+    hold the canonical one; coalesced requests share its `_image` handle, so
+    each format is rendered once.
+    """
+    payload = dict(payload)
+    image = payload.pop("_image", None) or ImageHandle.from_base64(payload["result_image"])
+    with metrics.stage("response_encode"):
+        handle = image.render(output.format, output.quality, output.max_dimension, DEFAULT_OUTPUT_QUALITY)
+        result_image = handle.base64()
+    return {
+        **payload,
+        "result_image": result_image,
+        "result_format": handle.format.lower(),
+        "result_mime": handle.mime,
+    }
+
+def get_request_data():
+    """
+    Request body as a dict: JSON with base64 images, or multipart/form-data
+    whose image fields are file uploads (no base64 inflation, no JSON parse).
+    """
+    if request.mimetype != "multipart/form-data":
+        with metrics.stage("json_parse"):
+            return request.get_json()
+
+    with metrics.stage("json_parse"):
+        data = request.form.to_dict()
+        for field in ("clothing_item", "body_measurements", "garments"):
+            if isinstance(data.get(field), str):
+                try:
+                    data[field] = json.loads(data[field])
+                except ValueError:
+                    raise ValueError(f"{field} must be JSON")
+    # Clothing fields may also be sent flat: color=black&item_type=shirt
+    if "clothing_item" not in data:
+        data["clothing_item"] = {k: data[k] for k in CLOTHING_FIELDS if k in data}
+    # Werkzeug FileStorage objects; read_image_bytes reads them directly
+    data.update(request.files.to_dict())
+    # Batch uploads repeat the clothing_image part once per garment
+    data["clothing_images"] = request.files.getlist("clothing_image")
+    return data
+
+def wants_binary_response(data, args=None, accept=None):
+    """`response_format=binary` or an Accept header preferring an image type"""
+    args = request.args if args is None else args
+    accept = request.accept_mimetypes if accept is None else accept
+    fmt = (data or {}).get("response_format") or args.get("response_format")
+    if fmt:
+        return fmt == "binary"
+    best = accept.best_match(["application/json", *OUTPUT_MIME_TYPES])
+    return best in OUTPUT_MIME_TYPES
+
+def binary_image_response(payload, user_id=None):
+    """Result image as raw bytes; the JSON metadata moves into X-TryOn-* headers."""
+    mimetype = payload.get("result_mime", "image/png")
+    return Response(base64.b64decode(payload["result_image"]), mimetype=mimetype,
+                    headers=binary_image_headers(payload, user_id))
+
+def binary_image_headers(payload, user_id=None):
+    headers = {
+        "X-TryOn-Confidence": str(payload["confidence"]),
+        "X-TryOn-Request-Id": payload.get("request_id") or "",
+        "X-TryOn-Cached": str(bool(payload.get("cached"))).lower(),
+        "X-TryOn-Recommendations-Status": payload.get("recommendations_status", ""),
+        "X-TryOn-Backend": payload.get("backend") or "",
+    }
+    if user_id:
+        headers["X-TryOn-User-Id"] = str(user_id)
+    return headers
+
+@dataclass
+class TryOnRequest:
+    person_raw: bytes
+    clothing_raw: bytes
+    clothing_item: ClothingItem
+    body_measurements: Optional[BodyMeasurements] = None
+    user_id: Optional[str] = None
+    output: OutputOptions = field(default_factory=OutputOptions)
+    # Pre-opened person image, shared by every garment of a batch
+    person_image: Optional[ImageHandle] = None
+    # Pre-opened garment image (catalog garments)
+    clothing_image: Optional[ImageHandle] = None
+    # Instant local composite instead of the upstream try-on
+    preview: bool = False
+    # Client address: the fairness/rate-limit key when there is no user_id
+    client: Optional[str] = None
+    # Part of a batch already charged by admission.charge()
+    prepaid: bool = False
+
+# Reverse proxies in front of the app. X-Forwarded-For is only trusted for
+# that many hops (the entries those proxies appended); 0 = use the peer address.
+# Behind a proxy left at 0, every anonymous caller shares the proxy's address,
+# and so one rate-limit bucket: warned about on the first forwarded request.
+PROXY_HOPS = int(os.getenv("TRYON_PROXY_HOPS", 0))
+_proxy_warned = threading.Event()
+
+def warn_unconfigured_proxy(headers):
+    if "X-Forwarded-For" in headers and not _proxy_warned.is_set():
+        _proxy_warned.set()
+        logger.warning(
+            "⚠️ Requests carry X-Forwarded-For but TRYON_PROXY_HOPS=0: anonymous callers are keyed "
+            "on the proxy's address and share one rate limit. Set TRYON_PROXY_HOPS to the number "
+            "of proxies in front of the app (1 on Render)."
+        )
+
+def client_address(headers=None, remote=None):
+    """
+    The client's address. In Flask, request.remote_addr (already rewritten by
+    ProxyFix when TRYON_PROXY_HOPS is set, see app.py); with explicit headers
+    and peer address (aiohttp), the entry PROXY_HOPS from the right of
+    X-Forwarded-For, else the peer address.
+    """
+    if not PROXY_HOPS:
+        warn_unconfigured_proxy(request.headers if headers is None else headers)
+    if headers is None:
+        return request.remote_addr
+    if PROXY_HOPS:
+        forwarded = [hop.strip() for hop in headers.get("X-Forwarded-For", "").split(",") if hop.strip()]
+        if len(forwarded) >= PROXY_HOPS:
+            return forwarded[-PROXY_HOPS]
+    return remote
+
+def wants_preview(data, args=None):
+    """`preview=true` in the body or the query string"""
+    args = request.args if args is None else args
+    value = (data or {}).get("preview", args.get("preview", ""))
+    return str(value).lower() in ("1", "true")
+
+def parse_body_measurements(bm):
+    """Parse optional body measurements; returns None if malformed"""
+    try:
+        return BodyMeasurements(
+            height=float(bm.get("height", 170)),
+            chest=float(bm.get("chest", 0)),
+            waist=float(bm.get("waist", 0)),
+            hips=float(bm.get("hips", 0)),
+            shoulder_width=float(bm.get("shoulder_width", 0)),
+            body_shape=bm.get("body_shape", "regular")
+        )
+    except Exception as e:
+        logger.warning(f"Failed to parse body measurements: {e}")
+        return None
+
+def resolve_person(data):
+    """
+    (person_raw, person_image) from an uploaded person_image or a person_id
+    session (already normalized). Raises ValueError for unknown/expired ids.
+    """
+    if data.get("person_id"):
+        session = person_sessions.get(str(data["person_id"]), data.get("user_id"))
+        if session is None:
+            raise ValueError("Unknown or expired person_id")
+        return session.image.encode(), session.image
+
+    person_raw, p_err = read_image_bytes(data["person_image"])
+    if p_err:
+        raise ValueError(f"Image Error: {p_err}")
+    return person_raw, None
+
+def resolve_garment(data):
+    """
+    (clothing_raw, clothing_image, clothing_item) from either an uploaded
+    clothing_image or a catalog clothing_id. Request clothing_item fields
+    override the catalog's.
+    """
+    if "clothing_id" in data and not isinstance(data["clothing_id"], str):
+        raise ValueError("clothing_id must be a string")
+    if not isinstance(data.get("clothing_item") or {}, dict):
+        raise ValueError("clothing_item must be an object")
+    if data.get("clothing_id"):
+        try:
+            entry, handle = garment_catalog.image(data["clothing_id"])
+        except CatalogError as e:
+            raise ValueError(str(e))
+        fields = {**entry.clothing_item, **(data.get("clothing_item") or {})}
+        return handle.encode(), handle, parse_clothing_item(fields)
+
+    clothing_raw, c_err = read_image_bytes(data["clothing_image"])
+    if c_err:
+        raise ValueError(f"Image Error: {c_err}")
+    return clothing_raw, None, parse_clothing_item(data.get("clothing_item", {}))
+
+def parse_tryon_request(data, args=None, accept=None, client=None):
+    """Validate a JSON try-on body. Raises ValueError on bad input."""
+    # 1. Validate Inputs
+    if not data or not ("person_image" in data or "person_id" in data) \
+            or not ("clothing_image" in data or "clothing_id" in data):
+        raise ValueError("Missing images")
+
+    # 2. Read raw image bytes (decoded to pixels only on a cache miss)
+    person_raw, person_image = resolve_person(data)
+
+    # 3. Parse Details (catalog garments bring their stored image and fields)
+    clothing_raw, clothing_image, clothing_item = resolve_garment(data)
+
+    # 4. Parse body measurements (optional)
+    body_measurements = None
+    if "body_measurements" in data:
+        body_measurements = parse_body_measurements(data["body_measurements"])
+
+    # 5. Get user_id for storage tracking (optional)
+    return TryOnRequest(
+        person_raw=person_raw,
+        clothing_raw=clothing_raw,
+        clothing_item=clothing_item,
+        body_measurements=body_measurements,
+        user_id=data.get("user_id", None),
+        output=parse_output_options(data, args, accept),
+        person_image=person_image,
+        clothing_image=clothing_image,
+        preview=wants_preview(data, args),
+        client=client or client_address(),
+    )
+
+# Payload fields shared by every response for the same inputs
+CACHED_FIELDS = ("status", "result_image", "confidence", "fit_analysis", "backend", "fallback")
+
+def open_request_images(tryon_req):
+    """(person, clothing) ImageHandles of a parsed request. Raises ValueError."""
+    person_img, p_err = tryon_req.person_image, None
+    if person_img is None:
+        person_img, p_err = open_image_bytes(tryon_req.person_raw)
+    clothing_img, c_err = tryon_req.clothing_image, None
+    if clothing_img is None:
+        clothing_img, c_err = open_image_bytes(tryon_req.clothing_raw)
+    if p_err or c_err:
+        raise ValueError(f"Image Error: {p_err or c_err}")
+    return person_img, clothing_img
+
+def run_engine(engine, tryon_req, on_stage=None):
+    """Open the images and run one engine's process_tryon."""
+    person_img, clothing_img = open_request_images(tryon_req)
+    return engine.process_tryon(
+        person_img,
+        clothing_img,
+        tryon_req.clothing_item,
+        tryon_req.body_measurements,
+        llm_engine,  # Recommendations run alongside the try-on
+        on_stage=on_stage,
+    )
+
+def build_result_payload(result):
+    image = as_image_handle(result.result_image)
+    with metrics.stage("response_encode"):
+        if image.format is None:
+            # Pixel arrays (local compositor) are encoded once, as PNG bytes
+            image = ImageHandle.from_bytes(image.encode("PNG"))
+        result_image = format_image_response(image)
+    return {
+        "status": "success",
+        "result_image": result_image,
+        "_image": image,  # canonical handle for apply_output_options (never serialized)
+        "confidence": result.confidence,
+        "fit_analysis": result.fit_analysis,
+        "backend": result.backend,
+        "fallback": result.fallback,
+        "request_id": result.request_id,
+        "recommendations": result.recommendations,
+        "recommendations_status": "ready" if result.recommendations_ready else "pending",
+    }
+
+def cached_payload(payload, request_id, future, on_stage=None):
+    """A cache hit's payload, with this request's own recommendations."""
+    notify_when_ready(future, on_stage)
+    ready = future.done()
+    return {
+        **payload,
+        "request_id": request_id,
+        "recommendations": future.result() if ready else [],
+        "recommendations_status": "ready" if ready else "pending",
+        "cached": True,
+        "coalesced": False,
+    }
+
+def cache_result(cache_key, result, payload):
+    # Only successful try-ons are cached (last-resort previews are not,
+    # so the next request gets another chance at a real backend);
+    # recommendations are per request
+    if result.confidence > 0 and not result.fallback:
+        # Stored in the default output encoding, so a default hit is passed
+        # through as-is. A default request has already rendered it on the
+        # shared handle; anything else renders it here, once per result.
+        default = OutputOptions()
+        with metrics.stage("response_encode"):
+            image = payload["_image"].render(default.format, default.quality, default.max_dimension,
+                                             DEFAULT_OUTPUT_QUALITY)
+        result_cache.set(cache_key, {**{k: payload[k] for k in CACHED_FIELDS}, "result_image": image.base64()})
+
+def run_tryon_request(tryon_req, on_stage=None):
+    """
+    Produce the response payload for a parsed request (cache → single-flight → engine).
+    `on_stage(stage, info)` receives progress events (see llm_tryon_service.emit_stage).
+    """
+    if tryon_req.preview:
+        # Local previews take milliseconds: no cache, no coalescing
+        return apply_output_options({
+            **build_result_payload(run_engine(preview_engine, tryon_req, on_stage)),
+            "cached": False,
+            "coalesced": False,
+        }, tryon_req.output)
+
+    # 6. Serve repeated submissions from the result cache
+    cache_key = make_cache_key(tryon_req.person_raw, tryon_req.clothing_raw, tryon_req.clothing_item)
+    payload = result_cache.get(cache_key)
+    metrics.CACHE.inc(outcome="hit" if payload is not None else "miss")
+    if payload is not None:
+        logger.info(f"Result cache hit: {cache_key[:12]}")
+        emit_stage(on_stage, "cache_hit")
+        request_id = uuid.uuid4().hex
+        future = llm_engine.submit_recommendations(
+            request_id, tryon_req.clothing_item, tryon_req.body_measurements
+        )
+        return apply_output_options(cached_payload(payload, request_id, future, on_stage), tryon_req.output)
+
+    # 7. Process via HuggingFace; identical concurrent requests share one call.
+    # Its admission is charged to the leader's user: followers that share a
+    # leader's AdmissionRejected (another user's rate limit or queue deadline)
+    # go again, leading themselves if no one else is by then.
+    while True:
+        led = []
+
+        def run_tryon():
+            led.append(True)
+            with admission.slot(tryon_req.user_id, tryon_req.client, tryon_req.prepaid):
+                result = run_engine(tryon_engine, tryon_req, on_stage)
+            payload = build_result_payload(result)
+            cache_result(cache_key, result, payload)
+            return payload
+
+        try:
+            payload, shared = inflight.do(cache_key, run_tryon)
+            break
+        except AdmissionRejected:
+            if led:
+                raise
+            logger.info(f"Coalesced leader was refused admission, retrying: {cache_key[:12]}")
+    return apply_output_options({**payload, "cached": False, "coalesced": shared}, tryon_req.output)
+
+def idempotency_key(headers=None):
+    """The request's Idempotency-Key header, or None. Raises ValueError."""
+    headers = request.headers if headers is None else headers
+    return check_key(headers.get("Idempotency-Key"))
+
+def request_fingerprint(tryon_req):
+    """Everything that shapes a /process response, so a reused key can be told apart."""
+    return make_cache_key(tryon_req.person_raw, tryon_req.clothing_raw, tryon_req.clothing_item, {
+        "body_measurements": asdict(tryon_req.body_measurements) if tryon_req.body_measurements else None,
+        "output": asdict(tryon_req.output),
+        "preview": tryon_req.preview,
+        "user_id": tryon_req.user_id,
+    })
+
+def admission_overload(key):
+    """
+    admission.check(), for a request with this Idempotency-Key (or None).
+    A keyed request may be a retry whose outcome is stored, which needs no
+    slot: its rejection is returned, to raise once the key is known to be new.
+    """
+    try:
+        admission.check()
+    except AdmissionRejected as e:
+        if not key:
+            raise
+        return e
+    return None
+
+def scoped_idempotency_key(key, tryon_req):
+    """Keys are per caller (user_id, else client address): one cannot replay another's result."""
+    return f"{tenant_of(tryon_req.user_id, tryon_req.client)[1]}:{key}"
+
+def record_outcome(key, future, payload, preview=False):
+    """
+    Store a successful payload under its key. Failed try-ons and last-resort
+    results (as in cache_result; previews always come from the local
+    compositor) only go to the retries already waiting; the next one runs again.
+    """
+    if payload["confidence"] > 0 and (preview or not payload.get("fallback")):
+        idempotency.complete(key, future, payload)
+    else:
+        idempotency.discard(key, future, payload)
+
+def run_idempotent_request(key, tryon_req):
+    """run_tryon_request() once per scoped Idempotency-Key. Returns (payload, replayed)."""
+    future, owner = idempotency.begin(key, request_fingerprint(tryon_req))
+    if not owner:
+        return future.result(), True
+    try:
+        payload = run_tryon_request(tryon_req)
+    except BaseException as e:
+        idempotency.fail(key, future, e)
+        raise
+    record_outcome(key, future, payload, tryon_req.preview)
+    return payload, False
+
+def parse_batch_request(data, args=None, accept=None, client=None):
+    """
+    One person image + a list of garments, each {clothing_image, clothing_item}
+    or a catalog {clothing_id}. Multipart batches send one clothing_image file
+    per garment and an optional `garments` JSON list with the matching
+    clothing_item metadata, followed by any catalog garments.
+    """
+    if not data or not ("person_image" in data or "person_id" in data):
+        raise ValueError("Missing person image")
+
+    garments = data.get("garments") or []
+    files = data.get("clothing_images") or []
+    if files:
+        uploaded = [g for g in garments if not (isinstance(g, dict) and g.get("clothing_id"))]
+        garments = [
+            {**(meta or {}), "clothing_image": file}
+            for file, meta in zip_longest(files, uploaded[:len(files)])
+        ] + [g for g in garments if isinstance(g, dict) and g.get("clothing_id")]
+    if not isinstance(garments, list) or not garments:
+        raise ValueError("garments must be a non-empty list")
+    if len(garments) > MAX_BATCH_GARMENTS:
+        raise ValueError(f"At most {MAX_BATCH_GARMENTS} garments per batch")
+
+    # The person image is read and opened once for the whole batch
+    person_raw, person_image = resolve_person(data)
+    if person_image is None:
+        person_image, p_err = open_image_bytes(person_raw)
+        if p_err:
+            raise ValueError(f"Image Error: {p_err}")
+
+    body_measurements = None
+    if "body_measurements" in data:
+        body_measurements = parse_body_measurements(data["body_measurements"])
+    output = parse_output_options(data, args, accept)
+    preview = wants_preview(data, args)
+    client = client or client_address()
+
+    batch = []
+    for i, garment in enumerate(garments):
+        if not isinstance(garment, dict) or not ("clothing_image" in garment or "clothing_id" in garment):
+            raise ValueError(f"garments[{i}]: missing clothing_image or clothing_id")
+        try:
+            clothing_raw, clothing_image, clothing_item = resolve_garment(garment)
+        except ValueError as e:
+            raise ValueError(f"garments[{i}]: {e}")
+        batch.append(TryOnRequest(
+            person_raw=person_raw,
+            clothing_raw=clothing_raw,
+            clothing_item=clothing_item,
+            body_measurements=body_measurements,
+            user_id=data.get("user_id", None),
+            output=output,
+            person_image=person_image,
+            clothing_image=clothing_image,
+            preview=preview,
+            client=client,
+        ))
+    return batch
+
+def admit_batch(batch):
+    """
+    Admit a batch as one request: a single capacity check and rate-limit
+    token, refused up front. Its try-ons then queue without further charges.
+    Raises AdmissionRejected.
+    """
+    if not batch or batch[0].preview:
+        return  # previews never take an upstream slot
+    admission.charge(batch[0].user_id, batch[0].client)
+    for tryon_req in batch:
+        tryon_req.prepaid = True
+
+def iter_batch_results(batch):
+    """Run a batch with bounded concurrency, yielding results as they finish."""
+    executor = ThreadPoolExecutor(
+        max_workers=min(len(batch), BATCH_CONCURRENCY),
+        thread_name_prefix="tryon-batch",
+    )
+    try:
+        futures = {executor.submit(run_tryon_request, req): i for i, req in enumerate(batch)}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                yield {"index": index, **future.result()}
+            except Exception as e:
+                logger.error(f"Batch garment {index} failed: {e}")
+                yield {"index": index, "status": "error", "message": str(e)}
+    finally:
+        # A disconnected stream stops waiting; finished calls still fill the cache
+        executor.shutdown(wait=False)
+
 # ============================================
 # API ENDPOINTS
 # ============================================
@@ -99,71 +758,361 @@ def parse_clothing_item(data):
 def health_check():
     return jsonify({"status": "healthy", "service": "HuggingFace VTON"}), 200
 
+@tryon_bp.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    return jsonify({
+        "status": "success",
+        "cache": result_cache.stats(),
+        "inflight": inflight.stats(),
+        "admission": admission.stats(),
+        "idempotency": idempotency.stats(),
+        "jobs": job_manager.stats(),
+        "recommendations": llm_engine.cache_stats(),
+        "upstream": tryon_engine.stats(),
+        "catalog": garment_catalog.stats(),
+        "persons": person_sessions.stats(),
+    }), 200
+
+def overloaded_response(e):
+    """429 for an AdmissionRejected, with its Retry-After."""
+    return jsonify({
+        "status": "error",
+        "message": str(e),
+        "retry_after": e.retry_after,
+    }), 429, {"Retry-After": str(e.retry_after)}
+
 @tryon_bp.route("/process", methods=["POST"])
 def process_virtual_tryon():
     try:
-        data = request.get_json()
-        
-        # 1. Validate Inputs
-        if not data or "person_image" not in data or "clothing_image" not in data:
-            return jsonify({"status": "error", "message": "Missing images"}), 400
+        replayed = False
+        try:
+            key = idempotency_key()
+            overloaded = admission_overload(key)  # before the (up to 50 MB) body is read
+            data = get_request_data()
+            tryon_req = parse_tryon_request(data)
+            if key:
+                key = scoped_idempotency_key(key, tryon_req)
+                # A retry whose outcome is already stored needs no upstream slot
+                if overloaded and not idempotency.completed(key):
+                    raise overloaded
+                payload, replayed = run_idempotent_request(key, tryon_req)
+            else:
+                payload = run_tryon_request(tryon_req)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        except AdmissionRejected as e:
+            return overloaded_response(e)
+        except IdempotencyMismatch as e:
+            return jsonify({"status": "error", "message": str(e)}), 422
 
-        # 2. Decode Images
-        person_img, p_err = validate_image(data["person_image"])
-        clothing_img, c_err = validate_image(data["clothing_image"])
-        
-        if p_err or c_err:
-            return jsonify({"status": "error", "message": f"Image Error: {p_err or c_err}"}), 400
+        headers = {"Idempotent-Replayed": "true"} if replayed else {}
+        if wants_binary_response(data):
+            response = binary_image_response(payload, tryon_req.user_id)
+            response.headers.update(headers)
+            return response, 200
 
-        # 3. Parse Details
-        clothing_item = parse_clothing_item(data.get("clothing_item", {}))
-        
-        # 4. Parse body measurements (optional)
-        body_measurements = None
-        if "body_measurements" in data:
+        # user_id is echoed back for frontend tracking
+        return jsonify({**payload, "user_id": tryon_req.user_id}), 200, headers
+
+    except Exception as e:
+        logger.error(f"API Error: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@tryon_bp.route("/process-stream", methods=["POST"])
+def process_tryon_stream():
+    """
+    Same request as /process, answered as Server-Sent Events: `stage` events
+    with timestamps while the try-on runs, then `result` (or `error`), a final
+    recommendations_ready stage, and `done`. Comment heartbeats keep idle
+    connections open so clients don't time out and retry.
+    """
+    try:
+        try:
+            admission.check()
+            tryon_req = parse_tryon_request(get_request_data())
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        except AdmissionRejected as e:
+            return overloaded_response(e)
+
+        events = queue.Queue()
+        started = time.time()
+
+        def on_stage(stage, info):
+            events.put(("stage", {"stage": stage, "elapsed": round(info["t"] - started, 3), **info}))
+
+        def run():
+            # Runs as a regular job, so the result can also be polled by job_id
             try:
-                bm = data["body_measurements"]
-                body_measurements = BodyMeasurements(
-                    height=float(bm.get("height", 170)),
-                    chest=float(bm.get("chest", 0)),
-                    waist=float(bm.get("waist", 0)),
-                    hips=float(bm.get("hips", 0)),
-                    shoulder_width=float(bm.get("shoulder_width", 0)),
-                    body_shape=bm.get("body_shape", "regular")
-                )
+                payload = {**run_tryon_request(tryon_req, on_stage), "user_id": tryon_req.user_id}
             except Exception as e:
-                logger.warning(f"Failed to parse body measurements: {e}")
-        
-        # 5. Get user_id for storage tracking (optional)
-        user_id = data.get("user_id", None)
-        
-        # 6. Process via HuggingFace with AI recommendations
-        result = tryon_engine.process_tryon(
-            person_img,
-            clothing_img,
-            clothing_item,
-            body_measurements,
-            llm_engine  # Pass the LLM engine for recommendations
+                error = {"status": "error", "message": str(e)}
+                if isinstance(e, AdmissionRejected):
+                    error["retry_after"] = e.retry_after
+                events.put(("error", error))
+                raise
+            events.put(("result", payload))
+            return payload
+
+        try:
+            job = job_manager.submit(run, user_id=tryon_req.user_id)
+        except JobQueueFull as e:
+            return jsonify({"status": "error", "message": str(e)}), 503
+
+        def generate():
+            yield sse_event("stage", {"stage": "accepted", "job_id": job.id, "t": started, "elapsed": 0.0})
+            result, recs_done = None, False
+            deadline = None
+            while True:
+                if result is not None and (recs_done or time.time() >= deadline):
+                    break
+                try:
+                    event, data = events.get(timeout=SSE_HEARTBEAT)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                if event == "stage" and data["stage"] == "recommendations_ready":
+                    recs_done = True
+                yield sse_event(event, data)
+                if event == "error":
+                    break
+                if event == "result":
+                    result = data
+                    recs_done = recs_done or data.get("recommendations_status") == "ready"
+                    deadline = time.time() + llm_engine.timeout
+
+            # Coalesced requests never see the leader's recommendation callback
+            if result is not None and not recs_done:
+                found = llm_engine.get_recommendations(result["request_id"], wait=max(0, deadline - time.time()))
+                if found:
+                    yield sse_event("stage", {
+                        "stage": "recommendations_ready",
+                        "t": time.time(),
+                        "elapsed": round(time.time() - started, 3),
+                        "recommendations": found[1],
+                    })
+            yield sse_event("done", {"elapsed": round(time.time() - started, 3)})
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
         )
 
-        # 7. Return Response
+    except Exception as e:
+        logger.error(f"API Error: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@tryon_bp.route("/process-batch", methods=["POST"])
+def process_batch_tryon():
+    """
+    One person against many garments. Returns all results at once, or with
+    `stream=true` one NDJSON line per garment as soon as it finishes.
+    """
+    try:
+        try:
+            admission.check()
+            data = get_request_data()
+            batch = parse_batch_request(data)
+            admit_batch(batch)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        except AdmissionRejected as e:
+            return overloaded_response(e)
+
+        user_id = data.get("user_id", None)
+        stream = str(data.get("stream", request.args.get("stream", ""))).lower() in ("1", "true")
+        if stream:
+            def generate():
+                for result in iter_batch_results(batch):
+                    yield json.dumps(result) + "\n"
+            return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+        results = sorted(iter_batch_results(batch), key=lambda r: r["index"])
+        return jsonify({"status": "success", "results": results, "user_id": user_id}), 200
+
+    except Exception as e:
+        logger.error(f"API Error: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@tryon_bp.route("/persons", methods=["POST"])
+def create_person_session():
+    """
+    Upload a person photo once (JSON or multipart `person_image`, optional
+    user_id); later try-ons send the returned person_id instead.
+    """
+    try:
+        data = get_request_data()
+        if not data or "person_image" not in data:
+            return jsonify({"status": "error", "message": "Missing person_image"}), 400
+        raw, err = read_image_bytes(data["person_image"])
+        if err:
+            return jsonify({"status": "error", "message": f"Image Error: {err}"}), 400
+        try:
+            session = person_sessions.create(raw, data.get("user_id"), client_address())
+        except Exception as e:
+            return jsonify({"status": "error", "message": f"Image Error: {e}"}), 400
+        return jsonify({"status": "success", **session.to_dict()}), 201
+
+    except Exception as e:
+        logger.error(f"API Error: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@tryon_bp.route("/persons/<person_id>", methods=["GET"])
+def get_person_session(person_id):
+    session = person_sessions.get(person_id, request.args.get("user_id"))
+    if session is None:
+        return jsonify({"status": "error", "message": "Unknown or expired person_id"}), 404
+    return jsonify({"status": "success", **session.to_dict()}), 200
+
+@tryon_bp.route("/persons/<person_id>", methods=["DELETE"])
+def delete_person_session(person_id):
+    if not person_sessions.delete(person_id, request.args.get("user_id")):
+        return jsonify({"status": "error", "message": "Unknown or expired person_id"}), 404
+    return jsonify({"status": "success", "person_id": person_id}), 200
+
+def catalog_write_allowed():
+    """
+    Catalog writes need `Authorization: Bearer $TRYON_CATALOG_TOKEN`. Without
+    a token they are refused, unless TRYON_CATALOG_OPEN_WRITES=1 opts in.
+    """
+    token = os.getenv("TRYON_CATALOG_TOKEN")
+    if not token:
+        return os.getenv("TRYON_CATALOG_OPEN_WRITES", "0").lower() in ("1", "true")
+    return hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}")
+
+@tryon_bp.route("/garments", methods=["GET"])
+def list_garments():
+    return jsonify({
+        "status": "success",
+        "garments": [entry.to_dict() for entry in garment_catalog.list()],
+    }), 200
+
+@tryon_bp.route("/garments", methods=["POST"])
+def add_garment():
+    """
+    Ingest a garment once: clothing_image + clothing_item fields (JSON or
+    multipart), optional clothing_id and name. Try-ons then send clothing_id.
+    """
+    if not catalog_write_allowed():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    try:
+        data = get_request_data()
+        if not data or "clothing_image" not in data:
+            return jsonify({"status": "error", "message": "Missing clothing_image"}), 400
+        raw, err = read_image_bytes(data["clothing_image"])
+        if err:
+            return jsonify({"status": "error", "message": f"Image Error: {err}"}), 400
+        try:
+            entry = garment_catalog.add(
+                raw,
+                data.get("clothing_item") or {},
+                clothing_id=data.get("clothing_id") or None,
+                name=data.get("name", ""),
+            )
+        except CatalogFull as e:
+            return jsonify({"status": "error", "message": str(e)}), 507
+        except CatalogError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        return jsonify({"status": "success", **entry.to_dict()}), 201
+
+    except Exception as e:
+        logger.error(f"API Error: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@tryon_bp.route("/garments/<clothing_id>", methods=["GET"])
+def get_garment(clothing_id):
+    entry = garment_catalog.get(clothing_id)
+    if entry is None:
+        return jsonify({"status": "error", "message": "Unknown clothing_id"}), 404
+    return jsonify({"status": "success", **entry.to_dict()}), 200
+
+@tryon_bp.route("/garments/<clothing_id>", methods=["DELETE"])
+def delete_garment(clothing_id):
+    if not catalog_write_allowed():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    if not garment_catalog.remove(clothing_id):
+        return jsonify({"status": "error", "message": "Unknown clothing_id"}), 404
+    return jsonify({"status": "success", "clothing_id": clothing_id}), 200
+
+@tryon_bp.route("/jobs", methods=["POST"])
+def submit_tryon_job():
+    """Queue a try-on and return immediately; poll /jobs/<id> for the result."""
+    try:
+        try:
+            admission.check()
+            tryon_req = parse_tryon_request(get_request_data())
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        except AdmissionRejected as e:
+            return overloaded_response(e)
+
+        try:
+            job = job_manager.submit(lambda: run_tryon_request(tryon_req), user_id=tryon_req.user_id)
+        except JobQueueFull as e:
+            return jsonify({"status": "error", "message": str(e)}), 503
+
         return jsonify({
             "status": "success",
-            "result_image": format_image_response(result.result_image),
-            "confidence": result.confidence,
-            "fit_analysis": result.fit_analysis,
-            "recommendations": result.recommendations,
-            "user_id": user_id  # Echo back for frontend tracking
-        }), 200
+            **job.to_dict(),
+            "status_url": f"{tryon_bp.url_prefix}/jobs/{job.id}",
+        }), 202
 
     except Exception as e:
         logger.error(f"API Error: {str(e)}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
-@tryon_bp.route("/recommendations", methods=["POST"])
+@tryon_bp.route("/jobs/<job_id>", methods=["GET"])
+def get_tryon_job(job_id):
+    """Job status/result; ?wait=<seconds> long-polls until the job finishes."""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unknown job id"}), 404
+
+    try:
+        wait = min(float(request.args.get("wait", 0)), MAX_JOB_WAIT)
+    except ValueError:
+        return jsonify({"status": "error", "message": "wait must be a number"}), 400
+    if wait > 0:
+        job.wait(wait)
+
+    return jsonify({"status": "success", **job.to_dict()}), 200
+
+@tryon_bp.route("/recommendations", methods=["GET", "POST"])
 def get_recommendations():
-    # Mock endpoint to prevent 404s in frontend
+    """
+    Fetch the recommendations started by a try-on, keyed by its request_id.
+    Optional `wait` long-polls (bounded by the Gemini deadline).
+    Without a request_id, generates directly from `clothing_item`.
+    """
+    data = request.get_json(silent=True) or {}
+    request_id = data.get("request_id") or request.args.get("request_id")
+
+    if not request_id:
+        clothing_item = parse_clothing_item(data.get("clothing_item", {}))
+        body_measurements = None
+        if "body_measurements" in data:
+            body_measurements = parse_body_measurements(data["body_measurements"])
+        request_id = uuid.uuid4().hex
+        llm_engine.submit_recommendations(request_id, clothing_item, body_measurements)
+        wait = llm_engine.timeout
+    else:
+        try:
+            wait = float(data.get("wait", request.args.get("wait", 0)))
+        except (TypeError, ValueError):
+            return jsonify({"status": "error", "message": "wait must be a number"}), 400
+
+    found = llm_engine.get_recommendations(request_id, wait=wait)
+    if found is None:
+        return jsonify({"status": "error", "message": "Unknown request id"}), 404
+
+    ready, recommendations = found
     return jsonify({
         "status": "success",
-        "recommendations": ["Great choice!", "Matches your style."]
-    }), 200
\ No newline at end of file
+        "request_id": request_id,
+        "recommendations_status": "ready" if ready else "pending",
+        "recommendations": recommendations,
+    }), 200
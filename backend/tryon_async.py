@@ -0,0 +1,586 @@
+"""
+Asyncio Try-On Server
+The same /api/tryon API as tryon_api, served by aiohttp. A pending try-on is
+a coroutine awaiting the Space (and Gemini) instead of a blocked thread, so
+one process holds thousands of them; image decode/encode runs on a bounded
+thread pool. Endpoints without a long upstream wait (jobs, persons, garments,
+/health, /metrics) are answered by the Flask app through a WSGI bridge.
+
+    python tryon_async.py
+    gunicorn tryon_async:app_factory --worker-class aiohttp.GunicornWebWorker
+"""
+
+import startup  # first: marks the start of the startup-time report
+import os
+import json
+import time
+import uuid
+import base64
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import aiohttp
+from aiohttp import web
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Response as WSGIResponse
+
+from app import EXPOSED_HEADERS, app as flask_app  # loads .env, builds the Flask app
+import tryon_api
+from tryon_api import (
+    BATCH_CONCURRENCY,
+    CLOTHING_FIELDS,
+    SSE_HEARTBEAT,
+    admission,
+    admission_overload,
+    admit_batch,
+    apply_output_options,
+    binary_image_headers,
+    client_address,
+    build_result_payload,
+    cache_result,
+    cached_payload,
+    garment_catalog,
+    idempotency,
+    idempotency_key,
+    llm_engine,
+    open_request_images,
+    parse_batch_request,
+    parse_body_measurements,
+    parse_clothing_item,
+    parse_tryon_request,
+    person_sessions,
+    record_outcome,
+    request_fingerprint,
+    result_cache,
+    run_tryon_request,
+    scoped_idempotency_key,
+    sse_event,
+    tryon_engine,
+    wants_binary_response,
+)
+from admission import AdmissionRejected
+from idempotency import IdempotencyMismatch
+from tryon_jobs import JobQueueFull
+from llm_tryon_service import emit_stage
+from singleflight import AsyncSingleFlight
+from tryon_cache import make_cache_key
+import tryon_metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+CPU_WORKERS = int(os.getenv("TRYON_ASYNC_CPU_WORKERS", os.cpu_count() or 4))
+WSGI_THREADS = int(os.getenv("TRYON_ASYNC_WSGI_THREADS", 16))
+UPSTREAM_CONNECTIONS = int(os.getenv("TRYON_ASYNC_UPSTREAM_CONNECTIONS", 4096))
+INLINE_JSON_BYTES = 64 * 1024  # smaller bodies are parsed on the loop itself
+
+inflight = AsyncSingleFlight()
+
+CPU = web.AppKey("cpu", ThreadPoolExecutor)
+WSGI = web.AppKey("wsgi", ThreadPoolExecutor)
+HTTP = web.AppKey("http", aiohttp.ClientSession)
+
+
+def run_cpu(app, fn, *args, **kwargs):
+    """Run blocking image/JSON work on the bounded CPU pool."""
+    return asyncio.get_running_loop().run_in_executor(app[CPU], partial(fn, *args, **kwargs))
+
+
+def error_response(message, status):
+    return web.json_response({"status": "error", "message": message}, status=status)
+
+
+def overloaded_response(e):
+    return web.json_response(
+        {"status": "error", "message": str(e), "retry_after": e.retry_after},
+        status=429,
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+
+def accept_of(request) -> MIMEAccept:
+    return parse_accept_header(request.headers.get("Accept"), MIMEAccept)
+
+
+def client_of(request) -> str:
+    return client_address(request.headers, request.remote) or "unknown"
+
+
+# ============================================
+# REQUEST PIPELINE
+# ============================================
+
+def _parse_json(body: bytes):
+    with metrics.stage("json_parse"):
+        return json.loads(body)
+
+
+async def read_request_data(request):
+    """tryon_api.get_request_data() for aiohttp: the same dict, file fields as file objects."""
+    if request.content_type != "multipart/form-data":
+        body = await request.read()
+        if not body:
+            return None
+        try:
+            if len(body) <= INLINE_JSON_BYTES:
+                return _parse_json(body)
+            return await run_cpu(request.app, _parse_json, body)
+        except ValueError:
+            raise ValueError("Request body must be JSON")
+
+    form = await request.post()
+    data, files, clothing_images = {}, {}, []
+    for key, value in form.items():
+        if isinstance(value, web.FileField):
+            files.setdefault(key, value.file)
+            if key == "clothing_image":
+                clothing_images.append(value.file)
+        else:
+            data.setdefault(key, value)
+    for name in ("clothing_item", "body_measurements", "garments"):
+        if isinstance(data.get(name), str):
+            try:
+                data[name] = json.loads(data[name])
+            except ValueError:
+                raise ValueError(f"{name} must be JSON")
+    if "clothing_item" not in data:
+        data["clothing_item"] = {k: data[k] for k in CLOTHING_FIELDS if k in data}
+    data.update(files)
+    data["clothing_images"] = clothing_images
+    return data
+
+
+async def run_tryon_request_async(app, tryon_req, on_stage=None):
+    """tryon_api.run_tryon_request(): cache → single-flight → awaited engine call."""
+    if tryon_req.preview:
+        # Local previews are pure CPU work: the threaded pipeline as-is
+        return await run_cpu(app, run_tryon_request, tryon_req, on_stage)
+
+    cache_key = await run_cpu(app, make_cache_key, tryon_req.person_raw, tryon_req.clothing_raw,
+                              tryon_req.clothing_item)
+    payload = await run_cpu(app, result_cache.get, cache_key)
+    metrics.CACHE.inc(outcome="hit" if payload is not None else "miss")
+    if payload is not None:
+        logger.info(f"Result cache hit: {cache_key[:12]}")
+        emit_stage(on_stage, "cache_hit")
+        request_id = uuid.uuid4().hex
+        future = llm_engine.asubmit_recommendations(
+            request_id, tryon_req.clothing_item, tryon_req.body_measurements
+        )
+        return await run_cpu(app, apply_output_options,
+                             cached_payload(payload, request_id, future, on_stage), tryon_req.output)
+
+    async def run_tryon():
+        led.append(True)
+        person_img, clothing_img = await run_cpu(app, open_request_images, tryon_req)
+        async with admission.aslot(tryon_req.user_id, tryon_req.client, tryon_req.prepaid):
+            result = await tryon_engine.aprocess_tryon(
+                app[HTTP],
+                app[CPU],
+                person_img,
+                clothing_img,
+                tryon_req.clothing_item,
+                tryon_req.body_measurements,
+                llm_engine,
+                on_stage=on_stage,
+            )
+        payload = await run_cpu(app, build_result_payload, result)
+        await run_cpu(app, cache_result, cache_key, result, payload)
+        return payload
+
+    # Followers retry when the leader's own admission was refused (see tryon_api)
+    while True:
+        led = []
+        try:
+            payload, shared = await inflight.do(cache_key, run_tryon)
+            break
+        except AdmissionRejected:
+            if led:
+                raise
+            logger.info(f"Coalesced leader was refused admission, retrying: {cache_key[:12]}")
+    return await run_cpu(app, apply_output_options,
+                         {**payload, "cached": False, "coalesced": shared}, tryon_req.output)
+
+
+async def run_idempotent_request_async(app, key, tryon_req):
+    """tryon_api.run_idempotent_request(): one run per Idempotency-Key. Returns (payload, replayed)."""
+    fingerprint = await run_cpu(app, request_fingerprint, tryon_req)
+    future, owner = idempotency.begin(key, fingerprint)
+    if owner:
+        # A task of its own: the client that dropped is the one that will retry
+        task = asyncio.ensure_future(run_tryon_request_async(app, tryon_req))
+
+        def record(task):
+            if task.cancelled():
+                idempotency.fail(key, future, RuntimeError("Try-on was cancelled"))
+            elif task.exception() is not None:
+                idempotency.fail(key, future, task.exception())
+            else:
+                record_outcome(key, future, task.result(), tryon_req.preview)
+
+        task.add_done_callback(record)
+    # Shielded: a disconnecting waiter must not cancel the shared outcome
+    return await asyncio.shield(asyncio.wrap_future(future)), not owner
+
+
+# ============================================
+# API ENDPOINTS
+# ============================================
+
+async def process_virtual_tryon(request):
+    try:
+        replayed = False
+        try:
+            key = idempotency_key(request.headers)
+            overloaded = admission_overload(key)  # before the (up to 50 MB) body is read
+            data = await read_request_data(request)
+            tryon_req = await run_cpu(request.app, parse_tryon_request, data, request.query, accept_of(request),
+                                      client_of(request))
+            if key:
+                key = scoped_idempotency_key(key, tryon_req)
+                # A retry whose outcome is already stored needs no upstream slot
+                if overloaded and not idempotency.completed(key):
+                    raise overloaded
+                payload, replayed = await run_idempotent_request_async(request.app, key, tryon_req)
+            else:
+                payload = await run_tryon_request_async(request.app, tryon_req)
+        except ValueError as e:
+            return error_response(str(e), 400)
+        except AdmissionRejected as e:
+            return overloaded_response(e)
+        except IdempotencyMismatch as e:
+            return error_response(str(e), 422)
+
+        headers = {"Idempotent-Replayed": "true"} if replayed else {}
+        if wants_binary_response(data, request.query, accept_of(request)):
+            image = await run_cpu(request.app, base64.b64decode, payload["result_image"])
+            return web.Response(body=image, content_type=payload.get("result_mime", "image/png"),
+                                headers={**binary_image_headers(payload, tryon_req.user_id), **headers})
+
+        # user_id is echoed back for frontend tracking
+        body = await run_cpu(request.app, json.dumps, {**payload, "user_id": tryon_req.user_id})
+        return web.Response(body=body.encode(), content_type="application/json", headers=headers)
+
+    except Exception as e:
+        logger.error(f"API Error: {str(e)}")
+        return error_response(str(e), 500)
+
+
+async def process_tryon_stream(request):
+    """/process-stream: stage events, result, recommendations_ready, done (see tryon_api)."""
+    try:
+        admission.check()
+        data = await read_request_data(request)
+        tryon_req = await run_cpu(request.app, parse_tryon_request, data, request.query, accept_of(request),
+                                  client_of(request))
+    except ValueError as e:
+        return error_response(str(e), 400)
+    except AdmissionRejected as e:
+        return overloaded_response(e)
+
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    started = time.time()
+
+    def on_stage(stage, info):
+        # Called from the loop and from CPU-pool threads alike
+        loop.call_soon_threadsafe(events.put_nowait, (
+            "stage", {"stage": stage, "elapsed": round(info["t"] - started, 3), **info}
+        ))
+
+    try:
+        # Tracked as a regular job, so the result can also be polled by job_id
+        job = tryon_api.job_manager.track(tryon_req.user_id)
+    except JobQueueFull as e:
+        return error_response(str(e), 503)
+
+    async def run():
+        tryon_api.job_manager.start(job)
+        try:
+            payload = {**await run_tryon_request_async(request.app, tryon_req, on_stage),
+                       "user_id": tryon_req.user_id}
+        except asyncio.CancelledError:
+            tryon_api.job_manager.finish(job, error="Try-on was cancelled")
+            raise
+        except Exception as e:
+            logger.error(f"API Error: {str(e)}")
+            tryon_api.job_manager.finish(job, error=str(e))
+            error = {"status": "error", "message": str(e)}
+            if isinstance(e, AdmissionRejected):
+                error["retry_after"] = e.retry_after
+            events.put_nowait(("error", error))
+            return
+        tryon_api.job_manager.finish(job, payload)
+        events.put_nowait(("result", payload))
+
+    # A task of its own: a client that disconnects can still fetch the result by job_id
+    asyncio.ensure_future(run())
+
+    response = web.StreamResponse(headers={
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+    await response.prepare(request)
+    await response.write(sse_event("stage", {"stage": "accepted", "job_id": job.id, "t": started,
+                                             "elapsed": 0.0}).encode())
+    result, recs_done, deadline = None, False, None
+    while True:
+        if result is not None and (recs_done or time.time() >= deadline):
+            break
+        try:
+            event, payload = await asyncio.wait_for(events.get(), timeout=SSE_HEARTBEAT)
+        except asyncio.TimeoutError:
+            await response.write(b": keep-alive\n\n")
+            continue
+        if event == "stage" and payload["stage"] == "recommendations_ready":
+            recs_done = True
+        await response.write(sse_event(event, payload).encode())
+        if event == "error":
+            break
+        if event == "result":
+            result = payload
+            recs_done = recs_done or payload.get("recommendations_status") == "ready"
+            deadline = time.time() + llm_engine.timeout
+
+    # Coalesced requests never see the leader's recommendation callback
+    if result is not None and not recs_done:
+        found = await llm_engine.await_recommendations(result["request_id"], wait=max(0, deadline - time.time()))
+        if found:
+            await response.write(sse_event("stage", {
+                "stage": "recommendations_ready",
+                "t": time.time(),
+                "elapsed": round(time.time() - started, 3),
+                "recommendations": found[1],
+            }).encode())
+    await response.write(sse_event("done", {"elapsed": round(time.time() - started, 3)}).encode())
+    await response.write_eof()
+    return response
+
+
+async def process_batch_tryon(request):
+    """/process-batch: all results at once, or NDJSON lines with stream=true."""
+    try:
+        try:
+            admission.check()
+            data = await read_request_data(request)
+            batch = await run_cpu(request.app, parse_batch_request, data, request.query, accept_of(request),
+                                  client_of(request))
+            admit_batch(batch)
+        except ValueError as e:
+            return error_response(str(e), 400)
+        except AdmissionRejected as e:
+            return overloaded_response(e)
+
+        semaphore = asyncio.Semaphore(min(len(batch), BATCH_CONCURRENCY))
+
+        async def run_one(index, tryon_req):
+            async with semaphore:
+                try:
+                    return {"index": index, **await run_tryon_request_async(request.app, tryon_req)}
+                except Exception as e:
+                    logger.error(f"Batch garment {index} failed: {e}")
+                    return {"index": index, "status": "error", "message": str(e)}
+
+        tasks = [asyncio.ensure_future(run_one(i, req)) for i, req in enumerate(batch)]
+        stream = str(data.get("stream", request.query.get("stream", ""))).lower() in ("1", "true")
+        if stream:
+            response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+            await response.prepare(request)
+            for next_done in asyncio.as_completed(tasks):
+                await response.write((json.dumps(await next_done) + "\n").encode())
+            await response.write_eof()
+            return response
+
+        results = sorted(await asyncio.gather(*tasks), key=lambda r: r["index"])
+        body = await run_cpu(request.app, json.dumps,
+                             {"status": "success", "results": results, "user_id": data.get("user_id", None)})
+        return web.Response(body=body.encode(), content_type="application/json")
+
+    except Exception as e:
+        logger.error(f"API Error: {str(e)}")
+        return error_response(str(e), 500)
+
+
+async def get_recommendations(request):
+    """/recommendations by request_id (optional long-poll `wait`), or directly from clothing_item."""
+    data = {}
+    if request.can_read_body:
+        try:
+            data = json.loads(await request.read() or b"{}") or {}
+        except ValueError:
+            data = {}
+    request_id = data.get("request_id") or request.query.get("request_id")
+
+    if not request_id:
+        clothing_item = parse_clothing_item(data.get("clothing_item", {}))
+        body_measurements = None
+        if "body_measurements" in data:
+            body_measurements = parse_body_measurements(data["body_measurements"])
+        request_id = uuid.uuid4().hex
+        llm_engine.asubmit_recommendations(request_id, clothing_item, body_measurements)
+        wait = llm_engine.timeout
+    else:
+        try:
+            wait = float(data.get("wait", request.query.get("wait", 0)))
+        except (TypeError, ValueError):
+            return error_response("wait must be a number", 400)
+
+    found = await llm_engine.await_recommendations(request_id, wait=wait)
+    if found is None:
+        return error_response("Unknown request id", 404)
+
+    ready, recommendations = found
+    return web.json_response({
+        "status": "success",
+        "request_id": request_id,
+        "recommendations_status": "ready" if ready else "pending",
+        "recommendations": recommendations,
+    })
+
+
+async def cache_stats(request):
+    return web.json_response({
+        "status": "success",
+        "cache": result_cache.stats(),
+        "inflight": inflight.stats(),
+        "admission": admission.stats(),
+        "idempotency": idempotency.stats(),
+        "jobs": tryon_api.job_manager.stats(),
+        "recommendations": llm_engine.cache_stats(),
+        "upstream": tryon_engine.stats(),
+        "catalog": garment_catalog.stats(),
+        "persons": person_sessions.stats(),
+    })
+
+
+async def health_check(request):
+    return web.json_response({"status": "healthy", "service": "HuggingFace VTON", "mode": "asyncio"})
+
+
+# ============================================
+# WSGI BRIDGE / MIDDLEWARE
+# ============================================
+
+HOP_BY_HOP = {"connection", "content-length", "transfer-encoding", "keep-alive"}
+
+
+async def wsgi_bridge(request):
+    """Everything without a native handler goes to the Flask app on the WSGI pool."""
+    body = await request.read()
+    builder = EnvironBuilder(
+        path=request.path,
+        method=request.method,
+        headers=list(request.headers.items()),
+        data=body,
+        query_string=request.query_string,
+    )
+    environ = builder.get_environ()
+    environ["REMOTE_ADDR"] = request.remote or ""
+
+    def call():
+        try:
+            response = WSGIResponse.from_app(flask_app, environ, buffered=True)
+            return response.status_code, list(response.headers.items()), response.get_data()
+        finally:
+            builder.close()
+
+    status, headers, data = await asyncio.get_running_loop().run_in_executor(request.app[WSGI], call)
+    response = web.Response(status=status, body=data)
+    for name, value in headers:
+        if name.lower() not in HOP_BY_HOP:
+            response.headers.add(name, value)
+    return response
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    """What flask-cors does for the Flask app: any origin, X-TryOn-* headers exposed."""
+    if request.method == "OPTIONS" and "Access-Control-Request-Method" in request.headers:
+        return web.Response(status=200, headers={
+            "Access-Control-Allow-Origin": request.headers.get("Origin", "*"),
+            "Access-Control-Allow-Methods": "GET, HEAD, POST, OPTIONS, PUT, PATCH, DELETE",
+            "Access-Control-Allow-Headers": request.headers.get("Access-Control-Request-Headers", "*"),
+            "Vary": "Origin",
+        })
+    try:
+        response = await handler(request)
+    except web.HTTPRequestEntityTooLarge:
+        response = web.json_response({"error": "File too large. Maximum size is 50MB"}, status=413)
+    if "Origin" in request.headers and "Access-Control-Allow-Origin" not in response.headers:
+        response.headers["Access-Control-Allow-Origin"] = request.headers["Origin"]
+        response.headers["Access-Control-Expose-Headers"] = ", ".join(EXPOSED_HEADERS)
+        response.headers["Vary"] = "Origin"
+    return response
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """The request metrics tryon_api records in its Flask hooks, for native routes."""
+    if request.match_info.handler is wsgi_bridge:
+        return await handler(request)  # the Flask app records these itself
+    started = time.perf_counter()
+    response = await handler(request)
+    endpoint = request.match_info.route.resource.canonical
+    metrics.REQUESTS.inc(endpoint=endpoint, status=response.status)
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+    metrics.PAYLOAD_BYTES.inc(request.content_length or 0, direction="in")
+    if isinstance(response, web.Response):  # streamed bodies have no length up front
+        metrics.PAYLOAD_BYTES.inc(response.content_length or 0, direction="out")
+    return response
+
+
+# ============================================
+# APPLICATION
+# ============================================
+
+async def _start(app):
+    app[HTTP] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=UPSTREAM_CONNECTIONS),
+        # Legacy Spaces send whole base64 images as one event line
+        read_bufsize=8 * 1024 * 1024,
+    )
+    # Build the engines before the port opens (run_app binds after startup)
+    await asyncio.get_running_loop().run_in_executor(app[CPU], tryon_api.warm)
+
+
+async def _stop(app):
+    await app[HTTP].close()
+    app[CPU].shutdown(wait=False)
+    app[WSGI].shutdown(wait=False)
+
+
+def create_app() -> web.Application:
+    app = web.Application(
+        client_max_size=flask_app.config["MAX_CONTENT_LENGTH"],
+        middlewares=[cors_middleware, metrics_middleware],
+    )
+    app[CPU] = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="tryon-cpu")
+    app[WSGI] = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix="tryon-wsgi")
+    app.on_startup.append(_start)
+    app.on_cleanup.append(_stop)
+
+    prefix = tryon_api.tryon_bp.url_prefix
+    app.router.add_get(f"{prefix}/health", health_check)
+    app.router.add_get(f"{prefix}/cache/stats", cache_stats)
+    app.router.add_post(f"{prefix}/process", process_virtual_tryon)
+    app.router.add_post(f"{prefix}/process-stream", process_tryon_stream)
+    app.router.add_post(f"{prefix}/process-batch", process_batch_tryon)
+    app.router.add_route("GET", f"{prefix}/recommendations", get_recommendations)
+    app.router.add_route("POST", f"{prefix}/recommendations", get_recommendations)
+    app.router.add_route("*", "/{tail:.*}", wsgi_bridge)
+    return app
+
+
+async def app_factory() -> web.Application:
+    """Entry point for aiohttp.GunicornWebWorker."""
+    return create_app()
+
+
+if __name__ == "__main__":
+    port = int(os.environ.get("FLASK_PORT", 5000))
+    logger.info(f"Starting asyncio try-on server on port {port}...")
+    web.run_app(create_app(), host="0.0.0.0", port=port)
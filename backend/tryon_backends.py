@@ -0,0 +1,548 @@
+"""
+Try-On Backend Registry
+Several try-on providers (Space replicas, a self-hosted endpoint, the local
+compositor as a last resort) behind one predict() that routes on EWMA latency,
+in-flight count and circuit health, with optional request hedging.
+predict() serves the threaded Flask app, apredict() the asyncio one.
+"""
+
+import os
+import time
+import base64
+import asyncio
+import logging
+import threading
+from io import BytesIO
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from local_compositor import composite_garment
+from space_client import GradioSpaceClient, SchemaUnavailable
+from circuit_breaker import AdaptiveTimeout, CircuitBreaker, CircuitOpenError, LatencyTracker
+import tryon_metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+
+# =====================================================
+# BACKENDS
+# =====================================================
+
+class TryOnBackend:
+    """
+    One try-on provider. Subclasses implement _call(); this class keeps the
+    routing state: circuit breaker, EWMA latency, in-flight count and an
+    adaptive per-call deadline.
+    """
+
+    kind = "backend"
+    confidence = 0.95
+    fallback = False  # last-resort backends are only used when nothing else is left
+
+    def __init__(self, name: str, max_deadline: float = 240, ewma_alpha: float = 0.3):
+        self.name = name
+        self.ewma_alpha = ewma_alpha
+        self.ewma: Optional[float] = None
+        self._running: List[float] = []  # start times of calls still in flight
+        self.calls = 0
+        self.failures = 0
+        self.breaker = CircuitBreaker.from_env(name=name)
+        self.latency = LatencyTracker(window_seconds=600)
+        self.timeout = AdaptiveTimeout(
+            self.latency,
+            minimum=float(os.getenv("TRYON_TIMEOUT_MIN", 20)),
+            maximum=max_deadline,
+            percentile=float(os.getenv("TRYON_TIMEOUT_PERCENTILE", 99)),
+            multiplier=float(os.getenv("TRYON_TIMEOUT_MULTIPLIER", 1.5)),
+        )
+        self._lock = threading.Lock()
+
+    @property
+    def healthy(self) -> bool:
+        return not self.breaker.rejecting()
+
+    def score(self) -> float:
+        """Expected seconds until a new call finishes; lower is better."""
+        # A call that has been running for N seconds means latency is at
+        # least N, even before it finishes (and before any EWMA exists).
+        # Unmeasured, idle backends score 0 so each one gets tried early.
+        running = self._running
+        age = time.time() - running[0] if running else 0.0
+        return max(self.ewma or 0.0, age) * (1 + len(running))
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._running)
+
+    def predict(self, person, cloth, description: str, progress,
+                clothing_item=None, body_measurements=None) -> bytes:
+        """Guarded call: breaker check, adaptive deadline, latency bookkeeping."""
+        started, deadline, _ = self._begin()
+        try:
+            result = self._call(person, cloth, description, progress, deadline,
+                                clothing_item, body_measurements)
+        except Exception:
+            self._finish(started, ok=False)
+            raise
+        self._finish(started, ok=True)
+        return result
+
+    async def apredict(self, http, executor, person, cloth, description: str, progress,
+                       clothing_item=None, body_measurements=None) -> bytes:
+        """predict() for the asyncio server: `http` is an aiohttp session, `executor` runs CPU work."""
+        started, deadline, probe = self._begin()
+        try:
+            result = await self._acall(http, executor, person, cloth, description, progress, deadline,
+                                       clothing_item, body_measurements)
+        except asyncio.CancelledError:
+            # Abandoned, not failed: no verdict on the backend, but a
+            # half-open probe hands its slot back so another call can probe
+            with self._lock:
+                self._running.remove(started)
+            if probe:
+                self.breaker.release_probe()
+            raise
+        except Exception:
+            self._finish(started, ok=False)
+            raise
+        self._finish(started, ok=True)
+        return result
+
+    def _begin(self) -> Tuple[float, float, bool]:
+        """(started, deadline, whether the call is a half-open probe)"""
+        probe = self.breaker.check()
+        deadline = self.timeout.current()
+        started = time.time()
+        with self._lock:
+            self._running.append(started)
+            self.calls += 1
+        return started, deadline, probe
+
+    def _finish(self, started: float, ok: bool):
+        elapsed = time.time() - started
+        with self._lock:
+            self._running.remove(started)
+        metrics.STAGE_SECONDS.observe(elapsed, stage="upstream_wait", backend=self.name)
+        if ok:
+            self.breaker.record_success(elapsed)
+            self.latency.record(elapsed, ok=True)
+            self._observe(elapsed)
+            return
+        metrics.UPSTREAM_ERRORS.inc(backend=self.name)
+        self.breaker.record_failure(elapsed)
+        # A failure costs the caller at least the time it took (and a retry)
+        self._observe(max(elapsed, self.ewma or 0.0) * 2)
+        with self._lock:
+            self.failures += 1
+
+    def _observe(self, seconds: float):
+        with self._lock:
+            if self.ewma is None:
+                self.ewma = seconds
+            else:
+                self.ewma = self.ewma_alpha * seconds + (1 - self.ewma_alpha) * self.ewma
+
+    def _call(self, person, cloth, description: str, progress, deadline: float,
+              clothing_item=None, body_measurements=None) -> bytes:
+        """Encoded result image. Remote backends only need the description."""
+        raise NotImplementedError
+
+    async def _acall(self, http, executor, person, cloth, description: str, progress, deadline: float,
+                     clothing_item=None, body_measurements=None) -> bytes:
+        """Async _call(); by default the sync one on `executor` (right for CPU-bound backends)."""
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, self._call, person, cloth, description, progress, deadline,
+            clothing_item, body_measurements,
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "fallback": self.fallback,
+            "ewma": round(self.ewma, 3) if self.ewma is not None else None,
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "failures": self.failures,
+            "circuit": self.breaker.stats(),
+            "timeout": round(self.timeout.current(), 1),
+            "latency_p50": self.latency.percentile(50),
+            "latency_p99": self.latency.percentile(99),
+        }
+
+    def close(self):
+        pass
+
+
+class SpaceBackend(TryOnBackend):
+    """An IDM-VTON HuggingFace Space (or a duplicate of it)."""
+
+    kind = "space"
+
+    def __init__(self, space: str, session, timeout=(10, 120), api_name: str = "/tryon",
+                 hf_token: Optional[str] = None, deadline: float = 240):
+        if "://" in space:
+            self.space_url = space.rstrip("/")
+        else:
+            # Spaces are served from https://{username}-{spacename}.hf.space
+            self.space_url = f"https://{space.replace('/', '-').lower()}.hf.space"
+        super().__init__(space, max_deadline=deadline)
+        self.api_url = f"{self.space_url}/api/predict"  # legacy route, fallback only
+        self.session = session
+        self.http_timeout = timeout
+        # Native Gradio queue client; the endpoint signature is discovered
+        # from the Space's config once and cached.
+        self.client = GradioSpaceClient(
+            self.space_url, session, timeout=timeout, api_name=api_name,
+            hf_token=hf_token, deadline=deadline,
+        )
+        self._legacy_until = 0.0
+
+    def _call(self, person, cloth, description, progress, deadline,
+              clothing_item=None, body_measurements=None):
+        """Queue protocol first; the legacy predict route only for Spaces without a schema."""
+        if time.time() >= self._legacy_until:
+            try:
+                return self.client.predict(
+                    (person.encode(), person.mime),
+                    (cloth.encode(), cloth.mime),
+                    description,
+                    progress,
+                    deadline=deadline,
+                )
+            except SchemaUnavailable as e:
+                logger.warning(f"{e}; using legacy /api/predict on {self.name} for the next 5 minutes")
+                self._legacy_until = time.time() + 300
+        metrics.FALLBACKS.inc(kind="legacy_route")
+        return self._predict_legacy(person, cloth, progress, deadline)
+
+    async def _acall(self, http, executor, person, cloth, description, progress, deadline,
+                     clothing_item=None, body_measurements=None):
+        if time.time() >= self._legacy_until:
+            try:
+                return await self.client.apredict(
+                    http,
+                    (person.encode(), person.mime),
+                    (cloth.encode(), cloth.mime),
+                    description,
+                    progress,
+                    deadline=deadline,
+                )
+            except SchemaUnavailable as e:
+                logger.warning(f"{e}; using legacy /api/predict on {self.name} for the next 5 minutes")
+                self._legacy_until = time.time() + 300
+        metrics.FALLBACKS.inc(kind="legacy_route")
+        # Rare path: the blocking legacy call goes to the default thread pool, not the CPU one
+        return await asyncio.to_thread(self._predict_legacy, person, cloth, progress, deadline)
+
+    def _predict_legacy(self, person, cloth, progress, deadline: float) -> bytes:
+        # Space API payload format: array of inputs matching the Space's function signature
+        payload = {"data": [person.data_uri(), cloth.data_uri()]}
+
+        # The legacy predict route has no queue feedback: the call is
+        # queued and started as far as we can tell once it is sent.
+        progress("upstream_queued", url=self.api_url)
+        progress("upstream_started")
+        response = self.session.post(self.api_url, json=payload,
+                                     timeout=(self.http_timeout[0], deadline))
+        logger.info(f"Space API Status: {response.status_code}")
+        if response.status_code != 200:
+            raise Exception(f"HTTP {response.status_code}: {response.text[:500]}")
+
+        data = response.json()
+        # Space API returns data in format: {"data": [result_image_base64, ...]}
+        if isinstance(data, dict) and "data" in data:
+            result_data = data["data"]
+            if not (isinstance(result_data, list) and result_data):
+                raise Exception("Space API returned empty result")
+            output_b64 = result_data[0]
+        else:
+            # Fallback: try to get image directly
+            metrics.FALLBACKS.inc(kind="payload_format")
+            output_b64 = data.get("generated_image") or data.get("image") or data.get("result")
+            if not output_b64:
+                raise Exception(f"Unexpected Space API response format: {data}")
+        # Remove data URI prefix if present
+        if isinstance(output_b64, str) and output_b64.startswith("data:image"):
+            output_b64 = output_b64.split(",", 1)[1]
+        return base64.b64decode(output_b64)
+
+    def stats(self):
+        return {**super().stats(), "url": self.space_url, "queue": vars(self.client.queue_status)}
+
+
+class HTTPBackend(TryOnBackend):
+    """
+    A self-hosted try-on endpoint. Receives a multipart POST with
+    person_image, clothing_image and description; answers with the image
+    bytes, or JSON carrying base64 in result_image / image.
+    """
+
+    kind = "http"
+
+    def __init__(self, url: str, session, timeout=(10, 120), token: Optional[str] = None,
+                 deadline: float = 240):
+        super().__init__(url, max_deadline=deadline)
+        self.url = url
+        self.session = session
+        self.http_timeout = timeout
+        self.headers = {"Authorization": f"Bearer {token}"} if token else {}
+
+    def _call(self, person, cloth, description, progress, deadline,
+              clothing_item=None, body_measurements=None):
+        progress("upstream_started", url=self.url)
+        response = self.session.post(
+            self.url,
+            files={
+                "person_image": ("person", person.encode(), person.mime),
+                "clothing_image": ("clothing", cloth.encode(), cloth.mime),
+            },
+            data={"description": description},
+            headers=self.headers,
+            timeout=(self.http_timeout[0], deadline),
+        )
+        if response.status_code != 200:
+            raise Exception(f"HTTP {response.status_code}: {response.text[:500]}")
+        if response.headers.get("Content-Type", "").startswith("image/"):
+            return response.content
+        data = response.json()
+        output_b64 = data.get("result_image") or data.get("image")
+        if not output_b64:
+            raise Exception(f"Unexpected response from {self.url}: {list(data)}")
+        if output_b64.startswith("data:"):
+            output_b64 = output_b64.split(",", 1)[1]
+        return base64.b64decode(output_b64)
+
+    async def _acall(self, http, executor, person, cloth, description, progress, deadline,
+                     clothing_item=None, body_measurements=None):
+        import aiohttp
+        progress("upstream_started", url=self.url)
+        form = aiohttp.FormData()
+        form.add_field("person_image", person.encode(), filename="person", content_type=person.mime)
+        form.add_field("clothing_image", cloth.encode(), filename="clothing", content_type=cloth.mime)
+        form.add_field("description", description)
+        timeout = aiohttp.ClientTimeout(total=deadline, sock_connect=self.http_timeout[0])
+        async with http.post(self.url, data=form, headers=self.headers, timeout=timeout) as response:
+            if response.status != 200:
+                raise Exception(f"HTTP {response.status}: {(await response.text())[:500]}")
+            if response.headers.get("Content-Type", "").startswith("image/"):
+                return await response.read()
+            data = await response.json(content_type=None)
+        output_b64 = data.get("result_image") or data.get("image")
+        if not output_b64:
+            raise Exception(f"Unexpected response from {self.url}: {list(data)}")
+        if output_b64.startswith("data:"):
+            output_b64 = output_b64.split(",", 1)[1]
+        return base64.b64decode(output_b64)
+
+
+class LocalCompositorBackend(TryOnBackend):
+    """Last resort: the NumPy compositor from local_compositor, on this machine's CPU."""
+
+    kind = "local"
+    confidence = 0.4
+    fallback = True
+
+    def __init__(self, name: str = "local-compositor"):
+        super().__init__(name, max_deadline=30)
+
+    def _call(self, person, cloth, description, progress, deadline,
+              clothing_item=None, body_measurements=None):
+        progress("upstream_started", backend=self.name)
+        person_arr = np.asarray(Image.open(BytesIO(person.encode())).convert("RGB"))
+        garment_pil = Image.open(BytesIO(cloth.encode()))
+        garment_arr = np.asarray(garment_pil.convert("RGBA" if "A" in garment_pil.getbands() else "RGB"))
+        result = composite_garment(
+            person_arr, garment_arr,
+            getattr(clothing_item, "item_type", None) or "shirt",
+            body_measurements,
+            getattr(clothing_item, "fit", ""),
+        )
+        buf = BytesIO()
+        Image.fromarray(result).save(buf, format="JPEG", quality=90)
+        return buf.getvalue()
+
+
+# =====================================================
+# REGISTRY / ROUTING
+# =====================================================
+
+class BackendRegistry:
+    """
+    Routes each prediction to the healthy backend with the lowest
+    EWMA latency × (1 + in-flight). A failed backend is skipped and the
+    next one tried; fallback backends run only when nothing else is left.
+    With `hedge_delay`, a second backend is started if the first has not
+    answered by then, and whichever finishes first wins.
+    """
+
+    def __init__(self, backends: List[TryOnBackend], hedge_delay: Optional[float] = None,
+                 hedge_workers: int = 8):
+        if not backends:
+            raise ValueError("BackendRegistry needs at least one backend")
+        self.backends = backends
+        self.hedge_delay = hedge_delay
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+        self._executor = (
+            ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix="tryon-hedge")
+            if hedge_delay else None
+        )
+
+    def pick(self, exclude=()) -> Optional[TryOnBackend]:
+        candidates = [b for b in self.backends if b not in exclude and b.healthy]
+        primary = [b for b in candidates if not b.fallback]
+        pool = primary or candidates
+        return min(pool, key=lambda b: b.score()) if pool else None
+
+    def predict(self, person, cloth, description: str, progress,
+                clothing_item=None, body_measurements=None) -> Tuple[bytes, TryOnBackend]:
+        """Result bytes and the backend that produced them."""
+        args = (person, cloth, description, progress, clothing_item, body_measurements)
+        tried: List[TryOnBackend] = []
+        last_error: Optional[Exception] = None
+        while True:
+            backend = self.pick(exclude=tried)
+            if backend is None:
+                if last_error is not None:
+                    raise last_error
+                retry = min(b.breaker.retry_after() for b in self.backends)
+                raise CircuitOpenError("all try-on backends", retry)
+            tried.append(backend)
+            try:
+                if self.hedge_delay and not backend.fallback:
+                    return self._hedged(backend, tried, args)
+                if backend.fallback:
+                    metrics.FALLBACKS.inc(kind="local_backend")
+                return backend.predict(*args), backend
+            except Exception as e:
+                last_error = e
+                self.failovers += 1
+                logger.warning(f"Backend {backend.name} failed ({e}); trying the next one")
+
+    async def apredict(self, http, executor, person, cloth, description: str, progress,
+                       clothing_item=None, body_measurements=None) -> Tuple[bytes, TryOnBackend]:
+        """predict() for the asyncio server; hedges with tasks instead of threads."""
+        args = (http, executor, person, cloth, description, progress, clothing_item, body_measurements)
+        tried: List[TryOnBackend] = []
+        last_error: Optional[Exception] = None
+        while True:
+            backend = self.pick(exclude=tried)
+            if backend is None:
+                if last_error is not None:
+                    raise last_error
+                retry = min(b.breaker.retry_after() for b in self.backends)
+                raise CircuitOpenError("all try-on backends", retry)
+            tried.append(backend)
+            try:
+                if self.hedge_delay and not backend.fallback:
+                    return await self._ahedged(backend, tried, args)
+                if backend.fallback:
+                    metrics.FALLBACKS.inc(kind="local_backend")
+                return await backend.apredict(*args), backend
+            except Exception as e:
+                last_error = e
+                self.failovers += 1
+                logger.warning(f"Backend {backend.name} failed ({e}); trying the next one")
+
+    async def _ahedged(self, primary, tried, args):
+        tasks = {asyncio.ensure_future(primary.apredict(*args)): primary}
+        done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay)
+        if not done:
+            hedge = self.pick(exclude=tried)
+            if hedge is not None and not hedge.fallback:
+                tried.append(hedge)
+                self.hedges += 1
+                logger.info(f"{primary.name} slower than {self.hedge_delay}s; hedging on {hedge.name}")
+                tasks[asyncio.ensure_future(hedge.apredict(*args))] = hedge
+
+        error = None
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    backend = tasks[task]
+                    if backend is not primary:
+                        self.hedge_wins += 1
+                    # The loser keeps running; its latency still feeds the EWMA
+                    return task.result(), backend
+                error = task.exception()
+        raise error
+
+    def _hedged(self, primary, tried, args):
+        futures = {self._executor.submit(primary.predict, *args): primary}
+        done, _ = wait(futures, timeout=self.hedge_delay)
+        if not done:
+            hedge = self.pick(exclude=tried)
+            if hedge is not None and not hedge.fallback:
+                tried.append(hedge)
+                self.hedges += 1
+                logger.info(f"{primary.name} slower than {self.hedge_delay}s; hedging on {hedge.name}")
+                futures[self._executor.submit(hedge.predict, *args)] = hedge
+
+        error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    backend = futures[future]
+                    if backend is not primary:
+                        self.hedge_wins += 1
+                    # The loser keeps running; its latency still feeds the EWMA
+                    return future.result(), backend
+                error = future.exception()
+        raise error
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backends": [b.stats() for b in self.backends],
+            "hedge_delay": self.hedge_delay,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "failovers": self.failovers,
+        }
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        for backend in self.backends:
+            backend.close()
+
+
+def backends_from_env(session, spec: Optional[str] = None, default_space: str = "yisol/IDM-VTON",
+                      default_url: Optional[str] = None, timeout=(10, 120)) -> List[TryOnBackend]:
+    """
+    TRYON_BACKENDS="space:yisol/IDM-VTON, space:https://my-dup.hf.space,
+                    http:https://gpu.example.com/tryon, local"
+    Unset: the single Space from TRYON_HF_SPACE.
+    """
+    spec = spec if spec is not None else os.getenv("TRYON_BACKENDS", "")
+    api_name = os.getenv("TRYON_SPACE_API", "/tryon")
+    hf_token = os.getenv("HF_TOKEN")
+    deadline = float(os.getenv("TRYON_UPSTREAM_DEADLINE", 240))
+
+    entries = [e.strip() for e in spec.split(",") if e.strip()]
+    if not entries:
+        entries = [f"space:{default_url or default_space}"]
+
+    backends: List[TryOnBackend] = []
+    for entry in entries:
+        kind, _, target = entry.partition(":")
+        kind = kind.strip().lower()
+        target = target.strip()
+        if kind == "space" and target:
+            backends.append(SpaceBackend(target, session, timeout, api_name, hf_token, deadline))
+        elif kind == "http" and target:
+            backends.append(HTTPBackend(target, session, timeout,
+                                        os.getenv("TRYON_BACKEND_TOKEN"), deadline))
+        elif kind == "local":
+            backends.append(LocalCompositorBackend())
+        else:
+            raise ValueError(f"Unknown try-on backend spec: {entry!r}")
+    return backends
@@ -0,0 +1,282 @@
+"""
+Try-On Result Cache
+Two-tier (memory LRU + disk) cache for finished try-on responses,
+keyed on the raw uploaded bytes and the normalized ClothingItem.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# =====================================================
+# IN-MEMORY LRU / TTL CACHE
+# =====================================================
+
+class TTLCache:
+    """Thread-safe LRU cache bounded by entry count, total size and age."""
+
+    def __init__(self, max_entries: int = 256, max_bytes: Optional[int] = None,
+                 ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (value, size, stored_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, size, stored_at = entry
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        """Like get(), without touching LRU order or hit/miss counters."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (self.ttl is not None and time.time() - entry[2] > self.ttl):
+                return default
+            return entry[0]
+
+    def set(self, key, value, size: int = 0, stored_at: Optional[float] = None):
+        """`stored_at` keeps an earlier timestamp (and so expiry) when re-storing."""
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._data[key] = (value, size, time.time() if stored_at is None else stored_at)
+            self._bytes += size
+            while self._data and (
+                len(self._data) > self.max_entries
+                or (self.max_bytes is not None and self._bytes > self.max_bytes)
+            ):
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            self._remove(key)
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def _remove(self, key):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._data),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+# =====================================================
+# TWO-TIER TRY-ON RESULT CACHE
+# =====================================================
+
+def _normalize(value) -> str:
+    if hasattr(value, "value"):
+        value = value.value
+    return str(value or "").strip().lower()
+
+
+def make_cache_key(person_bytes: bytes, clothing_bytes: bytes,
+                   clothing_item, extra: Optional[Dict[str, Any]] = None) -> str:
+    """SHA-256 over both raw images plus the normalized clothing fields."""
+    h = hashlib.sha256()
+    h.update(hashlib.sha256(person_bytes).digest())
+    h.update(hashlib.sha256(clothing_bytes).digest())
+    fields = {
+        name: _normalize(getattr(clothing_item, name, ""))
+        for name in ("item_type", "color", "pattern", "size", "fit", "style")
+    }
+    if extra:
+        fields["_extra"] = extra
+    h.update(json.dumps(fields, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class TryOnResultCache:
+    """
+    Caches encoded try-on responses (the JSON-ready payload, not arrays),
+    so a hit skips image decode, the upstream call and re-encoding.
+    """
+
+    def __init__(self, max_entries: int = 128, max_memory_bytes: int = 256 * 1024 * 1024,
+                 max_disk_bytes: int = 1024 * 1024 * 1024, ttl: float = 24 * 3600,
+                 cache_dir: Optional[str] = None):
+        self.memory = TTLCache(max_entries=max_entries, max_bytes=max_memory_bytes, ttl=ttl)
+        self.ttl = ttl
+        self.max_disk_bytes = max_disk_bytes
+        self.cache_dir = None
+        self._disk_lock = threading.Lock()
+        self._disk_bytes = 0
+        self.disk_hits = 0
+        self.disk_evictions = 0
+        self.stores = 0
+        if cache_dir:
+            self.attach_disk(cache_dir)
+
+    @classmethod
+    def from_env(cls, cache_dir: Optional[str] = None) -> "TryOnResultCache":
+        return cls(
+            max_entries=int(os.getenv("TRYON_CACHE_MAX_ENTRIES", 128)),
+            max_memory_bytes=int(float(os.getenv("TRYON_CACHE_MEMORY_MB", 256)) * 1024 * 1024),
+            max_disk_bytes=int(float(os.getenv("TRYON_CACHE_DISK_MB", 1024)) * 1024 * 1024),
+            ttl=float(os.getenv("TRYON_CACHE_TTL", 24 * 3600)),
+            cache_dir=cache_dir,
+        )
+
+    def attach_disk(self, cache_dir: str):
+        """Enable the on-disk tier (called once the upload folder is known)."""
+        os.makedirs(cache_dir, exist_ok=True)
+        with self._disk_lock:
+            self.cache_dir = cache_dir
+            self._disk_bytes = sum(size for _, size, _ in self._scan_disk())
+        logger.info(f"Try-on result cache on disk: {cache_dir}")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        payload = self.memory.get(key)
+        if payload is not None:
+            return payload
+
+        payload = self._read_disk(key)
+        if payload is not None:
+            self.disk_hits += 1
+            # The memory miss was already counted; promote the entry.
+            self.memory.set(key, payload, size=_payload_size(payload))
+        return payload
+
+    def set(self, key: str, payload: Dict[str, Any]):
+        self.stores += 1
+        self.memory.set(key, payload, size=_payload_size(payload))
+        self._write_disk(key, payload)
+
+    def stats(self) -> Dict[str, Any]:
+        mem = self.memory.stats()
+        return {
+            "memory": mem,
+            "disk": {
+                "enabled": self.cache_dir is not None,
+                "bytes": self._disk_bytes,
+                "hits": self.disk_hits,
+                "evictions": self.disk_evictions,
+            },
+            "hits": mem["hits"] + self.disk_hits,
+            "misses": mem["misses"] - self.disk_hits,
+            "stores": self.stores,
+        }
+
+    # -------- disk tier --------
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _read_disk(self, key: str) -> Optional[Dict[str, Any]]:
+        if not self.cache_dir:
+            return None
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                with self._disk_lock:
+                    size = os.path.getsize(path)
+                    if self._delete(path):
+                        self._disk_bytes -= size
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key: str, payload: Dict[str, Any]):
+        if not self.cache_dir:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(payload, f)
+            size = os.path.getsize(tmp)
+            if size > self.max_disk_bytes:
+                os.remove(tmp)
+                return
+            with self._disk_lock:
+                if os.path.exists(path):
+                    self._disk_bytes -= os.path.getsize(path)
+                os.replace(tmp, path)
+                self._disk_bytes += size
+                if self._disk_bytes > self.max_disk_bytes:
+                    self._prune_disk()
+        except OSError as e:
+            logger.warning(f"Result cache write failed: {e}")
+
+    def _scan_disk(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def _prune_disk(self):
+        """Drop expired entries, then oldest-first until under the byte budget."""
+        now = time.time()
+        entries = sorted(self._scan_disk(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, mtime in entries:
+            if total <= self.max_disk_bytes and now - mtime <= self.ttl:
+                continue
+            if self._delete(path):
+                total -= size
+                self.disk_evictions += 1
+        self._disk_bytes = total
+
+    def _delete(self, path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+
+def _payload_size(payload: Dict[str, Any]) -> int:
+    image = payload.get("result_image") or ""
+    return len(image) + 1024
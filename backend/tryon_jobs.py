@@ -0,0 +1,151 @@
+"""
+Background Try-On Jobs
+Bounded worker pool + job table so slow Space calls don't pin request threads.
+"""
+
+import os
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+class JobQueueFull(Exception):
+    """Raised when the pending-job limit is reached."""
+
+
+class Job:
+    def __init__(self, job_id: str, user_id: Optional[str] = None):
+        self.id = job_id
+        self.user_id = user_id
+        self.status = QUEUED
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._done = threading.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float]) -> bool:
+        return self._done.wait(timeout)
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {
+            "job_id": self.id,
+            "job_status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "user_id": self.user_id,
+        }
+        if self.status == SUCCEEDED:
+            data["result"] = self.result
+        elif self.status == FAILED:
+            data["error"] = self.error
+        return data
+
+
+class JobManager:
+    """Runs submitted callables on a fixed-size pool and tracks their outcome."""
+
+    def __init__(self, max_workers: int = 4, max_pending: int = 64, ttl: float = 600):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tryon-job")
+        self._jobs: Dict[str, Job] = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "JobManager":
+        return cls(
+            max_workers=int(os.getenv("TRYON_JOB_WORKERS", 4)),
+            max_pending=int(os.getenv("TRYON_JOB_QUEUE", 64)),
+            ttl=float(os.getenv("TRYON_JOB_TTL", 600)),
+        )
+
+    def submit(self, fn: Callable[[], Dict[str, Any]], user_id: Optional[str] = None) -> Job:
+        job = self.track(user_id)
+        self._executor.submit(self._run, job, fn)
+        return job
+
+    def track(self, user_id: Optional[str] = None) -> Job:
+        """
+        Register a job the caller runs itself (e.g. a coroutine on the async
+        server) and settles with start()/finish(). Raises JobQueueFull.
+        """
+        with self._lock:
+            self._prune()
+            if self._pending >= self.max_pending:
+                raise JobQueueFull(f"{self._pending} try-on jobs already pending")
+            job = Job(uuid.uuid4().hex, user_id)
+            self._jobs[job.id] = job
+            self._pending += 1
+        return job
+
+    def start(self, job: Job):
+        job.status = RUNNING
+        job.started_at = time.time()
+
+    def finish(self, job: Job, result: Optional[Dict[str, Any]] = None, error: Optional[str] = None):
+        if error is None:
+            job.result = result
+            job.status = SUCCEEDED
+        else:
+            logger.error(f"Try-on job {job.id} failed: {error}")
+            job.error = error
+            job.status = FAILED
+        job.finished_at = time.time()
+        with self._lock:
+            self._pending -= 1
+        job._done.set()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            self._prune()
+            return self._jobs.get(job_id)
+
+    def _run(self, job: Job, fn: Callable[[], Dict[str, Any]]):
+        self.start(job)
+        try:
+            result = fn()
+        except Exception as e:
+            self.finish(job, error=str(e))
+        else:
+            self.finish(job, result)
+
+    def _prune(self):
+        """Forget finished jobs older than the TTL (caller holds the lock)."""
+        cutoff = time.time() - self.ttl
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished and job.finished_at < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "pending": self._pending,
+                "max_pending": self.max_pending,
+                "tracked": len(self._jobs),
+            }
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
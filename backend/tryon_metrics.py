@@ -0,0 +1,144 @@
+"""
+Try-On Pipeline Metrics
+Minimal thread-safe counters and histograms rendered in the Prometheus text
+exposition format (served at /metrics). Each Gunicorn worker keeps its own
+values, so scrape every worker or run with a single worker per container.
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Seconds; covers sub-millisecond parsing up to multi-minute Space queues
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 20, 30, 60, 120, 240)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Optional[Dict[str, str]]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in (labels or {}).items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key: LabelKey, extra: Iterable[Tuple[str, str]] = ()) -> str:
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values: Dict[LabelKey, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        lines += [f"{self.name}{_format_labels(k)} {_format_value(v)}" for k, v in items]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[LabelKey, List[float]] = {}  # per-bucket counts + [sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def totals(self) -> Dict[LabelKey, Tuple[float, int]]:
+        """(sum, count) per label set."""
+        with self._lock:
+            return {k: (v[-2], v[-1]) for k, v in self._series.items()}
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        for key, series in items:
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', _format_value(bound))])} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(series[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {series[-1]}")
+        return lines
+
+
+# =====================================================
+# PIPELINE METRICS
+# =====================================================
+
+STAGE_SECONDS = Histogram(
+    "tryon_stage_seconds",
+    "Time spent per try-on pipeline stage (json_parse, base64_decode, image_decode, "
+    "upstream_encode, upstream_wait, result_decode, llm_call, response_encode, admission_wait)",
+)
+REQUEST_SECONDS = Histogram("tryon_request_seconds", "Try-on API request duration by endpoint")
+REQUESTS = Counter("tryon_requests_total", "Try-on API requests by endpoint and HTTP status")
+UPSTREAM_ERRORS = Counter("tryon_upstream_errors_total", "Failed try-on backend calls by backend")
+FALLBACKS = Counter(
+    "tryon_fallback_total",
+    "Fallback paths taken (legacy_route, payload_format, local_backend, recommendations)",
+)
+CACHE = Counter("tryon_cache_total", "Result cache lookups by outcome (hit, miss)")
+ADMISSION = Counter(
+    "tryon_admission_total",
+    "Upstream admission decisions (admitted, queued, rejected, rate_limited, timed_out) by priority class",
+)
+PAYLOAD_BYTES = Counter("tryon_payload_bytes_total", "Request and response body bytes (direction=in|out)")
+
+ALL_METRICS = (STAGE_SECONDS, REQUEST_SECONDS, REQUESTS, UPSTREAM_ERRORS, FALLBACKS, CACHE, ADMISSION,
+               PAYLOAD_BYTES)
+
+
+def stage(name: str, **labels):
+    """`with stage("upstream_encode"):` — time one pipeline stage."""
+    return STAGE_SECONDS.time(stage=name, **labels)
+
+
+def render() -> str:
+    lines = []
+    for metric in ALL_METRICS:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"